@@ -1,19 +1,10 @@
+import asyncio
 import os
-from get_products_by_dirs import dump_to_json
-from bs4 import BeautifulSoup
-import requests
+from get_products_by_dirs import dump_to_json, close_json
+from html_crawler import get_soup, run_crawl
 
-def get_soup(url, **kwargs): 
-    """
-        returns soup for url or None
-    """
-    response = requests.get(url, **kwargs)
-    if response.status_code == 200:
-        return BeautifulSoup(response.text, features='html.parser')
-    return None
 
-
-def get_sub_categories(url, fmt):
+async def get_sub_categories(url, fmt):
     """
     :param url:
     :param fmt:
@@ -21,7 +12,7 @@ def get_sub_categories(url, fmt):
         title: amount
     }
     """
-    soup = get_soup(url)  
+    soup = await get_soup(url)
     sub = {}
     if soup is None: 
         print('No soup') 
@@ -36,7 +27,7 @@ def get_sub_categories(url, fmt):
     return sub 
 
 
-def get_categories(url):
+async def get_categories(url):
     """
     :param url:
     :return:
@@ -46,14 +37,16 @@ def get_categories(url):
         ...
     ]
     """
-    soup = get_soup(url)  
+    soup = await get_soup(url)
     cats = []
     if soup is None: 
         print('No soup') 
     else: 
-        for cat in soup.select('.CategoriesMenuListItem'):   
-            href = cat.select_one('.CategoriesMenuListItem__link').attrs['href']
-            subs = get_sub_categories(url+href, url)
+        menu = soup.select('.CategoriesMenuListItem')
+        # subcategories of all categories are fetched at once
+        hrefs = [cat.select_one('.CategoriesMenuListItem__link').attrs['href'] for cat in menu]
+        all_subs = await asyncio.gather(*[get_sub_categories(url + href, url) for href in hrefs])
+        for cat, subs in zip(menu, all_subs):
             title = cat.attrs['title']
             print('\t' + title)
             item = {'Category': title, 'SubCategories': subs}
@@ -71,8 +64,15 @@ SHOPS = [
     {'name': 'varus', 'url': 'https://varus.zakaz.ua'},
     ]
 
-for shop in SHOPS: 
+
+async def crawl_shop(shop):
+    cats = await get_categories(shop['url'])
     print(shop['name'])
     filename = os.path.join(shop['name'], FILE_NAME)
-    cats = get_categories(shop['url']) 
     dump_to_json(filename, cats)
+    close_json(filename)
+    return cats
+
+
+if __name__ == '__main__':
+    run_crawl(SHOPS, crawl_shop)
@@ -1,60 +1,49 @@
-import json
-import math
+import asyncio
+import functools as ft
 import os
 import logging
-from bs4 import BeautifulSoup
-import requests
+from html_crawler import CrawlCheckpoint, get_soup, get_listing, listing_crawled, map_pages, page_unit, run_crawl
+from jsonl_writer import JsonlStore
 
 logging.basicConfig(filename='metadata.log', level=logging.DEBUG)
 
-def get_soup(url, **kwargs): 
+def merge_metadata(file_data, data):
     """
-        returns soup for url or None
+        adding data = {product: {category, subcategory}} to file_data
     """
-    response = requests.get(url, **kwargs)
-    if response.status_code == 200:
-        return BeautifulSoup(response.text, features='html.parser')
-    return None
+    # check each product in data to add
+    for k in data.keys():
 
-def dump_to_json(filename, data, **kwargs):
-    """
-        saving data = {product: {category, subcategory}} to filename.json
-    """
-    kwargs.setdefault('ensure_ascii', False)
-    kwargs.setdefault('indent', 2)
-    full_path = os.path.join(os.path.dirname(__file__), '..', 'data', filename)
-
-    # file not created yet
-    if not os.path.isfile(full_path):
-        with open(full_path, 'w', encoding='utf-8') as f:
-            json.dump({}, f, **kwargs)
+        file_data.setdefault(k, {})  
+        file_data[k].setdefault('category', []) 
+        file_data[k].setdefault('subcategory', []) 
+        
+        # (sub)category-value exist in product?
+        if data[k]['category'] not in file_data[k]['category']:
+            file_data[k]['category'].append(data[k]['category']) 
+            file_data[k]['subcategory'].append(data[k]['subcategory'])
+    return file_data
 
-    # work with created file
-    with open(full_path, 'r+', encoding='utf-8') as f:
 
-        # get file content
-        file_data = json.load(f) 
+metadata_store = JsonlStore(merge_metadata, dict)
+# categories crawled, a rerun after a crash continues from them
+checkpoint = CrawlCheckpoint(os.path.join(os.path.dirname(__file__), '..', 'data', 'metadata_config_checkpoint.jsonl'))
 
-        # check each product in data to add
-        for k in data.keys():
 
-            file_data.setdefault(k, {})  
-            file_data[k].setdefault('category', []) 
-            file_data[k].setdefault('subcategory', []) 
-            
-            # (sub)category-value exist in product?
-            if data[k]['category'] not in file_data[k]['category']:
-                file_data[k]['category'].append(data[k]['category']) 
-                file_data[k]['subcategory'].append(data[k]['subcategory'])
+def data_path(filename):
+    return os.path.join(os.path.dirname(__file__), '..', 'data', filename)
 
-        # add updated data to file 
-        f.seek(0)
-        json.dump(file_data, f, **kwargs)
 
-    logging.debug(f'Saved data to file: {filename}')
+def dump_to_json(filename, data, page_url=None):
+    """
+        saving data = {product: {category, subcategory}} to filename.json,
+        appended to the journal of the file until the shop is crawled,
+        data of a page_url, a category, is added once
+    """
+    metadata_store.append(data_path(filename), data, page_url)
 
 
-def get_products(url, cat, subcat):
+def get_products(page, url, cat, subcat):
     """
             returns products = {
                 title:
@@ -64,20 +53,19 @@ def get_products(url, cat, subcat):
                 }
             }
     """
-    soup = get_soup(url)
     products = {}
-    if soup is None:
+    if page is None:
         logging.warning(f'No soup for {url}')
     else:
-        for p in soup.select('.ProductsBox__listItem'):
-            if p.select_one('.ProductTile_withOpacity') is not None:  # Product not available
+        for tile in page.tiles:
+            if not tile.available:  # Product not available
                 break
-            title = p.select_one('.ProductTile__title').text
+            title = tile.title
             products[title] = {'category': cat, 'subcategory': subcat}
     return products
 
 
-def crawl_pages(url, cat, subcat):
+async def crawl_pages(url, cat, subcat):
     """
             returns products_on_page = {
                 title:
@@ -88,29 +76,26 @@ def crawl_pages(url, cat, subcat):
             }
     """
     products_on_page = {}
-    soup = get_soup(url)
+    page = await get_listing(url)
     fmt_page = url + '?page={}'
 
-    if soup is None:
+    if page is None:
         logging.warning(f'No soup for {url}')
     else:
 
         # Getting number of pages
-        amount = (soup.select_one('.FilterableLayout__productsCount') or soup.select_one(
-            '.SecondLevelCategory__goodsNumber')).text
-        amount = int(amount.split(' ')[0])
-        pages_count = min(math.ceil(amount / 30 + 1),
-                        int(soup.select('.Pagination__item')[-1].text) if soup.select('.Pagination__item') else 1)
-
-        # For each page getting products
-        for i in range(1, pages_count + 1):
-            logging.debug(f'Start crawling page: {str(i)}')
-            url = fmt_page.format(i)
-            products_on_page.update(get_products(url=url, cat=cat, subcat=subcat))
+        pages_count = page.pages_count()
+
+        # For each page getting products, the first page is the fetched (sub)category page, others are fetched at once
+        logging.debug(f'Start crawling {pages_count} pages')
+        products_on_page.update(get_products(page, fmt_page.format(1), cat=cat, subcat=subcat))
+        for products in await map_pages([fmt_page.format(i) for i in range(2, pages_count + 1)],
+                                        ft.partial(get_products, cat=cat, subcat=subcat)):
+            products_on_page.update(products)
     return products_on_page
 
 
-def get_sub_categories(url, fmt, cat):
+async def get_sub_categories(url, fmt, cat):
     """
             returns subs = {
                 title:
@@ -121,29 +106,33 @@ def get_sub_categories(url, fmt, cat):
             }
     """
     subs = {}
-    soup = get_soup(url)
+    soup = await get_soup(url)
     if soup is None:
         logging.warning(f'No soup for {url}')
     else:
         # subcategories exist
         if soup.select('.CategoriesBox__list'):
 
-            # Get products for each subcategory for each page
-            for s in soup.select('.CategoriesBox__listItem'):
+            async def crawl_sub_category(s):
                 title = s.select_one('.CategoryCard__title').text
                 logging.debug(f'Subcategory: {title}')
                 href = s.select_one('.CategoryCard').attrs['href']
-                subs.update(crawl_pages(url=fmt + href, cat=cat, subcat=title))
+                return await crawl_pages(url=fmt + href, cat=cat, subcat=title)
+
+            # Get products for each subcategory for each page, subcategories are crawled at once
+            for products in await asyncio.gather(*[crawl_sub_category(s)
+                                                   for s in soup.select('.CategoriesBox__listItem')]):
+                subs.update(products)
 
         # no subcategories
         else:
             # Get products for category for each page
             logging.debug('No subcategories')
-            subs.update(crawl_pages(url, cat=cat, subcat="No subcategories"))
+            subs.update(await crawl_pages(url, cat=cat, subcat="No subcategories"))
     return subs
 
 
-def get_categories(url, name):
+async def get_categories(url, name):
     """
             returns cats = {
                 title:
@@ -154,17 +143,26 @@ def get_categories(url, name):
             }
     """
     cats = {}
-    soup = get_soup(url)
+    soup = await get_soup(url)
     if soup is None:
         logging.warning(f'No soup for {url}')
     else:
-        # Get products for each category
-        for cat in soup.select('.CategoriesMenuListItem'):
+        async def crawl_category(cat):
             title = cat.attrs['title']
             logging.debug(f'Category: {title}')
             href = cat.select_one('.CategoriesMenuListItem__link').attrs['href']
-            cats.update(get_sub_categories(url=url+href, fmt=url, cat=title))
-            dump_to_json(name, cats)
+            if listing_crawled(url + href, checkpoint):
+                return {}
+            subs = await get_sub_categories(url=url+href, fmt=url, cat=title)
+            # saved as soon as the category is crawled, dump_to_json merges it into the file
+            dump_to_json(name, subs, url + href)
+            checkpoint.done(page_unit(url + href))
+            return subs
+
+        # Get products for each category, categories are crawled at once
+        for subs in await asyncio.gather(*[crawl_category(cat) for cat in soup.select('.CategoriesMenuListItem')]):
+            cats.update(subs)
+        metadata_store.close(data_path(name))
     return cats
 
 
@@ -177,8 +175,19 @@ SHOPS = [
     {'name': 'novus', 'url': 'https://novus.zakaz.ua'},
     {'name': 'varus', 'url': 'https://varus.zakaz.ua'},
 ]
-for shop in SHOPS:
+
+
+async def crawl_shop(shop):
     logging.debug(f'Shop: {shop["name"]}')
 
     file_name = shop['name'] + "_" + FILE_NAME
-    get_categories(shop['url'], os.path.join(shop['name'], file_name))
+    return await get_categories(shop['url'], os.path.join(shop['name'], file_name))
+
+
+if __name__ == '__main__':
+    with checkpoint:
+        try:
+            run_crawl(SHOPS, crawl_shop)
+        finally:
+            metadata_store.close_all()
+        checkpoint.complete()
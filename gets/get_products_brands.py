@@ -1,10 +1,10 @@
-from bs4 import BeautifulSoup
-import requests
-import json 
-import math
+import asyncio
+import functools as ft
 import os 
 import logging
 import re
+from html_crawler import CrawlCheckpoint, get_soup, get_listing, listing_crawled, map_listing, run_crawl
+from jsonl_writer import JsonlStore, concat_lists
 
 FILE_NAME = 'product_brands.json'
 SHOPS = [
@@ -19,53 +19,45 @@ SHOPS = [
 logging.basicConfig(filename='../metadata.log', level=logging.DEBUG)
 
 
-def get_soup(url, **kwargs): 
+brands_store = JsonlStore(concat_lists, list)
+# (sub)categories and pages crawled, a rerun after a crash continues from them
+checkpoint = CrawlCheckpoint(os.path.join(os.path.dirname(__file__), '..', 'data', 'products_brands_checkpoint.jsonl'))
+
+
+def data_path(filename):
+    # all will be saved in dir data + filename
+    return os.path.join(os.path.dirname(__file__), '..', 'data', filename).strip()
+
+
+def dump_to_json(filename, data, page_url=None):
     """
-        returns soup for url or None
+            filename - path to (sub)category to save data
+            data - list of brands products
+            page_url - page the data is parsed from, data of a page is added once
+            saving data to json = [] in dir data, appended to the journal of the file until close_json
     """
-    response = requests.get(url, **kwargs)
-    if response.status_code == 200:
-        return BeautifulSoup(response.text, features='html.parser')
-    return None
+    brands_store.append(data_path(filename), data, page_url)
 
 
-def dump_to_json(filename, data, **kwargs):
+def close_json(filename):
     """
-            saving data to json = [] in directory data
+            saves the file once all pages of its (sub)category are added
     """
-    kwargs.setdefault('ensure_ascii', False)
-    kwargs.setdefault('indent', 2)  
-    full_path = os.path.join(os.path.dirname(__file__), '..', 'data', filename).strip()
-
-    # file not created yet
-    if not os.path.isfile(full_path): 
-        with open(full_path, 'w', encoding='utf-8') as f:  
-            json.dump([], f, **kwargs)
-            logging.debug(f'Created file: {filename}')
-    
-    with open(full_path, 'r+', encoding='utf-8') as f: 
-        file_data = json.load(f) # saving data from file 
-        file_data = [*file_data, *data] # adding new data
-        
-        # rewriting updated data to file  
-        f.seek(0)
-        json.dump(file_data, f, **kwargs) 
-        logging.debug(f'Saved data to file: {filename}')
+    return brands_store.close(data_path(filename))
 
 
-def get_products(url, path): 
+def get_products(page, url, path):
     """
             returns a list of products by url [title1, title2, title3, ...]
     """
-    soup = get_soup(url) 
     products = []
-    if soup is None: 
+    if page is None: 
         logging.warning(f'No soup for product {url}')
     else: 
-        for p in soup.select('.ProductsBox__listItem'): 
-            if p.select_one('.ProductTile_withOpacity') is not None: 
+        for tile in page.tiles: 
+            if not tile.available: 
                 break
-            product_title = p.select_one('.ProductTile__title').text  
+            product_title = tile.title  
             rb_first_letter = "(?<=\s)([A-ZА-ЯЇІЄҐ]" 
             rb_word = rb_first_letter + "[A-ZА-Яa-zа-яЇїІіЄєҐґ\-\—\.®']+\s?)+\s*" 
             rb_exc = "[a-zа-яїієґ\-\—\.®']{0,5}\s*" 
@@ -75,41 +67,41 @@ def get_products(url, path):
                 brand = brand.group()
             products.append(brand) 
     full_path = os.path.join(path, FILE_NAME)
-    dump_to_json(full_path, products)
+    dump_to_json(full_path, products, url)
     return products
 
 
-def crawl_pages(url, path): 
+async def crawl_pages(url, path):
     """
             returns list of brands products on page by url [title1, title2, title3, ...]
     """
     products_on_page = [] 
-    soup = get_soup(url)  
-    fmtp = url + '?page={}'
+    if listing_crawled(url, checkpoint):
+        return products_on_page
+    page = await get_listing(url, checkpoint)
 
-    if soup is None: 
+    if page is None:
         logging.warning(f'No soup for page {url}')
-    else: 
+    else:
         # Getting number of pages
-        amount = (soup.select_one('.FilterableLayout__productsCount') or soup.select_one('.SecondLevelCategory__goodsNumber')).text  
-        amount = int(amount.split(' ')[0])
-        pages_count = min(math.ceil(amount/30 + 1), int(soup.select('.Pagination__item')[-1].text) if soup.select('.Pagination__item') else 1)
-
-        # For each page getting products
-        for i in range(1, pages_count+1): 
-            logging.debug(f'Page: {str(i)}')
-            url = fmtp.format(i) 
-            products_on_page.extend(get_products(url = url, path = path)) 
+        pages_count = page.pages_count()
+
+        # For each page getting products, the first page is the fetched (sub)category page, others are fetched at once,
+        # pages crawled before the crawl was interrupted are skipped
+        logging.debug(f'Pages: {pages_count}')
+        for products in await map_listing(url, page, ft.partial(get_products, path = path), checkpoint):
+            products_on_page.extend(products)
+        close_json(os.path.join(path, FILE_NAME))
     
     return products_on_page
 
 
-def get_sub_categories(url, fmt, path):
+async def get_sub_categories(url, fmt, path):
     """
             returns a list of brands products in subcategory by url [title1, title2, title3, ...]
     """
 
-    soup = get_soup(url)  
+    soup = await get_soup(url)
     products_in_sub = [] 
     if soup is None: 
         logging.warning(f'No soup for subcategory {url}')
@@ -118,39 +110,55 @@ def get_sub_categories(url, fmt, path):
         # subcategories exist
         if soup.select('.CategoriesBox__list'): 
 
-            # Get products for each subcategory for each page
-            for s in soup.select('.CategoriesBox__listItem'): 
+            async def crawl_sub_category(s):
                 title = s.select_one('.CategoryCard__title').text
                 logging.debug(f'Subcategory: {title}')
                 full_path = os.path.join(path, title).strip()
                 href = s.select_one('.CategoryCard').attrs['href']
-                products_in_sub.extend(crawl_pages(url = fmt+href, path = full_path))
+                return await crawl_pages(url = fmt+href, path = full_path)
+
+            # Get products for each subcategory for each page, subcategories are crawled at once
+            for products in await asyncio.gather(*[crawl_sub_category(s) for s in soup.select('.CategoriesBox__listItem')]):
+                products_in_sub.extend(products)
 
         # no subcategories
         else: 
             logging.debug('Category with no subcategories')
-            products_in_sub.extend(crawl_pages(url = url, path = path.strip()))
+            products_in_sub.extend(await crawl_pages(url = url, path = path.strip()))
     return products_in_sub 
 
 
-def get_categories(url, path):  
+async def get_categories(url, path):
     """
             returns list of brands products in category by url [title1, title2, title3, ...]
     """
-    soup = get_soup(url)  
+    soup = await get_soup(url)
     products_in_cat = []
     if soup is None: 
         logging.warning(f'No soup for category {url}')
     else:  
-        for cat in soup.select('.CategoriesMenuListItem'):  
+        async def crawl_category(cat):
             title = cat.attrs['title']
             logging.debug(f'Category: {title}')
             href = cat.select_one('.CategoriesMenuListItem__link').attrs['href']
             path_to_cat = os.path.join(path, title).strip()
-            products_in_cat.extend(get_sub_categories(url = url + href, fmt = url, path=path_to_cat))
+            return await get_sub_categories(url = url + href, fmt = url, path=path_to_cat)
+
+        # categories are crawled at once
+        for products in await asyncio.gather(*[crawl_category(cat) for cat in soup.select('.CategoriesMenuListItem')]):
+            products_in_cat.extend(products)
     return products_in_cat
 
 
-for shop in SHOPS:
-    logging.debug(f'Shop{shop["name"]}')  
-    data = get_categories(url = shop['url'], path = shop['name'])
+async def crawl_shop(shop):
+    logging.debug(f'Shop{shop["name"]}')
+    return await get_categories(url = shop['url'], path = shop['name'])
+
+
+if __name__ == '__main__':
+    with checkpoint:
+        try:
+            data = run_crawl(SHOPS, crawl_shop)
+        finally:
+            brands_store.close_all()
+        checkpoint.complete()
@@ -1,52 +1,39 @@
-import json 
-import math
+import asyncio
+import functools as ft
 import os 
 import logging 
 import re 
-from bs4 import BeautifulSoup
-import requests
+from html_crawler import CrawlCheckpoint, get_soup, get_listing, listing_crawled, map_listing, run_crawl
+from jsonl_writer import JsonlStore, extend_lists
 
 logging.basicConfig(filename='metadata.log', level=logging.DEBUG)
 
 
-def get_soup(url, **kwargs): 
-    """
-        returns soup for url or None
-    """
-    response = requests.get(url, **kwargs)
-    if response.status_code == 200:
-        return BeautifulSoup(response.text, features='html.parser')
-    return None
+products_store = JsonlStore(extend_lists, dict)
+# (sub)categories and pages crawled, a rerun after a crash continues from them
+checkpoint = CrawlCheckpoint(os.path.join(os.path.dirname(__file__), '..', 'data', 'products_by_dirs_checkpoint.jsonl'))
+
 
-def dump_to_json(filename, data, **kwargs):
+def dump_to_json(filename, data, page_url=None):
     """
             filename - path like .../category/subcategory/products.json 
             data - {productKey: { title, brand, price... etc}} 
+            page_url - page the data is parsed from, data of a page is added once
+            appended to the journal of the file, close_json compacts it into the file
     """
-    kwargs.setdefault('ensure_ascii', False)
-    kwargs.setdefault('indent', 2)  
-    
-    # file not created yet
-    if not os.path.isfile(filename): 
-        with open(filename, 'w', encoding='utf-8') as f:  
-            json.dump({}, f, **kwargs)
-    
-    with open(filename, 'r+', encoding='utf-8') as f: 
-        file_data = json.load(f) # saving data from file 
-        # adding data to data from file by key
-        for k in data.keys(): 
-            file_data.setdefault(k, [])  
-            file_data[k].extend(data[k])
-        
-        # rewriting updated data to file  
-        f.seek(0)
-        json.dump(file_data, f, **kwargs)
-    
-    logging.debug(f'Saved data to file: {filename}')
+    products_store.append(filename, data, page_url)
 
 
-def parse_product(url, fmt, path): 
+def close_json(filename):
     """
+            saves the file once all data of its (sub)category is added
+    """
+    return products_store.close(filename)
+
+
+def parse_product(page, url, fmt, path):
+    """
+            page - product tiles of the fetched page or None
             url - path to page with products 
             fmt - universal part of url to product (to create link to product)
             path - created path to save result products 
@@ -55,17 +42,16 @@ def parse_product(url, fmt, path):
                                 keyTitle2: {title, price, amount ... etc }, 
                                 ...etc}
     """
-    soup = get_soup(url) 
     products = {} 
-    if soup is None: 
+    if page is None: 
         logging.warning(f'No soup for {url}')
     else: 
         # iterating over cards for products 
-        for p in soup.select('.ProductsBox__listItem'): 
-            if p.select_one('.ProductTile_withOpacity') is not None: # product not available
+        for tile in page.tiles: 
+            if not tile.available: # product not available
                 break
             
-            product_title = p.select_one('.ProductTile__title').text # title product 
+            product_title = tile.title # title product 
             product_key = product_title # key title for grouping products (without brand, amount)
 
             rb_first_letter = "(?<=\s)([A-ZА-ЯЇІЄҐ]" # без першого слова у рядку і з великої літери 
@@ -93,12 +79,12 @@ def parse_product(url, fmt, path):
                 product_key = re.sub(percentages, '', product_key) # deleting percentages from key
                 product_key = re.sub('  ', ' ', product_key) # deleting double spaces
 
-            href = p.select_one('.ProductTile').attrs['href'] # link to product
+            href = tile.href # link to product
             price = '-' # if no price for product  
-            if p.select_one('.Price__value_caption'): # if price found 
-                price = p.select_one('.Price__value_caption').text 
+            if tile.price is not None: # if price found 
+                price = tile.price 
 
-            size = p.select_one('.ProductTile__weight').text # size from html 
+            size = tile.weight or '' # size from html 
             size = re.sub('за', '', size) # deleting from size "за" (за 1кг -> 1кг, за 1л -> 1л)
             size = re.sub(' ', '', size) # deleting double spaces
 
@@ -117,12 +103,12 @@ def parse_product(url, fmt, path):
             products[product_key].append(product) # resulting object of products
     
     full_path = os.path.join(path, 'products.json').strip() # path from category to end file
-    dump_to_json(full_path, products) 
+    dump_to_json(full_path, products, url) 
 
     return products
 
 
-def crawl_pages(url, fmt, path): 
+async def crawl_pages(url, fmt, path):
     """
             url - url to (sub)category 
             fmt - start url to create link to page (adding ?page = i)
@@ -131,30 +117,29 @@ def crawl_pages(url, fmt, path):
             returns products_on_page = [{parsed_prod1}, {parsed_prod2}, ... etc]
     """
     products_on_page = [] 
-    soup = get_soup(url)  
-    fmtp = url + '?page={}' # pagination
+    if listing_crawled(url, checkpoint):
+        return products_on_page
+    page = await get_listing(url, checkpoint)
 
-    if soup is None: 
+    if page is None:
         logging.warning(f'No soup for {url}')
-    else: 
+    else:
         # Getting number of pages
-        # amount - num of available products in (sub)category, stored on page in one of 2 tags 
-        amount = (soup.select_one('.FilterableLayout__productsCount') or soup.select_one('.SecondLevelCategory__goodsNumber')).text  
-        amount = int(amount.split(' ')[0])
-        # num of pages - text in the last item in pagination block 
-            # or (if there are not available products) - num of available products / num of visible on page + 1 
-            # if no pagination block - there is one page 
-        pages_count = min(math.ceil(amount/30 + 1), int(soup.select('.Pagination__item')[-1].text) if soup.select('.Pagination__item') else 1)
-
-        # For each page getting products
-        for i in range(1, pages_count+1): 
-            logging.debug(f'Start crawling page: {str(i)}')
-            url = fmtp.format(i) # url of page 
-            products_on_page.extend(parse_product(url, fmt, path)) # adding products by each page 
+        # num of pages - text in the last item in pagination block
+            # or (if there are not available products) - num of available products / num of visible on page + 1
+            # if no pagination block - there is one page
+        pages_count = page.pages_count()
+
+        # For each page getting products, the first page is the fetched (sub)category page, others are fetched at once,
+        # pages crawled before the crawl was interrupted are skipped
+        logging.debug(f'Start crawling {pages_count} pages of {url}')
+        for products in await map_listing(url, page, ft.partial(parse_product, fmt=fmt, path=path), checkpoint):
+            products_on_page.extend(products) # adding products by each page
+        close_json(os.path.join(path, 'products.json').strip())
     return products_on_page
 
 
-def parse_sub_categories(url, fmt, path):
+async def parse_sub_categories(url, fmt, path):
     """
             url - url for category to explore 
             fmt - url to create link to subcategory 
@@ -163,7 +148,7 @@ def parse_sub_categories(url, fmt, path):
             returns sub = [{subcategory1: {Products1}}, {subcategory1: {Products2}}]
     """
 
-    soup = get_soup(url)  
+    soup = await get_soup(url)
     sub = [] 
     if soup is None: 
         logging.warning(f'No soup for {url}')
@@ -171,20 +156,18 @@ def parse_sub_categories(url, fmt, path):
         # Subcategory exists
         if soup.select('.CategoriesBox__list'): # (blocks for subcategories)
 
-            # Get products for each subcategory in category 
-            for s in soup.select('.CategoriesBox__listItem'): # blocks for subcategories
-
+            async def parse_sub_category(s):
                 title = s.select_one('.CategoryCard__title').text # subcategory title
                 logging.debug(f'Subcategory: {title}')
 
                 # dir for subcategory in category
                 full_path = os.path.join(path, title).strip() # 'categoryName/subcategoryName'
-                os.mkdir(full_path) # making dir for end results
+                os.makedirs(full_path, exist_ok=True) # making dir for end results, it exists when the crawl is resumed
 
                 href = s.select_one('.CategoryCard').attrs['href'] # subcategory link 
                 amount = s.select_one('.CategoryCard__label').text.split(' ')[0] # number of products in subcategory 
                 
-                products = crawl_pages(fmt+href, fmt, full_path) # explore each page in subcategory 
+                products = await crawl_pages(fmt+href, fmt, full_path) # explore each page in subcategory
 
                 # subcategory is a dictionary
                 item = {
@@ -193,6 +176,10 @@ def parse_sub_categories(url, fmt, path):
                     'sub amount': amount, 
                     'products': products
                 }
+                return item
+
+            # Get products for each subcategory in category, subcategories are crawled at once
+            for item in await asyncio.gather(*[parse_sub_category(s) for s in soup.select('.CategoriesBox__listItem')]):
                 # list with subcategories
                 sub.extend(item) # [{...subcatInfo, {Products}}}, {...subcatInfo, {Products}}]
 
@@ -200,7 +187,7 @@ def parse_sub_categories(url, fmt, path):
         else: 
             # no link to subcategory, so explore products in category
             logging.debug('No subcategories')
-            products = crawl_pages(url, fmt, path)
+            products = await crawl_pages(url, fmt, path)
 
             # subcategory is a dictionary
             item = {
@@ -211,40 +198,47 @@ def parse_sub_categories(url, fmt, path):
     return sub 
 
 
-def get_categories(url, name):  
+async def get_categories(url, name):
     """
             url - url to catgeory 
             name - name of shop (to create dir to save products)
 
             returns [{CategoryName, Link, {Subcategories}}, ... etc]
     """
-    soup = get_soup(url)  
+    soup = await get_soup(url)
     cats = []
     if soup is None: 
         logging.warning(f'No soup for {url}')
     else:  
-        # for each category item 
-        for cat in soup.select('.CategoriesMenuListItem'):  
+        async def parse_category(cat):
             title = cat.attrs['title'] # title of the category
             logging.debug(f'Category: {title}')
 
             # directory for each category
             full_path = os.path.join(os.path.dirname(__file__), "..", 'data', name, title).strip()
-            os.mkdir(full_path) 
+            os.makedirs(full_path, exist_ok=True) 
 
             href = cat.select_one('.CategoriesMenuListItem__link').attrs['href'] # link to the category 
-            subs = parse_sub_categories(url = url + href, fmt = url, path = full_path) # subcategories [{SubCat: {prods}}, {SubCat: {prods}}]
+            subs = await parse_sub_categories(url = url + href, fmt = url, path = full_path) # subcategories [{SubCat: {prods}}, {SubCat: {prods}}]
 
             # category is a dictionary
-            item = {
+            return {
                 'category name': title, 
                 'link': url + href, 
                 'sub categories': subs
             }
+
+        # for each category item, categories are crawled at once
+        for item in await asyncio.gather(*[parse_category(cat) for cat in soup.select('.CategoriesMenuListItem')]):
             cats.extend(item)
     return cats
 
 
+async def crawl_shop(shop):
+    logging.debug(f'Shop{shop["name"]}')
+    return await get_categories(shop['url'], shop['name'])
+
+
 FILE_NAME = 'products.json'
 SHOPS = [
     {'name': 'auchan', 'url': 'https://auchan.zakaz.ua'}, 
@@ -255,6 +249,10 @@ SHOPS = [
     {'name': 'varus', 'url': 'https://varus.zakaz.ua'},
     ]
 
-for shop in SHOPS:
-    logging.debug(f'Shop{shop["name"]}')
-    data = get_categories(shop['url'], shop['name'])  
+if __name__ == '__main__':
+    with checkpoint:
+        try:
+            data = run_crawl(SHOPS, crawl_shop)
+        finally:
+            products_store.close_all()
+        checkpoint.complete()
@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+from urllib.parse import urlparse
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+from checkpoints import CrawlCheckpoint  # noqa: E402
+from extensions import HttpClient, HttpClientSettings, HttpResponseType, get_http_response_info  # noqa: E402
+from html_tiles import ListingPage, parse_listing, lxml_html  # noqa: E402
+from rate_limiter import get_rate_limiter  # noqa: E402
+
+T = TypeVar("T")
+
+# lxml builds the tree of BeautifulSoup several times faster than the builtin html.parser
+soup_features = 'lxml' if lxml_html is not None else 'html.parser'
+# listing pages are saved to this directory when it is set, benchmark.py html-tiles parses them given --pages_dir
+pages_dir = os.environ.get("GETS_PAGES_DIR")
+
+
+def shop_name(url: str) -> str:
+    """
+        name of the shop of a page, https://novus.zakaz.ua/uk/... is a page of novus,
+        requests to a shop share its rate limiter from scraping_config.json
+    """
+    return (urlparse(url).hostname or "").split(".")[0]
+
+
+def page_unit(url: str) -> Tuple[str, str]:
+    """unit of a checkpoint for a page or a whole (sub)category"""
+    return shop_name(url), url
+
+
+async def get_html(url: str, **kwargs) -> Optional[str]:
+    """
+        returns html of url or None
+    """
+    response_info = await get_http_response_info(url, params=kwargs.get('params'), headers=kwargs.get('headers'),
+                                                 response_body_type=HttpResponseType.Text,
+                                                 rate_limiter=get_rate_limiter(shop_name(url)))
+    if response_info.get("status") == 200:
+        return response_info["response"]
+    return None
+
+
+async def get_soup(url: str, **kwargs) -> Optional[BeautifulSoup]:
+    """
+        returns soup for url or None
+    """
+    page_html = await get_html(url, **kwargs)
+    return BeautifulSoup(page_html, features=soup_features) if page_html is not None else None
+
+
+async def get_listing(url: str, checkpoint: CrawlCheckpoint = None, **kwargs) -> Optional[ListingPage]:
+    """
+        returns product tiles and pagination of a listing page or None,
+        parsed by the PRODUCTS_HTML_PARSER backend of html_tiles, the fastest installed one by default,
+        a failed page is reported to the checkpoint, so it is kept to crawl the page again
+    """
+    page_html = await get_html(url, **kwargs)
+    if page_html is None:
+        if checkpoint is not None:
+            checkpoint.failed(page_unit(url))
+        return None
+    if pages_dir:
+        os.makedirs(pages_dir, exist_ok=True)
+        page_name = f'{shop_name(url)}_{hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]}.html'
+        with open(os.path.join(pages_dir, page_name), 'w', encoding='utf-8') as f:
+            f.write(page_html)
+    return parse_listing(page_html)
+
+
+def listing_crawled(url: str, checkpoint: CrawlCheckpoint = None) -> bool:
+    """
+        whether all pages of the (sub)category at url were crawled before the crawl was interrupted
+    """
+    if checkpoint is not None and page_unit(url) in checkpoint:
+        logging.debug(f'Skipping {url}, it was crawled before the crawl was interrupted')
+        return True
+    return False
+
+
+async def map_pages(urls: List[str], parse: Callable[[Optional[ListingPage], str], T],
+                    checkpoint: CrawlCheckpoint = None, fetched: Dict[str, ListingPage] = None) -> List[T]:
+    """
+        fetches listing pages concurrently and calls parse(page, url) for each page as soon as it arrives,
+        returns results in the order of urls,
+        pages in fetched are parsed without requests, pages recorded in the checkpoint are skipped
+        and parsed pages are recorded in it, failed pages are crawled again on restart
+    """
+    async def fetch_and_parse(url: str) -> T:
+        page = fetched[url] if fetched and url in fetched else await get_listing(url, checkpoint)
+        result = parse(page, url)
+        if checkpoint is not None and page is not None:
+            checkpoint.done(page_unit(url))
+        return result
+
+    return list(await asyncio.gather(*[fetch_and_parse(url) for url in urls
+                                       if checkpoint is None or page_unit(url) not in checkpoint]))
+
+
+async def map_listing(url: str, page: ListingPage, parse: Callable[[Optional[ListingPage], str], T],
+                      checkpoint: CrawlCheckpoint = None) -> List[T]:
+    """
+        calls parse(page, url) for each page of the (sub)category at url, page is its fetched first page,
+        others are fetched at once, the (sub)category is recorded in the checkpoint once all of its pages are
+    """
+    fmt_page = url + '?page={}'
+    urls = [fmt_page.format(i) for i in range(1, page.pages_count() + 1)]
+    results = await map_pages(urls, parse, checkpoint, {urls[0]: page})
+    if checkpoint is not None and all(page_unit(page_url) in checkpoint for page_url in urls):
+        checkpoint.done(page_unit(url))
+    return results
+
+
+def run_crawl(shops: List[Dict[str, str]], crawl_shop: Callable[[Dict[str, str]], Awaitable[Any]],
+              settings: HttpClientSettings = None) -> List[Any]:
+    """
+        crawls all shops at once on one pooled HTTP client, returns results of crawl_shop in the order of shops
+    """
+    async def crawl() -> List[Any]:
+        async with HttpClient(settings):
+            return list(await asyncio.gather(*[crawl_shop(shop) for shop in shops]))
+
+    start = time.perf_counter()
+    results = asyncio.run(crawl())
+    logging.info(f'Crawled {len(shops)} shops in {time.perf_counter() - start:.1f} s')
+    return results
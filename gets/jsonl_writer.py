@@ -0,0 +1,190 @@
+import logging
+import os
+import sys
+from typing import Any, Callable, Dict, Optional, Set
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+from catalog_storage import atomic_write  # noqa: E402
+from serialization import dump, dumps_bytes, load_file, loads  # noqa: E402
+
+journal_suffix = '.jsonl'
+# journals of files smaller than this are compacted only when their writer is closed
+compact_min_bytes = 1024 * 1024
+
+
+def file_stamp(path: str) -> Optional[Dict[str, int]]:
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class JsonlWriter():
+    """
+        Appends records to the journal `<path>.jsonl` one line each and compacts them into the JSON file at `path`,
+        so a write costs the size of the record instead of the size of the file.
+        `merge(value, record)` folds a record into the value of the file, which starts as the content `path` had,
+        so files of previous crawls are merged into as before, or as `empty()` without one.
+        The first line of the journal refers to the file by its size and mtime instead of copying it. The file is
+        compacted when the writer is closed, or once the journal grows past `compact_ratio` times the file, and is
+        replaced atomically. A compaction starts a new journal referring to the new file, and the journal is removed
+        once the writer is closed. After a crash the journal is still there: reopening it folds its records into the
+        file again and drops a torn last line, so a crawl resumes from the records written before it was interrupted.
+        When the file is not the one the journal refers to, the crash came after a compaction which saved its records.
+        A record may be appended with a key, the url of the page it was parsed from. A record whose key is already in
+        the journal is dropped, so a page which is crawled again after an interruption is not added twice, keys of
+        compacted records are kept in the first line of the new journal.
+    """
+
+    def __init__(self, path: str, merge: Callable[[Any, Any], Any], empty: Callable[[], Any],
+                 compact_ratio: float = 1.0):
+        self.path = path
+        self.journal_path = path + journal_suffix
+        self.merge = merge
+        self.empty = empty
+        self.compact_ratio = compact_ratio
+        self.value: Any = None
+        self.pending = 0
+        self.journal_bytes = 0
+        self.file_bytes = 0
+        self.keys: Set[str] = set()
+        self.journal = None
+
+    def load(self) -> Any:
+        if os.path.isfile(self.path):
+            try:
+                return load_file(self.path)
+            except ValueError:
+                logging.warning(f'{self.path} is not valid JSON, moving it to {self.path}.bak')
+                os.replace(self.path, self.path + '.bak')
+        return self.empty()
+
+    def start_journal(self):
+        """Starts a journal of the records to fold into the current file"""
+        with atomic_write(self.journal_path, 'wb') as f:
+            f.write(dumps_bytes({"file": file_stamp(self.path), "keys": sorted(self.keys)}, indent=False) + b"\n")
+        self.pending = 0
+        self.journal_bytes = 0
+        self.file_bytes = os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+
+    def open(self) -> "JsonlWriter":
+        if self.journal:
+            return self
+        self.value = self.load()
+        if not os.path.isfile(self.journal_path):
+            self.keys = set()
+            self.start_journal()
+
+        with open(self.journal_path, 'rb') as f:
+            data = f.read()
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            logging.warning(f'Dropping a torn record of {self.journal_path}')
+        header, *records = data[:complete].splitlines()
+        header_entry = loads(header)
+        self.keys = set(header_entry["keys"])
+        compacted = os.path.isfile(self.path) and header_entry["file"] != file_stamp(self.path)
+        if compacted:
+            logging.info(f'Records of {self.journal_path} are already compacted into {self.path}')
+        for line in records:
+            entry = loads(line)
+            if entry["key"] is not None:
+                self.keys.add(entry["key"])
+            if not compacted:
+                self.value = self.merge(self.value, entry["record"])
+
+        if compacted:
+            self.start_journal()
+        else:
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(complete)
+            # records written before an interruption are not compacted yet
+            self.pending = len(records)
+            self.journal_bytes = complete - len(header) - 1
+            self.file_bytes = os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+        self.journal = open(self.journal_path, 'ab')
+        return self
+
+    def append(self, record: Any, key: Optional[str] = None):
+        if key is not None:
+            if key in self.keys:
+                logging.debug(f'Skipping a record of {key}, it is already in {self.journal_path}')
+                return
+            self.keys.add(key)
+        line = dumps_bytes({"key": key, "record": record}, indent=False) + b"\n"
+        self.journal.write(line)
+        self.journal.flush()
+        self.value = self.merge(self.value, record)
+        self.pending += 1
+        self.journal_bytes += len(line)
+        if self.journal_bytes > self.compact_ratio * max(self.file_bytes, compact_min_bytes):
+            self.compact()
+            self.journal.close()
+            self.start_journal()
+            self.journal = open(self.journal_path, 'ab')
+
+    def compact(self):
+        with atomic_write(self.path, 'wb') as f:
+            dump(self.value, f)
+        self.pending = 0
+        logging.debug(f'Saved data to file: {self.path}')
+
+    def close(self):
+        if self.journal:
+            if self.pending or not os.path.isfile(self.path):
+                self.compact()
+            self.journal.close()
+            self.journal = None
+            os.remove(self.journal_path)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class JsonlStore():
+    """Open writers of the files a crawl is writing, records of a file go to one writer until it is closed"""
+
+    def __init__(self, merge: Callable[[Any, Any], Any], empty: Callable[[], Any], compact_ratio: float = 1.0):
+        self.merge = merge
+        self.empty = empty
+        self.compact_ratio = compact_ratio
+        self.writers: Dict[str, JsonlWriter] = {}
+
+    def writer(self, path: str) -> JsonlWriter:
+        if path not in self.writers:
+            self.writers[path] = JsonlWriter(path, self.merge, self.empty, self.compact_ratio).open()
+        return self.writers[path]
+
+    def append(self, path: str, record: Any, key: Optional[str] = None):
+        self.writer(path).append(record, key)
+
+    def close(self, path: str) -> Optional[Any]:
+        """Compacts the file once all of its records are written, returns its value"""
+        writer = self.writers.pop(path, None)
+        if writer is None:
+            # records of an interrupted crawl whose pages were all skipped by the resumed one
+            if not os.path.isfile(path + journal_suffix):
+                return None
+            writer = JsonlWriter(path, self.merge, self.empty, self.compact_ratio).open()
+        writer.close()
+        return writer.value
+
+    def close_all(self):
+        for path in list(self.writers):
+            self.close(path)
+
+
+def extend_lists(file_data: Dict[str, list], data: Dict[str, list]) -> Dict[str, list]:
+    """adding data to data from file by key"""
+    for k in data.keys():
+        file_data.setdefault(k, [])
+        file_data[k].extend(data[k])
+    return file_data
+
+
+def concat_lists(file_data: list, data: list) -> list:
+    file_data.extend(data)
+    return file_data
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 
 from pydantic import BaseModel
 from datetime import datetime, date
@@ -113,3 +113,16 @@ class ProductsShopRequest(BaseModel):
 class ChequeMulti(BaseModel):
     buy_list: List[ProductsShopRequest]
     end_price: int
+
+class ChequeMultiOptimized(ChequeMulti):
+    end_price: float # products price plus shop fees
+    shops: List[str]
+    products_price: float
+    shop_fee: float
+    missing_requests: List[BuyPreference]
+
+class BuyListResult(BaseModel):
+    request_index: int
+    shop_cheques: Optional[Dict[str, ChequeShop]]
+    multi_cheque: Optional[Union[ChequeMultiOptimized, ChequeMulti]]
+    error: Optional[str]
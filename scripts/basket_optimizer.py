@@ -0,0 +1,127 @@
+import math
+from typing import List, Optional, Tuple
+
+from pydantic import BaseModel
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# subsets of shops times items searched exhaustively, 14 shops and 50 items take 2^14 * 50 cells
+exact_search_max_cells = 2 ** 24
+# subsets are priced in chunks sharing the same high shops, a chunk holds at most this many cells
+exact_search_chunk_cells = 2 ** 20
+
+
+class BasketPlan(BaseModel):
+    shops: List[int]
+    assignment: List[Optional[int]]
+    products_price: float
+    missing_items: int
+
+    def total_price(self, shop_fee: float) -> float:
+        return self.products_price + shop_fee * len(self.shops)
+
+
+def evaluate_shops(costs: List[List[float]], shops: List[int]) -> BasketPlan:
+    """Buys every item in the cheapest of the given shops, items none of them sells are missing"""
+    assignment: List[Optional[int]] = []
+    products_price = 0
+    missing_items = 0
+    for item_costs in costs:
+        shop = min(shops, key=lambda s: (item_costs[s], s), default=None)
+        if shop is None or math.isinf(item_costs[shop]):
+            assignment.append(None)
+            missing_items += 1
+        else:
+            assignment.append(shop)
+            products_price += item_costs[shop]
+    return BasketPlan(shops=sorted(shops), assignment=assignment, products_price=products_price,
+                      missing_items=missing_items)
+
+
+def plan_key(plan: BasketPlan, shop_fee: float) -> Tuple[int, float]:
+    # a basket with more items is always better than a cheaper one with less
+    return plan.missing_items, plan.total_price(shop_fee)
+
+
+def exact_search(costs: List[List[float]], shop_fee: float, max_shops: int) -> BasketPlan:
+    shops_count = len(costs[0])
+    cost_matrix = np.array(costs, dtype=float)
+    low_count = min(shops_count, max((exact_search_chunk_cells // len(costs)).bit_length() - 1, 1))
+    # best item prices of every subset of the low shops, subset masks are built by adding one shop bit at a time
+    low_prices = np.full((2 ** low_count, len(costs)), np.inf)
+    low_sizes = np.zeros(2 ** low_count, dtype=int)
+    for shop in range(low_count):
+        low, high = 2 ** shop, 2 ** (shop + 1)
+        low_prices[low:high] = np.minimum(low_prices[:low], cost_matrix[:, shop])
+        low_sizes[low:high] = low_sizes[:low] + 1
+
+    # every chunk adds one subset of the high shops to all subsets of the low ones, masks are visited in ascending
+    # order and ties keep the first one, as a single search over all masks would
+    best_key, best_mask = None, 0
+    for high_mask in range(2 ** (shops_count - low_count)):
+        high_shops = [shop for shop in range(low_count, shops_count) if high_mask >> (shop - low_count) & 1]
+        if len(high_shops) > max_shops:
+            continue
+        subset_prices = np.minimum(low_prices, cost_matrix[:, high_shops].min(axis=1)) if high_shops else low_prices
+        subset_sizes = low_sizes + len(high_shops)
+        missing_items = np.isinf(subset_prices).sum(axis=1)
+        totals = np.where(np.isinf(subset_prices), 0, subset_prices).sum(axis=1) + shop_fee * subset_sizes
+        candidates = np.flatnonzero((subset_sizes >= 1) & (subset_sizes <= max_shops))
+        if not len(candidates):
+            continue
+        best_low_mask = candidates[np.lexsort((totals[candidates], missing_items[candidates]))[0]]
+        key = (missing_items[best_low_mask], totals[best_low_mask])
+        if best_key is None or key < best_key:
+            best_key, best_mask = key, high_mask << low_count | int(best_low_mask)
+    return evaluate_shops(costs, [shop for shop in range(shops_count) if best_mask >> shop & 1])
+
+
+def local_search(costs: List[List[float]], shop_fee: float, max_shops: int) -> BasketPlan:
+    """Greedily adds the shop improving the basket most, then adds, drops and swaps shops while it gets better"""
+    shops_count = len(costs[0])
+    shops: List[int] = []
+    plan = evaluate_shops(costs, shops)
+    while len(shops) < max_shops:
+        additions = [evaluate_shops(costs, shops + [shop]) for shop in range(shops_count) if shop not in shops]
+        best_addition = min(additions, key=lambda p: plan_key(p, shop_fee))
+        if shops and plan_key(best_addition, shop_fee) >= plan_key(plan, shop_fee):
+            break
+        plan, shops = best_addition, best_addition.shops
+
+    improved = True
+    while improved:
+        improved = False
+        moves: List[List[int]] = []
+        if len(shops) < max_shops:
+            moves += [shops + [shop] for shop in range(shops_count) if shop not in shops]
+        if len(shops) > 1:
+            moves += [[s for s in shops if s != shop] for shop in shops]
+        moves += [[s for s in shops if s != shop] + [new_shop] for shop in shops for new_shop in range(shops_count)
+                  if new_shop not in shops]
+        for move in moves:
+            move_plan = evaluate_shops(costs, move)
+            if plan_key(move_plan, shop_fee) < plan_key(plan, shop_fee):
+                plan, shops, improved = move_plan, move_plan.shops, True
+                break
+    return plan
+
+
+def optimize_basket(costs: List[List[float]], shop_fee: float = 0, max_shops: Optional[int] = None,
+                    exact: Optional[bool] = None) -> BasketPlan:
+    """
+    Picks shops minimizing the price of the basket plus `shop_fee` per visited shop, with at most `max_shops` shops.
+    `costs[item][shop]` is the cheapest price of an item in a shop, math.inf when the shop does not sell it.
+    Small baskets are searched exhaustively, large ones by local search unless `exact` says otherwise.
+    """
+    if not costs or not costs[0]:
+        return BasketPlan(shops=[], assignment=[None] * len(costs), products_price=0, missing_items=len(costs))
+    shops_count = len(costs[0])
+    max_shops = min(max_shops or shops_count, shops_count)
+    if exact is None:
+        exact = np is not None and 2 ** shops_count * len(costs) <= exact_search_max_cells
+    if exact and np is not None:
+        return exact_search(costs, shop_fee, max_shops)
+    return local_search(costs, shop_fee, max_shops)
@@ -0,0 +1,150 @@
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Optional, Tuple, Deque, List
+
+import click
+from pydantic import BaseModel
+
+from base_entities import UserBuyRequest, BuyListResult
+from catalog_cache import CatalogCache
+from catalog_db import CatalogDatabase
+from constants import STORE_INFO_PATH
+from main import form_user_basket, form_cheques
+from parser import file_open_settings
+from serialization import dumps, parse_raw
+
+
+class BatchSettings(BaseModel):
+    base_path: str
+    catalog_db: str = ""
+    catalog_cache_mb: int = 1024
+    top_k: int = 1
+    optimize_shops: bool = False
+    shop_fee: float = 0
+    max_shops: Optional[int] = None
+    shops: List[str] = []  # shops to preload, all saved ones when empty
+
+
+# catalogs of a batch worker, preloaded by the parent process they are shared with forked workers
+batch_settings: Optional[BatchSettings] = None
+batch_catalog_cache: Optional[CatalogCache] = None
+batch_catalog_database: Optional[CatalogDatabase] = None
+
+
+def load_catalog_cache(settings: BatchSettings) -> CatalogCache:
+    catalog_cache = CatalogCache(settings.base_path, max_bytes=settings.catalog_cache_mb * 1024 * 1024)
+    shop_list = settings.shops or catalog_cache.saved_shops()
+    start = time.perf_counter()
+    for shop in shop_list:
+        catalog_cache.preload(shop)
+    print(f"Preloaded {len(shop_list)} shops in {time.perf_counter() - start:.1f} s, "
+          f"catalog cache {catalog_cache.stats()}", file=sys.stderr)
+    return catalog_cache
+
+
+def init_batch_worker(settings: BatchSettings):
+    """Forked workers inherit the catalogs preloaded by the parent, spawned ones and a serial run load their own"""
+    global batch_settings, batch_catalog_cache, batch_catalog_database
+    batch_settings = settings
+    if batch_catalog_cache is None:
+        batch_catalog_cache = CatalogCache(settings.base_path, max_bytes=settings.catalog_cache_mb * 1024 * 1024) \
+            if settings.catalog_db else load_catalog_cache(settings)
+    # sqlite connections must not be shared with forked processes
+    batch_catalog_database = CatalogDatabase(settings.catalog_db) if settings.catalog_db else None
+
+
+def evaluate_buy_request(indexed_line: Tuple[int, str]) -> str:
+    request_index, line = indexed_line
+    try:
+        user_query: UserBuyRequest = parse_raw(UserBuyRequest, line)
+        user_basket = form_user_basket(user_query, batch_catalog_cache, batch_catalog_database, batch_settings.top_k,
+                                       verbose=False)
+        shop_cheques, multi_cheque = form_cheques(user_query, user_basket, batch_settings.top_k,
+                                                  batch_settings.optimize_shops, batch_settings.shop_fee,
+                                                  batch_settings.max_shops)
+        result = BuyListResult(request_index=request_index, shop_cheques=shop_cheques, multi_cheque=multi_cheque)
+    except Exception as ex:
+        logging.error(f"Failed to evaluate buy request {request_index}", exc_info=ex)
+        result = BuyListResult(request_index=request_index, error=f"{type(ex).__name__}: {ex}")
+    return dumps(result.dict(), indent=False)
+
+
+@click.command()
+@click.option('--input_file_path', default="./user_data/user_buy_requests.jsonl", type=str,
+              help='JSONL file with a user buy request per line, - reads stdin.')
+@click.option('--output_file_path', default="./user_data/cheques.jsonl", type=str,
+              help='JSONL file to stream cheques of every request to, - writes stdout.')
+@click.option('--workers', default=None, type=int, help='processes evaluating requests, all cores by default.')
+@click.option('--shops', default="", type=str, help='shops to preload before starting workers, all saved by default.')
+@click.option('--catalog_cache_mb', default=1024, type=int, help='MB of parsed shop files kept by each worker.')
+@click.option('--catalog_db', default="", type=str, help='path to an SQLite catalog to query instead of shop files.')
+@click.option('--top_k', default=1, type=int, help='cheapest products of each buy preference kept in cheques.')
+@click.option('--optimize_shops', default=False, type=bool,
+              help='pick shops of a multi shop cheque minimizing basket price with shop fees.')
+@click.option('--shop_fee', default=0.0, type=float, help='delivery cost of each visited shop.')
+@click.option('--max_shops', default=None, type=int, help='max number of shops to visit.')
+def form_buy_lists(input_file_path, output_file_path, workers, shops, catalog_cache_mb, catalog_db, top_k,
+                   optimize_shops, shop_fee, max_shops):
+    global batch_catalog_cache
+    settings = BatchSettings(base_path=os.path.join(os.path.dirname(__file__), STORE_INFO_PATH),
+                             catalog_db=catalog_db, catalog_cache_mb=catalog_cache_mb, top_k=top_k,
+                             optimize_shops=optimize_shops, shop_fee=shop_fee, max_shops=max_shops,
+                             shops=[shop.strip() for shop in shops.split(",")] if shops else [])
+    workers = workers or os.cpu_count() or 1
+    # workers are forked on purpose, so the catalogs preloaded once here are shared with all of them copy-on-write.
+    # Unlike the parser's normalization pool, which is started by a forkserver once the crawl runs threads, nothing
+    # but this thread runs yet. Where fork is not available workers are spawned and preload catalogs themselves
+    start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+
+    if not catalog_db and workers > 1 and start_method == "fork":
+        batch_catalog_cache = load_catalog_cache(settings)
+
+    input_file = sys.stdin if input_file_path == "-" else open(input_file_path, 'r', **file_open_settings)
+    output_file = sys.stdout if output_file_path == "-" else open(output_file_path, 'w', **file_open_settings)
+    indexed_lines = ((request_index, line) for request_index, line in enumerate(input_file) if line.strip())
+
+    requests_count = 0
+    start = time.perf_counter()
+
+    def write_result(result: str):
+        nonlocal requests_count
+        output_file.write(result + "\n")
+        requests_count += 1
+        if requests_count % 100 == 0:
+            print(f"Evaluated {requests_count} requests, {requests_count / (time.perf_counter() - start):.1f} "
+                  f"requests/sec", file=sys.stderr)
+
+    try:
+        if workers <= 1:
+            init_batch_worker(settings)
+            for indexed_line in indexed_lines:
+                write_result(evaluate_buy_request(indexed_line))
+        else:
+            # a bounded window of requests in flight keeps results in input order without reading all input
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method),
+                                     initializer=init_batch_worker, initargs=(settings,)) as executor:
+                in_flight: Deque[Future] = deque()
+                for indexed_line in indexed_lines:
+                    in_flight.append(executor.submit(evaluate_buy_request, indexed_line))
+                    if len(in_flight) >= workers * 4:
+                        write_result(in_flight.popleft().result())
+                while in_flight:
+                    write_result(in_flight.popleft().result())
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Evaluated {requests_count} requests in {elapsed:.1f} s, "
+          f"{requests_count / elapsed if elapsed else 0:.1f} requests/sec", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    form_buy_lists()
@@ -0,0 +1,334 @@
+import asyncio
+import glob
+import json
+import math
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from typing import Tuple, List, Dict
+
+import click
+from aiohttp import web
+from pydantic import parse_file_as
+
+from base_entities import ProductInfo, ProductsRequest
+from basket_optimizer import optimize_basket
+from catalog_writer import CatalogWriter, write_times_summary, serialize_products
+from catalog_storage import json_products_file, json_offsets_file, write_msgpack_products, read_msgpack_products, \
+    read_json_products
+from constants import STORE_INFO_PATH
+from helpers import get_products_buy_info, get_products_buy_infos
+from html_tiles import html_parser_backends, parse_listing
+from extensions import async_cmd, get_http_response, HttpClient, HttpClientSettings
+from normalization import normalize_title, parse_weight_info_with_validation, NormalizationStage
+from serialization import serialization_backends, configure, dumps_bytes, loads, orjson
+from stub_server import start_stub_server
+
+user_data_dir = os.path.join(os.path.dirname(__file__), 'user_data')
+data_dir = os.path.join(os.path.dirname(__file__), STORE_INFO_PATH)
+listing_fixtures_dir = os.path.join(os.path.dirname(__file__), '..', 'gets', 'fixtures', 'listing_pages')
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@async_cmd
+@click.option('--requests_count', default=1000, type=int, help='number of requests per run.')
+@click.option('--concurrency', default=10, type=int, help='number of requests in flight.')
+@click.option('--limit_per_host', default=10, type=int, help='pooled client connections per host.')
+async def http_client(requests_count, concurrency, limit_per_host):
+    async def stub_handler(request: web.Request):
+        return web.json_response({"results": [{"title": "Хліб", "price": 1000}], "page": request.query.get("page")})
+
+    runner, base_url = await start_stub_server(stub_handler)
+
+    async def run_requests() -> float:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def request(page: int):
+            async with semaphore:
+                return await get_http_response(f"{base_url}/stores/1/categories/bread/products/",
+                                               params={"page": str(page)})
+
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[request(page) for page in range(requests_count)])
+        elapsed = time.perf_counter() - start
+        failed = len([response for response in responses if not response])
+        if failed:
+            print(f"\t{failed} requests failed")
+        return requests_count / elapsed
+
+    try:
+        per_request_rps = await run_requests()
+        print(f"Per-request sessions: {per_request_rps:.1f} requests/sec")
+        async with HttpClient(HttpClientSettings(limit_per_host=limit_per_host)):
+            pooled_rps = await run_requests()
+        print(f"Pooled client: {pooled_rps:.1f} requests/sec ({pooled_rps / per_request_rps:.2f}x)")
+    finally:
+        await runner.cleanup()
+
+
+def load_fixture_products(pattern: str = 'output_*.json') -> List[ProductInfo]:
+    """Products of the saved form_buy_list outputs, scraped weight info is dropped so it is parsed again"""
+    products: List[ProductInfo] = []
+    for path in sorted(glob.glob(os.path.join(user_data_dir, pattern))):
+        with open(path, 'r', encoding='utf-8') as f:
+            for product_request in json.load(f):
+                for product_buy_info in product_request['product_buy_infos']:
+                    products.append(ProductInfo.parse_obj({**product_buy_info['product'], 'weight_info': None}))
+    return products
+
+
+@cli.command()
+@async_cmd
+@click.option('--repeat', default=5, type=int, help='number of passes over the fixtures.')
+@click.option('--workers', default=None, type=int, help='processes of the normalization stage, all cores by default.')
+@click.option('--chunk_size', default=500, type=int, help='products normalized by a process at once.')
+async def normalization(repeat, workers, chunk_size):
+    products = load_fixture_products()
+    print(f"Loaded {len(products)} products from {user_data_dir}")
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for product in products:
+            normalize_title(product_title=product.title, product_brand=product.producer.trademark)
+    elapsed = time.perf_counter() - start
+    print(f"normalize_title: {len(products) * repeat / elapsed:.0f} products/sec")
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for product in products:
+            parse_weight_info_with_validation(product)
+    elapsed = time.perf_counter() - start
+    print(f"parse_weight_info_with_validation: {len(products) * repeat / elapsed:.0f} products/sec")
+
+    for stage in [NormalizationStage(workers=1), NormalizationStage(workers=workers, chunk_size=chunk_size)]:
+        with stage:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                await stage.normalize(products)
+            elapsed = time.perf_counter() - start
+        print(f"NormalizationStage, {stage.workers} workers: {len(products) * repeat / elapsed:.0f} products/sec")
+
+
+@cli.command()
+@click.option('--shop', default="novus", type=str, help='shop whose saved categories are loaded.')
+@click.option('--location', default="default", type=str, help='location of the shop.')
+def catalog_format(shop, location):
+    json_paths = sorted(glob.glob(os.path.join(data_dir, shop, location, '*', json_products_file)))
+    if not json_paths:
+        print(f"No saved categories of {shop} {location} in {data_dir}, run parser.py parse-shop-products first")
+        return
+
+    with tempfile.TemporaryDirectory() as msgpack_dir:
+        msgpack_paths = []
+        for i, json_path in enumerate(json_paths):
+            msgpack_path = os.path.join(msgpack_dir, f"{i}.msgpack")
+            write_msgpack_products(msgpack_path, parse_file_as(Dict[str, ProductInfo], json_path))
+            msgpack_paths.append(msgpack_path)
+
+        start = time.perf_counter()
+        json_products_count = sum(len(parse_file_as(Dict[str, ProductInfo], path)) for path in json_paths)
+        json_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        msgpack_products_count = sum(len(read_msgpack_products(path)) for path in msgpack_paths)
+        msgpack_elapsed = time.perf_counter() - start
+
+        json_size = sum(os.path.getsize(path) for path in json_paths)
+        msgpack_size = sum(os.path.getsize(path) for path in msgpack_paths)
+
+    print(f"{len(json_paths)} categories of {shop} {location}, {json_products_count} products")
+    print(f"JSON: {json_size / 1024 / 1024:.2f} MB, loaded in {json_elapsed:.2f} s")
+    print(f"msgpack: {msgpack_size / 1024 / 1024:.2f} MB ({json_size / msgpack_size:.1f}x smaller), "
+          f"loaded in {msgpack_elapsed:.2f} s ({json_elapsed / msgpack_elapsed:.1f}x faster)")
+    if json_products_count != msgpack_products_count:
+        print(f"\tmsgpack products count differs: {msgpack_products_count}")
+
+
+@cli.command()
+@click.option('--shop', default="novus", type=str, help='shop whose saved categories are scanned.')
+@click.option('--location', default="default", type=str, help='location of the shop.')
+@click.option('--title_filter', default="молоко", type=str, help='title filter the categories are scanned with.')
+def lazy_products(shop, location, title_filter):
+    json_paths = [path for path in sorted(glob.glob(os.path.join(data_dir, shop, location, '*', json_products_file)))
+                  if os.path.isfile(os.path.join(os.path.dirname(path), json_offsets_file))]
+    if not json_paths:
+        print(f"No categories of {shop} {location} with saved offsets in {data_dir}, run parser.py "
+              f"parse-shop-products first")
+        return
+
+    def scan(load) -> Tuple[int, float, int]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        categories, matches_count = [], 0
+        for path in json_paths:
+            products = load(path)
+            categories.append(products)
+            matches_count += len([products[key] for key in products if title_filter + " " in key.lower()])
+        elapsed = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return matches_count, elapsed, memory
+
+    eager_count, eager_elapsed, eager_memory = scan(lambda path: parse_file_as(Dict[str, ProductInfo], path))
+    lazy_count, lazy_elapsed, lazy_memory = scan(lambda path: read_json_products(
+        path, os.path.join(os.path.dirname(path), json_offsets_file)))
+    print(f"{len(json_paths)} categories of {shop} {location}, {eager_count} products match '{title_filter}'")
+    print(f"validated: {eager_elapsed:.2f} s, {eager_memory / 1024 / 1024:.1f} MB kept")
+    print(f"lazy: {lazy_elapsed:.2f} s ({eager_elapsed / lazy_elapsed:.1f}x faster), "
+          f"{lazy_memory / 1024 / 1024:.1f} MB kept ({eager_memory / lazy_memory:.1f}x less)")
+    if eager_count != lazy_count:
+        print(f"\tlazy matches count differs: {lazy_count}")
+
+
+@cli.command()
+@async_cmd
+@click.option('--shop', default="novus", type=str, help='shop whose saved raw products are written.')
+@click.option('--location', default="default", type=str, help='location of the shop.')
+@click.option('--workers', default=4, type=int, help='threads of the pooled writer.')
+@click.option('--catalog_format', default="json", type=str, help='format of normalized products of categories.')
+async def catalog_writer(shop, location, workers, catalog_format):
+    raw_products_path = os.path.join(data_dir, shop, location, 'raw_products_info.json')
+    if not os.path.isfile(raw_products_path):
+        print(f"No saved products of {shop} {location} in {data_dir}, run parser.py parse-shop-products first")
+        return
+    category_products = parse_file_as(Dict[str, List[ProductInfo]], raw_products_path)
+    products_count = sum(len(products) for products in category_products.values())
+    print(f"{len(category_products)} categories of {shop} {location}, {products_count} products")
+
+    for writer_workers in [1, workers]:
+        with tempfile.TemporaryDirectory() as shop_dir, \
+                CatalogWriter(writer_workers) as writer:
+            start = time.perf_counter()
+            write_times = await asyncio.gather(*[
+                writer.write_category(shop_dir, "", category_id, products, serialize_products(products),
+                                      catalog_format) for category_id, products in category_products.items()])
+            elapsed = time.perf_counter() - start
+        print(f"{writer_workers} writer threads: {elapsed:.2f} s, {len(category_products) / elapsed:.0f} "
+              f"categories/sec, {write_times_summary(write_times)}")
+
+
+@cli.command()
+@click.option('--repeat', default=5, type=int, help='number of passes over the fixtures.')
+def serialization(repeat):
+    values = []
+    for path in sorted(glob.glob(os.path.join(user_data_dir, 'output_*.json'))):
+        with open(path, encoding='utf-8') as f:
+            values.append(json.load(f))
+    print(f"Loaded {len(values)} fixture files from {user_data_dir}")
+
+    for backend in serialization_backends:
+        if backend == "orjson" and orjson is None:
+            print("orjson is not installed")
+            continue
+        for indent in [True, False]:
+            configure(backend, indent)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                dumped = [dumps_bytes(value) for value in values]
+            dump_elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for data in dumped:
+                    loads(data)
+            load_elapsed = time.perf_counter() - start
+            size = sum(len(data) for data in dumped)
+            print(f"{backend} {'indented' if indent else 'compact'}: {size / 1024 / 1024:.1f} MB, "
+                  f"dumps {size * repeat / dump_elapsed / 1024 / 1024:.0f} MB/sec, "
+                  f"loads {size * repeat / load_elapsed / 1024 / 1024:.0f} MB/sec")
+
+
+@cli.command()
+@click.option('--repeat', default=5, type=int, help='number of passes over the fixtures.')
+@click.option('--top_k', default=None, type=int, help='return only the cheapest products of each request.')
+def pricing(repeat, top_k):
+    product_requests: List[ProductsRequest] = []
+    for path in sorted(glob.glob(os.path.join(user_data_dir, 'output_*.json'))):
+        product_requests.extend(parse_file_as(List[ProductsRequest], path))
+    candidates = [([product_buy_info.product for product_buy_info in product_request.product_buy_infos],
+                   product_request.request.weight_filter) for product_request in product_requests]
+    products_count = sum(len(products) for products, _ in candidates)
+    print(f"Loaded {len(candidates)} buy requests, {products_count} products from {user_data_dir}")
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        scalar_results = []
+        for products, weight_filter in candidates:
+            product_buy_infos = list(map(lambda product_info: get_products_buy_info(product_info, weight_filter), products))
+            if top_k is not None:
+                product_buy_infos = sorted(product_buy_infos, key=lambda x: x.end_price)[:top_k]
+            scalar_results.append(product_buy_infos)
+    scalar_elapsed = time.perf_counter() - start
+    print(f"get_products_buy_info: {products_count * repeat / scalar_elapsed:.0f} products/sec")
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        batch_results = [get_products_buy_infos(products, weight_filter, top_k) for products, weight_filter in candidates]
+    batch_elapsed = time.perf_counter() - start
+    print(f"get_products_buy_infos: {products_count * repeat / batch_elapsed:.0f} products/sec "
+          f"({scalar_elapsed / batch_elapsed:.1f}x)")
+
+    mismatches = sum(1 for scalar, batch in zip(scalar_results, batch_results)
+                     if [(x.end_price, x.quantity) for x in scalar] != [(x.end_price, x.quantity) for x in batch])
+    print(f"Requests with different results: {mismatches}")
+
+
+@cli.command()
+@click.option('--items', default=50, type=int, help='number of buy preferences in the basket.')
+@click.option('--shops', default=14, type=int, help='number of shops.')
+@click.option('--shop_fee', default=50.0, type=float, help='delivery cost of each visited shop.')
+@click.option('--max_shops', default=None, type=int, help='max number of shops to visit.')
+@click.option('--missing_rate', default=0.2, type=float, help='share of items a shop does not sell.')
+@click.option('--seed', default=0, type=int, help='seed of generated prices.')
+def basket(items, shops, shop_fee, max_shops, missing_rate, seed):
+    generator = random.Random(seed)
+    costs = [[math.inf if generator.random() < missing_rate else round(generator.uniform(10, 500), 2)
+              for _ in range(shops)] for _ in range(items)]
+
+    for name, exact in [("exact search", True), ("local search", False)]:
+        if exact and 2 ** shops * items > 2 ** 26:
+            print(f"{name}: skipped, too many shops")
+            continue
+        start = time.perf_counter()
+        plan = optimize_basket(costs, shop_fee, max_shops, exact=exact)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed * 1000:.1f} ms, shops {plan.shops}, total {plan.total_price(shop_fee):.2f}, "
+              f"missing items {plan.missing_items}")
+
+
+@cli.command()
+@click.option('--pages_dir', default=listing_fixtures_dir, type=str,
+              help='listing pages, saved zakaz.ua listing fixtures by default or pages saved by the gets/ crawlers '
+                   'with GETS_PAGES_DIR set.')
+@click.option('--repeat', default=3, type=int, help='number of passes over the pages.')
+def html_tiles(pages_dir, repeat):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(pages_dir, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            pages.append(f.read())
+    if not pages:
+        print(f"No saved pages in {pages_dir}, run a gets/ crawler with GETS_PAGES_DIR={pages_dir} first")
+        return
+    print(f"Loaded {len(pages)} pages, {sum(len(page) for page in pages) / 1024 / 1024:.1f} MB from {pages_dir}")
+
+    listings = {}
+    for backend in html_parser_backends:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            listings[backend] = [parse_listing(page, backend) for page in pages]
+        elapsed = time.perf_counter() - start
+        tiles_count = sum(len(listing.tiles) for listing in listings[backend]) * repeat
+        print(f"{backend}: {tiles_count / elapsed:.0f} tiles/sec, {len(pages) * repeat / elapsed:.0f} pages/sec")
+    if len(listings) > 1:
+        reference, *others = listings.values()
+        print("All backends parse the same tiles" if all(listing == reference for listing in others)
+              else "Backends parse different tiles")
+
+
+if __name__ == '__main__':
+    cli()
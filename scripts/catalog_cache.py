@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Callable, Tuple, Mapping
+
+from base_entities import ProductInfo, CategoryInfo
+from catalog_storage import products_file_path, products_offsets_path, load_products_file
+from serialization import parse_file
+from title_index import TitleIndex, load_title_index
+
+
+class CatalogCache():
+    """
+    LRU cache of parsed shop files shared by all buy preferences of a run: navigators with their title index
+    and normalized products of categories. The size of an entry is the size of its files on disk, entries are
+    evicted once the cached files exceed `max_bytes`. With `check_mtime` an entry is reloaded when its files
+    changed since they were parsed, otherwise files are expected not to change while they are cached.
+    The cache may be shared by threads, files are loaded outside of its lock.
+    """
+
+    def __init__(self, base_path: str, max_bytes: int = 256 * 1024 * 1024, max_results: int = 4096,
+                 check_mtime: bool = False):
+        self.base_path = base_path
+        self.max_bytes = max_bytes
+        self.max_results = max_results
+        self.check_mtime = check_mtime
+        self.entries: "OrderedDict[Tuple[str, ...], Tuple[Any, int, Tuple]]" = OrderedDict()
+        # results computed from shop files, valid as long as the files are, so they are kept for the whole run
+        self.results: "OrderedDict[Tuple[Any, ...], Any]" = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _file_stamps(paths: List[str]) -> Tuple:
+        stamps = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                stamps.append((path, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stamps.append((path, None, 0))
+        return tuple(stamps)
+
+    def _get(self, key: Tuple[str, ...], paths: Callable[[], List[str]], load: Callable[[], Any]):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                if not self.check_mtime or self._file_stamps(paths()) == entry[2]:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return entry[0]
+                logging.debug(f"Files of {key} changed, reloading them")
+            self.misses += 1
+
+        stamps = self._file_stamps(paths())
+        value = load()
+        size = sum(stamp[2] for stamp in stamps)
+        with self.lock:
+            # the entry is outdated or another thread loaded it meanwhile
+            if key in self.entries:
+                _, outdated_size, _ = self.entries.pop(key)
+                self.cached_bytes -= outdated_size
+            self.entries[key] = (value, size, stamps)
+            self.cached_bytes += size
+            while self.cached_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.cached_bytes -= evicted_size
+                self.evictions += 1
+        return value
+
+    def memo(self, key: Tuple[Any, ...], compute: Callable[[], Any]):
+        """Last `max_results` results computed from shop files, with `check_mtime` results are not kept"""
+        if self.check_mtime:
+            return compute()
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key]
+        value = compute()
+        with self.lock:
+            self.results[key] = value
+            if len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+        return value
+
+    def shop_dir(self, shop: str, location: str = "default") -> str:
+        return os.path.join(self.base_path, shop, location)
+
+    def navigator_path(self, shop: str, location: str = "default", prefix: str = "") -> str:
+        return os.path.join(self.shop_dir(shop, location), f'{prefix}products_categories.json')
+
+    def saved_shops(self) -> List[str]:
+        """Shops which have a navigator saved by parse_shop_products"""
+        if not os.path.isdir(self.base_path):
+            return []
+        return [shop for shop in sorted(os.listdir(self.base_path)) if os.path.isfile(self.navigator_path(shop))]
+
+    def navigator(self, shop: str, location: str = "default",
+                  prefix: str = "") -> Tuple[Dict[str, List[str]], TitleIndex]:
+        navigator_path = self.navigator_path(shop, location, prefix)
+        title_index_path = os.path.join(self.shop_dir(shop, location), f'{prefix}title_index.json')
+        return self._get(('navigator', shop, location, prefix), lambda: [navigator_path, title_index_path],
+                         lambda: (parse_file(Dict[str, List[str]], navigator_path),
+                                  load_title_index(title_index_path, navigator_path)))
+
+    def category_products(self, shop: str, category_id: str, location: str = "default",
+                          prefix: str = "") -> Mapping[str, ProductInfo]:
+        def path_to_category():
+            return os.path.join(self.shop_dir(shop, location), category_id)
+
+        return self._get(('category', shop, category_id, location, prefix),
+                         lambda: [products_file_path(path_to_category(), prefix),
+                                  products_offsets_path(path_to_category(), prefix)],
+                         lambda: load_products_file(path_to_category(), prefix))
+
+    def categories(self, shop: str, location: str = "default", prefix: str = "") -> List[CategoryInfo]:
+        """Categories saved by parse_categories, empty when they were not scraped"""
+        categories_path = os.path.join(self.shop_dir(shop, location), f'{prefix}raw_categories_info.json')
+        return self._get(('categories', shop, location, prefix), lambda: [categories_path],
+                         lambda: parse_file(List[CategoryInfo], categories_path)
+                         if os.path.isfile(categories_path) else [])
+
+    def category_ids(self, shop: str, location: str = "default", prefix: str = "") -> List[str]:
+        """Categories with saved products in the order of the navigator"""
+        if not os.path.isfile(self.navigator_path(shop, location, prefix)):
+            return []
+        file_navigation, _ = self.navigator(shop, location, prefix)
+        return list(dict.fromkeys(category_id for category_ids in file_navigation.values()
+                                  for category_id in category_ids))
+
+    def preload(self, shop: str):
+        """Parses the navigator and all categories of a shop, the cache has to fit them to keep them"""
+        for category_id in self.category_ids(shop):
+            self.category_products(shop, category_id)
+
+    def find_products(self, shop: str, title_filter: str) -> List[ProductInfo]:
+        """Products whose normalized title contains `title_filter` followed by a space, by category of the navigator"""
+        products: List[ProductInfo] = []
+        examined_categories = set()
+        file_navigation, title_index = self.navigator(shop)
+        for product_key in title_index.match(title_filter):
+            for category_id in file_navigation[product_key]:
+                if category_id not in examined_categories:
+                    logging.debug(f"Scanning products of category {category_id}")
+                    examined_categories.add(category_id)
+                    # products of lazily read files are decoded only when their title matches
+                    category_products = self.category_products(shop, category_id)
+                    for title_key in category_products:
+                        if title_filter + " " in title_key.lower():
+                            products.append(category_products[title_key])
+        return products
+
+    def stats(self) -> str:
+        requests_count = self.hits + self.misses
+        hit_rate = self.hits / requests_count * 100 if requests_count else 0
+        return f"hits: {self.hits}, misses: {self.misses} ({hit_rate:.1f}% hit rate), evictions: {self.evictions}, " \
+               f"cached: {len(self.entries)} entries, {self.cached_bytes / 1024 / 1024:.1f} MB"
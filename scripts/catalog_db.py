@@ -0,0 +1,185 @@
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import List, Dict, Optional, Tuple, Any
+
+from base_entities import ProductInfo
+from catalog_storage import construct_product
+from serialization import dumps, loads
+from helpers import normalize_weight_info
+
+schema = """
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY,
+    shop TEXT NOT NULL,
+    location TEXT NOT NULL,
+    promotion INTEGER NOT NULL,
+    category_id TEXT NOT NULL,
+    UNIQUE (shop, location, promotion, category_id)
+);
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    category_row INTEGER NOT NULL REFERENCES categories(id),
+    shop TEXT NOT NULL,
+    location TEXT NOT NULL,
+    promotion INTEGER NOT NULL,
+    category_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    normalized_title TEXT NOT NULL,
+    title TEXT,
+    brand TEXT,
+    price REAL,
+    weight_value REAL,
+    weight_unit TEXT,
+    unit_price REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_shop_category ON products (shop, location, promotion, category_id);
+CREATE INDEX IF NOT EXISTS products_category_row ON products (category_row);
+CREATE INDEX IF NOT EXISTS products_brand ON products (brand);
+CREATE INDEX IF NOT EXISTS products_unit_price ON products (unit_price);
+CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5 (
+    normalized_title, content='products', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+    INSERT INTO products_fts (rowid, normalized_title) VALUES (new.id, new.normalized_title);
+END;
+CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+    INSERT INTO products_fts (products_fts, rowid, normalized_title) VALUES ('delete', old.id, old.normalized_title);
+END;
+"""
+
+# the trigram tokenizer matches substrings of at least 3 characters
+min_fts_pattern_length = 3
+
+
+def get_unit_price(product: ProductInfo) -> Optional[float]:
+    """Price per gram, millilitre, metre or piece"""
+    if not product.price or not product.weight_info:
+        return None
+    weight_value = normalize_weight_info(product.weight_info).value * (product.bundle or 1)
+    return product.price / weight_value if weight_value else None
+
+
+class CatalogDatabase():
+    """
+    Single-file SQLite store of normalized products of all shops. A category is replaced as a whole in one
+    transaction, categories keep the order they were saved in, so lookups return products in the same order as
+    scanning products_categories.json and category files does.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _delete_category(self, category_row: int):
+        self.connection.execute("DELETE FROM products WHERE category_row = ?", (category_row,))
+        self.connection.execute("DELETE FROM categories WHERE id = ?", (category_row,))
+
+    def write_category(self, shop: str, location: str, promotion: bool, category_id: str,
+                       products: Dict[str, ProductInfo], product_dicts: Optional[Dict[str, Dict[str, Any]]] = None):
+        """
+        Replaces products of a category, `products` are keyed by normalized title as in normalized_products.json,
+        `product_dicts` are dict() of the products when they are already serialized.
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT id FROM categories WHERE shop = ? AND location = ? AND promotion = ? AND category_id = ?",
+                (shop, location, int(promotion), category_id)).fetchone()
+            if row:
+                self._delete_category(row[0])
+            category_row = self.connection.execute(
+                "INSERT INTO categories (shop, location, promotion, category_id) VALUES (?, ?, ?, ?)",
+                (shop, location, int(promotion), category_id)).lastrowid
+            self.connection.executemany(
+                "INSERT INTO products (category_row, shop, location, promotion, category_id, position, "
+                "normalized_title, title, brand, price, weight_value, weight_unit, unit_price, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(category_row, shop, location, int(promotion), category_id, position, normalized_title,
+                  product.title, product.producer.trademark, product.price,
+                  product.weight_info.value if product.weight_info else None,
+                  product.weight_info.unit if product.weight_info else None, get_unit_price(product),
+                  dumps(product_dicts[normalized_title] if product_dicts is not None else product.dict(), indent=False))
+                 for position, (normalized_title, product) in enumerate(products.items())])
+
+    def remove_categories_except(self, shop: str, location: str, promotion: bool, category_ids: List[str]):
+        """Drops categories which were not saved by the latest full crawl of a shop location"""
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                "SELECT id, category_id FROM categories WHERE shop = ? AND location = ? AND promotion = ?",
+                (shop, location, int(promotion))).fetchall()
+            for category_row, category_id in rows:
+                if category_id not in category_ids:
+                    self._delete_category(category_row)
+
+    def _match_rows(self, title_filter: str, conditions: str, params: Tuple, order: str,
+                    limit: int = -1) -> List[Tuple]:
+        pattern = title_filter + " "
+        columns = "p.category_row, p.position, p.normalized_title, p.shop, p.data"
+        # the trigram index folds case, the file scan does not, so titles are also matched by the case-sensitive
+        # instr before the rows are limited
+        if len(pattern) >= min_fts_pattern_length:
+            query = f"SELECT {columns} FROM products_fts JOIN products p ON p.id = products_fts.rowid " \
+                    f"WHERE products_fts MATCH ? AND instr(p.normalized_title, ?) > 0 AND {conditions} " \
+                    f"ORDER BY {order} LIMIT ?"
+            params = ('"' + pattern.replace('"', '""') + '"', pattern, *params, limit)
+        else:
+            query = f"SELECT {columns} FROM products p WHERE instr(p.normalized_title, ?) > 0 AND {conditions} " \
+                    f"ORDER BY {order} LIMIT ?"
+            params = (pattern, *params, limit)
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def find_products(self, shop: str, title_filter: str, location: str = "default",
+                      promotion: bool = False) -> List[ProductInfo]:
+        """Products of a shop whose normalized title contains `title_filter` followed by a space"""
+        rows = self._match_rows(title_filter, "p.shop = ? AND p.location = ? AND p.promotion = ?",
+                                (shop, location, int(promotion)), "p.category_row, p.position")
+
+        # categories are examined in the order of products_categories.json: titles by the first category they
+        # were saved in, categories of a title by the order they were saved in, rows are sorted the same way
+        title_categories: Dict[str, List[int]] = defaultdict(list)
+        category_rows: Dict[int, List[Tuple]] = defaultdict(list)
+        for row in rows:
+            title_categories[row[2]].append(row[0])
+            category_rows[row[0]].append(row)
+        examined_categories: Dict[int, None] = {}
+        for category_row_list in title_categories.values():
+            for category_row in category_row_list:
+                examined_categories.setdefault(category_row)
+
+        return [construct_product(loads(row[4])) for category_row in examined_categories
+                for row in category_rows[category_row]]
+
+    def find_cheapest(self, title_filter: str, shops: Optional[List[str]] = None, location: str = "default",
+                      limit: int = 10) -> List[Tuple[str, ProductInfo]]:
+        """Cross-shop lookup of matching products with the lowest unit price, products of equal price in file order"""
+        conditions = "p.location = ? AND p.promotion = 0 AND p.unit_price IS NOT NULL"
+        params: Tuple[Any, ...] = (location,)
+        if shops:
+            conditions += f" AND p.shop IN ({', '.join('?' * len(shops))})"
+            params += tuple(shops)
+        rows = self._match_rows(title_filter, conditions, params, "p.unit_price, p.shop, p.category_row, p.position",
+                                limit)
+        return [(row[3], construct_product(loads(row[4]))) for row in rows]
+
+    def get_category_products(self, shop: str, location: str, category_id: str,
+                              promotion: bool = False) -> List[ProductInfo]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT data FROM products WHERE shop = ? AND location = ? AND promotion = ? AND category_id = ? "
+                "ORDER BY position", (shop, location, int(promotion), category_id)).fetchall()
+        return [construct_product(loads(row[0])) for row in rows]
@@ -0,0 +1,202 @@
+import mmap
+import os
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Iterator, Mapping, Union
+
+from base_entities import ProductInfo, ProducerInfo, SizeInfo, PromoInfo
+from serialization import json_serial, dumps_object_entry, dumps_object_end, dump, loads, load_file, parse_file
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+catalog_formats = ["json", "msgpack", "all"]
+json_products_file = "normalized_products.json"
+msgpack_products_file = "normalized_products.msgpack"
+# byte ranges of products in the json file, lets readers decode only the products they need
+json_offsets_file = "normalized_products_offsets.json"
+
+product_columns = ["normalized_title", "title", "category_id", "price", "unit", "weight", "bundle", "volume",
+                   "description", "slug", "web_url"]
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = 'w', **open_settings):
+    """Opens a temporary file which replaces `path` once it is completely written, a failed write keeps the old file"""
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, mode, **open_settings) as f:
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def products_to_columns(products: Dict[str, ProductInfo]) -> Dict[str, List[Any]]:
+    columns: Dict[str, List[Any]] = {column: [] for column in product_columns}
+    columns.update({"weight_value": [], "weight_unit": [], "weight_type": [], "trademark": [], "trademark_slug": [],
+                    "promotion": []})
+    for product in products.values():
+        for column in product_columns:
+            columns[column].append(getattr(product, column))
+        columns["weight_value"].append(product.weight_info.value if product.weight_info else None)
+        columns["weight_unit"].append(product.weight_info.unit if product.weight_info else None)
+        columns["weight_type"].append(product.weight_info.type if product.weight_info else None)
+        columns["trademark"].append(product.producer.trademark)
+        columns["trademark_slug"].append(product.producer.trademark_slug)
+        columns["promotion"].append(product.promotion.dict() if product.promotion else None)
+    return columns
+
+
+def construct_product(fields: Dict[str, Any]) -> ProductInfo:
+    """Builds the model of an already validated product from its dict() without pydantic validation"""
+    weight_info = SizeInfo.construct(**fields["weight_info"]) if fields.get("weight_info") else None
+    promotion: Optional[PromoInfo] = None
+    if fields.get("promotion"):
+        promotion_fields = fields["promotion"]
+        for date_field in ["start_date", "stop_date"]:
+            if isinstance(promotion_fields.get(date_field), str):
+                promotion_fields[date_field] = datetime.fromisoformat(promotion_fields[date_field])
+        promotion = PromoInfo.construct(**promotion_fields)
+    return ProductInfo.construct(**{column: fields.get(column) for column in product_columns},
+                                 weight_info=weight_info, producer=ProducerInfo.construct(**fields["producer"]),
+                                 promotion=promotion)
+
+
+def columns_to_products(columns: Dict[str, List[Any]]) -> Dict[str, ProductInfo]:
+    products: Dict[str, ProductInfo] = {}
+    for i, normalized_title in enumerate(columns["normalized_title"]):
+        weight_info = None
+        if columns["weight_unit"][i] is not None:
+            weight_info = {"value": columns["weight_value"][i], "unit": columns["weight_unit"][i],
+                           "type": columns["weight_type"][i]}
+        products[normalized_title] = construct_product({
+            **{column: columns[column][i] for column in product_columns},
+            "weight_info": weight_info,
+            "producer": {"trademark": columns["trademark"][i], "trademark_slug": columns["trademark_slug"][i]},
+            "promotion": columns["promotion"][i]})
+    return products
+
+
+def write_msgpack_products(path: str, products: Dict[str, ProductInfo]):
+    if msgpack is None:
+        raise RuntimeError("msgpack is not installed, install it to use the msgpack catalog format")
+    with atomic_write(path, 'wb') as f:
+        f.write(msgpack.packb(products_to_columns(products), default=json_serial))
+
+
+def read_msgpack_products(path: str) -> Dict[str, ProductInfo]:
+    with open(path, 'rb') as f:
+        return columns_to_products(msgpack.unpackb(f.read()))
+
+
+class LazyProducts(Mapping):
+    """
+    Products of a json category file decoded one by one on first access. Titles are available without decoding
+    anything, so products can be filtered by title before they are built. `data` is the file mapped to memory, only
+    pages of decoded products are read from disk.
+    """
+
+    def __init__(self, data: Union[bytes, mmap.mmap], keys: List[str], offsets: List[int]):
+        self.data = data
+        self.positions = {key: i for i, key in enumerate(keys)}
+        self.offsets = offsets
+        self.decoded: Dict[str, ProductInfo] = {}
+
+    def __getitem__(self, key: str) -> ProductInfo:
+        product = self.decoded.get(key)
+        if product is None:
+            i = self.positions[key]
+            product = self.decoded[key] = construct_product(
+                loads(self.data[self.offsets[2 * i]:self.offsets[2 * i + 1]]))
+        return product
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.positions)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+
+def write_json_products(path: str, offsets_path: str, products: Dict[str, ProductInfo],
+                        product_dicts: Optional[Dict[str, Dict[str, Any]]] = None):
+    """
+    Writes products the same way dumps of the whole dict does and saves byte ranges of every product next to them.
+    `product_dicts` are dict() of the products when they are already serialized.
+    """
+    keys: List[str] = []
+    offsets: List[int] = []
+    with atomic_write(path, 'wb') as f:
+        position = 0
+        for i, (key, product) in enumerate(products.items()):
+            key_text, value_text = dumps_object_entry(key, product_dicts[key] if product_dicts is not None
+                                                      else product.dict(), i)
+            value = value_text.encode()
+            position += f.write(key_text.encode())
+            keys.append(key)
+            offsets += [position, position + len(value)]
+            position += f.write(value)
+        f.write(dumps_object_end(len(products)).encode())
+
+    stat = os.stat(path)
+    with atomic_write(offsets_path, 'wb') as f:
+        dump({"file_size": stat.st_size, "file_mtime_ns": stat.st_mtime_ns, "keys": keys, "offsets": offsets}, f,
+             indent=False)
+
+
+def read_json_products(path: str, offsets_path: str) -> Mapping[str, ProductInfo]:
+    """Lazily decoded products when the offsets are saved for the current file, otherwise all of them validated"""
+    if os.path.isfile(offsets_path):
+        index = load_file(offsets_path)
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if index["file_size"] == stat.st_size and index["file_mtime_ns"] == stat.st_mtime_ns:
+                # a mapping outlives the closed file and the file replaced by atomic_write on posix, windows does not
+                # replace mapped files, so there the file is read instead
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.name != "nt" and stat.st_size \
+                    else f.read()
+                return LazyProducts(data, index["keys"], index["offsets"])
+    return parse_file(Dict[str, ProductInfo], path)
+
+
+def save_products_file(path_to_category: str, output_file_prefix: str, products: Dict[str, ProductInfo],
+                       catalog_format: str = "json", product_dicts: Optional[Dict[str, Dict[str, Any]]] = None):
+    """Writes normalized products of a category in the given formats and removes files of the other format"""
+    json_path = os.path.join(path_to_category, f'{output_file_prefix}{json_products_file}')
+    offsets_path = os.path.join(path_to_category, f'{output_file_prefix}{json_offsets_file}')
+    msgpack_path = os.path.join(path_to_category, f'{output_file_prefix}{msgpack_products_file}')
+
+    if catalog_format in ["json", "all"]:
+        write_json_products(json_path, offsets_path, products, product_dicts)
+    else:
+        for path in [json_path, offsets_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    if catalog_format in ["msgpack", "all"]:
+        write_msgpack_products(msgpack_path, products)
+    elif os.path.isfile(msgpack_path):
+        os.remove(msgpack_path)
+
+
+def products_file_path(path_to_category: str, output_file_prefix: str = "") -> str:
+    """Normalized products file of a category, the msgpack one is preferred when msgpack is installed"""
+    msgpack_path = os.path.join(path_to_category, f'{output_file_prefix}{msgpack_products_file}')
+    if msgpack is not None and os.path.isfile(msgpack_path):
+        return msgpack_path
+    return os.path.join(path_to_category, f'{output_file_prefix}{json_products_file}')
+
+
+def products_offsets_path(path_to_category: str, output_file_prefix: str = "") -> str:
+    return os.path.join(path_to_category, f'{output_file_prefix}{json_offsets_file}')
+
+
+def load_products_file(path_to_category: str, output_file_prefix: str = "") -> Mapping[str, ProductInfo]:
+    path = products_file_path(path_to_category, output_file_prefix)
+    if path.endswith(msgpack_products_file):
+        return read_msgpack_products(path)
+    return read_json_products(path, products_offsets_path(path_to_category, output_file_prefix))
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Set, Any, Optional
+
+from base_entities import ProductInfo
+from catalog_storage import save_products_file, atomic_write
+from serialization import dump
+
+
+def serialize_products(products: List[ProductInfo]) -> List[Dict[str, Any]]:
+    return [product.dict() for product in products]
+
+
+def write_category_files(shop_dir: str, output_file_prefix: str, category_id: str, products: List[ProductInfo],
+                         product_dicts: List[Dict[str, Any]], catalog_format: str = "json") -> float:
+    """Writes normalized products of a category with the views derived from them, returns the time it took"""
+    start = time.perf_counter()
+    path_to_category = os.path.join(shop_dir, category_id)
+    os.makedirs(path_to_category, exist_ok=True)
+
+    products_by_title = {product.normalized_title: product for product in products}
+    dicts_by_title = {product.normalized_title: product_dict for product, product_dict in zip(products, product_dicts)}
+    save_products_file(path_to_category, output_file_prefix, products_by_title, catalog_format, dicts_by_title)
+
+    brand_products: Dict[str, Set[str]] = defaultdict(set)
+    product_brands: Dict[str, Set[str]] = defaultdict(set)
+    for product in products:
+        # normalize
+        if product.producer.trademark:
+            brand_products[product.producer.trademark].add(product.normalized_title)
+            product_brands[product.normalized_title].add(product.producer.trademark)
+
+    views = {
+        'normalized_products_list.json': sorted([product.normalized_title for product in products]),
+        'products_list.json': sorted([product.title for product in products]),
+        'brand_list.json': list(set([product.producer.trademark for product in products if
+                                     product.producer.trademark])),
+        'brand_products.json': {k: list(v) for k, v in brand_products.items()},
+        'product_brands.json': {k: list(v) for k, v in product_brands.items()},
+    }
+    for file_name, view in views.items():
+        with atomic_write(os.path.join(path_to_category, f'{output_file_prefix}{file_name}'), 'wb') as f:
+            dump(view, f)
+    return time.perf_counter() - start
+
+
+def write_times_summary(write_times: List[float]) -> str:
+    if not write_times:
+        return "no categories written"
+    return f"{len(write_times)} categories written in {sum(write_times):.2f} s, " \
+           f"{sum(write_times) / len(write_times) * 1000:.1f} ms per category on average, " \
+           f"slowest {max(write_times) * 1000:.1f} ms"
+
+
+class CatalogWriter():
+    """
+    Writes files of categories on a thread pool, off the event loop. Products of a category are serialized once for
+    all files derived from them, every file replaces the previous one atomically, so an interrupted crawl never
+    leaves truncated files behind.
+    """
+
+    def __init__(self, workers: int = 4):
+        self.workers = max(workers, 1)
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def open(self):
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="catalog_writer")
+        return self
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def write_category(self, shop_dir: str, output_file_prefix: str, category_id: str,
+                             products: List[ProductInfo], product_dicts: List[Dict[str, Any]],
+                             catalog_format: str = "json") -> float:
+        loop = asyncio.get_running_loop()
+        elapsed = await loop.run_in_executor(
+            self.executor, lambda: write_category_files(shop_dir, output_file_prefix, category_id, products,
+                                                        product_dicts, catalog_format))
+        logging.debug(f"Wrote files of category {category_id} in {elapsed * 1000:.1f} ms")
+        return elapsed
@@ -0,0 +1,125 @@
+import logging
+import os
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from serialization import dumps_bytes, loads
+
+Unit = Tuple[Hashable, ...]
+
+
+class CrawlCheckpoint():
+    """
+    Journal of the completed units of a crawl, e.g. (shop, location, category, page), one JSON line per unit appended
+    and flushed as soon as the unit is done, so a crawl killed at any point keeps every unit it finished. A unit may
+    keep a value, products of a page for example, which is read back from the journal only when a restarted crawl
+    asks for it. The journal is removed once the crawl completes without failed units, otherwise the next run resumes
+    from it and repeats only the units which are not done.
+    """
+
+    def __init__(self, path: str, params: Dict[str, Any] = None, resume: bool = True, max_age_hours: float = None):
+        self.path = path
+        # a journal of a crawl with other params, e.g. another page size, describes other units and is not resumed
+        self.params = params or {}
+        self.resume = resume
+        self.max_age_hours = max_age_hours
+        self.offsets: Dict[Unit, Optional[int]] = {}
+        self.failed_units = 0
+        self.journal = None
+
+    def open(self) -> "CrawlCheckpoint":
+        if self.journal:
+            return self
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.isfile(self.path) and self.resume:
+            self._load()
+        if self.journal is None:
+            self.offsets = {}
+            self.journal = open(self.path, 'w+b')
+            self._write_line({"params": self.params, "created": time.time()})
+        return self
+
+    def _load(self):
+        journal = open(self.path, 'r+b')
+        try:
+            header = loads(journal.readline())
+        except ValueError:
+            header = {}
+        age_hours = (time.time() - header.get("created", 0)) / 3600
+        if not header:
+            logging.warning(f"Starting a new checkpoint {self.path}, the saved one is broken")
+        elif header.get("params") != self.params:
+            logging.info(f"Starting a new checkpoint {self.path}, the saved one is of a crawl with other params")
+        elif self.max_age_hours is not None and age_hours > self.max_age_hours:
+            logging.info(f"Starting a new checkpoint {self.path}, the saved one is {age_hours:.1f} hours old")
+        else:
+            offset = journal.tell()
+            for line in journal:
+                if not line.endswith(b"\n"):
+                    logging.warning(f"Dropping a torn unit of checkpoint {self.path}")
+                    break
+                entry = loads(line)
+                self.offsets[tuple(entry["unit"])] = offset if entry.get("value") is not None else None
+                offset += len(line)
+            journal.truncate(offset)
+            journal.seek(offset)
+            self.journal = journal
+            logging.info(f"Resuming from checkpoint {self.path}: {len(self.offsets)} units done "
+                         f"{age_hours:.1f} hours ago are skipped")
+            return
+        journal.close()
+
+    def _write_line(self, entry: Dict[str, Any]) -> int:
+        offset = self.journal.tell()
+        self.journal.write(dumps_bytes(entry, indent=False) + b"\n")
+        self.journal.flush()
+        return offset
+
+    def __contains__(self, unit: Unit) -> bool:
+        return tuple(unit) in self.offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def get(self, unit: Unit) -> Any:
+        """Value saved with a done unit, None for units without a value"""
+        offset = self.offsets.get(tuple(unit))
+        if offset is None:
+            return None
+        position = self.journal.tell()
+        self.journal.seek(offset)
+        entry = loads(self.journal.readline())
+        self.journal.seek(position)
+        return entry["value"]
+
+    def done(self, unit: Unit, value: Any = None):
+        offset = self._write_line({"unit": list(unit), "value": value})
+        self.offsets[tuple(unit)] = offset if value is not None else None
+
+    def failed(self, unit: Unit):
+        """Keeps the journal after the crawl completes, so a rerun retries the failed unit"""
+        self.failed_units += 1
+
+    def complete(self) -> bool:
+        """
+        Called once the crawl finished, the next run starts from scratch unless some units failed, returns whether
+        all units are done
+        """
+        self.close()
+        if self.failed_units:
+            logging.warning(f"{self.failed_units} units failed, checkpoint {self.path} is kept to retry them")
+            return False
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        return True
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,12 +1,21 @@
 import asyncio
 import functools as ft
+import json
 import logging
+import random
+import time
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
 from enum import Enum
 from http.client import InvalidURL
-from typing import Dict, Any
+from typing import Dict, Any, Optional, List, Awaitable, AsyncIterator
 
 from aiohttp import ClientSession, ClientResponse, ClientResponseError, ClientConnectionError, ClientPayloadError, \
-    ServerTimeoutError
+    ServerTimeoutError, TCPConnector, ClientTimeout
+from pydantic import BaseModel
+
+from rate_limiter import AdaptiveRateLimiter
+from serialization import json_serial
 
 
 class HttpMethod(str, Enum):
@@ -21,65 +30,352 @@ class HttpResponseType(str, Enum):
     Text = "text",
     Json = "json"
 
+class RetryErrorClass(str, Enum):
+    Throttled = "throttled"
+    Server = "server"
+    Timeout = "timeout"
+    Connection = "connection"
+    Payload = "payload"
+
+
+class RetryPolicy(BaseModel):
+    # retries of a request per class of error, other errors and 4xx responses are not retried
+    retry_budgets: Dict[RetryErrorClass, int] = {
+        RetryErrorClass.Throttled: 5,
+        RetryErrorClass.Server: 3,
+        RetryErrorClass.Timeout: 2,
+        RetryErrorClass.Connection: 3,
+        RetryErrorClass.Payload: 2,
+    }
+    # the n-th retry waits a random time up to backoff_base * 2 ** (n - 1) seconds, at most backoff_max
+    backoff_base: float = 0.5
+    backoff_max: float = 30
+    # longest Retry-After of a 429/5xx response which is honored
+    retry_after_max: float = 120
+
+
+default_retry_policy = RetryPolicy()
+
+
+class HttpClientSettings(BaseModel):
+    keepalive_timeout: float = 30
+    limit: int = 100
+    limit_per_host: int = 30
+    dns_cache_ttl: int = 300
+    request_timeout: float = 300
+
+
+class HttpClient():
+    """Long-lived pooled ClientSession shared by every call_method while the client is open"""
+
+    def __init__(self, settings: HttpClientSettings = None):
+        self.settings = settings or HttpClientSettings()
+        self.session: Optional[ClientSession] = None
+
+    async def open(self) -> "HttpClient":
+        global _shared_http_client
+        if not self.session or self.session.closed:
+            connector = TCPConnector(limit=self.settings.limit, limit_per_host=self.settings.limit_per_host,
+                                     keepalive_timeout=self.settings.keepalive_timeout,
+                                     ttl_dns_cache=self.settings.dns_cache_ttl, use_dns_cache=True)
+            self.session = ClientSession(connector=connector,
+                                         timeout=ClientTimeout(total=self.settings.request_timeout))
+        _shared_http_client = self
+        return self
+
+    async def close(self):
+        global _shared_http_client
+        if _shared_http_client is self:
+            _shared_http_client = None
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def __aenter__(self) -> "HttpClient":
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+_shared_http_client: Optional[HttpClient] = None
+
+
+def get_shared_http_client() -> Optional[HttpClient]:
+    return _shared_http_client
+
+
+async def send_request(session: ClientSession, url: str, params: Dict[str, str] = None,
+                       headers: Dict[str, str] = None, payload: Dict[str, str] = None, method: HttpMethod = HttpMethod.Get, response_body_type: HttpResponseType = HttpResponseType.Json) -> Dict[str, Any]:
+    if method == HttpMethod.Get:
+        request_manager = session.get(url, params=params, headers=headers, json=payload)
+    elif method == HttpMethod.Post:
+        request_manager = session.post(url, params=params, headers=headers, json=payload)
+    else:
+        raise Exception("Http method not implemented")
+    response = None
+    status = None
+    http_response = None
+    error_class: Optional[RetryErrorClass] = None
+    try:
+        async with request_manager as http_response:
+            http_response: ClientResponse
+            status = http_response.status
+            # bodies of error responses are not the data callers asked for
+            if status != 304 and status < 400:
+                response = await http_response.text() if response_body_type == HttpResponseType.Text else await http_response.json()
+
+    except ClientResponseError as error:
+        # a body which is not JSON, e.g. an error page of a proxy
+        error_class = RetryErrorClass.Payload
+        logging.error(
+            f"Server response error, status: {error.status}, message: {error.message}, url: {error.request_info.url}, headers: {str(error.request_info.headers)}",
+            exc_info=error)
+    except (ServerTimeoutError, asyncio.TimeoutError) as error:
+        error_class = RetryErrorClass.Timeout
+        logging.error(f"Server timeout error", exc_info=error)
+    except ClientPayloadError as payload_error:
+        error_class = RetryErrorClass.Payload
+        logging.error(
+            f"Client payload error", exc_info=payload_error)
+    except ClientConnectionError as connection_error:
+        error_class = RetryErrorClass.Connection
+        logging.error(f"Client connection error, ", exc_info=connection_error)
+    except InvalidURL as url_exception:
+        logging.error(f"InvalidURL error", exc_info=url_exception)
+    except ValueError as error:
+        error_class = RetryErrorClass.Payload
+        logging.error(f"Invalid response body", exc_info=error)
+    except Exception as error:
+        logging.error("Unknown exception happened", exc_info=error)
+
+    return {
+        "response": response,
+        "status": status,
+        "http_response": http_response,
+        "error": error_class
+    }
+
+
 async def call_method(url: str, params: Dict[str, str] = None,
                       headers: Dict[str, str] = None, payload: Dict[str, str] = None, method: HttpMethod = HttpMethod.Get, response_body_type: HttpResponseType = HttpResponseType.Json) -> Dict[str, Any]:
+    http_client = get_shared_http_client()
+    if http_client and http_client.session and not http_client.session.closed:
+        return await send_request(http_client.session, url, params, headers, payload, method, response_body_type)
     async with ClientSession() as session:
-        if method == HttpMethod.Get:
-            request_manager = session.get(url, params=params, headers=headers, json=payload)
-        elif method == HttpMethod.Post:
-            request_manager = session.post(url, params=params, headers=headers, json=payload)
-        else:
-            raise Exception("Http method not implemented")
-        response = None
-        status = None
-        http_response = None
-        try:
-            http_response: ClientResponse = await request_manager
-            status = http_response.status
-            response = await http_response.text() if response_body_type == response_body_type.Text else await http_response.json()
-
-        except ClientResponseError as error:
-            logging.error(
-                f"Server response error, status: {error.status}, message: {error.message}, url: {error.request_info.url}, headers: {str(error.request_info.headers)}",
-                exc_info=error)
-        except ServerTimeoutError as error:
-            logging.error(f"Server timeout error", exc_info=error)
-        except ClientPayloadError as payload_error:
-            logging.error(
-                f"Client payload error", exc_info=payload_error)
-        except ClientConnectionError as connection_error:
-            logging.error(f"Client connection error, ", exc_info=connection_error)
-        except InvalidURL as url_exception:
-            logging.error(f"InvalidURL error", exc_info=url_exception)
-        except Exception as error:
-            logging.error("Unknown exception happened", exc_info=error)
-        
-        return {
-            "response": response,
-            "status": status,
-            "http_response": http_response
-        }
+        return await send_request(session, url, params, headers, payload, method, response_body_type)
+
+async def call_method_limited(url: str, params: Dict[str, str] = None,
+                              headers: Dict[str, str] = None, payload: Dict[str, str] = None, method: HttpMethod = HttpMethod.Get, response_body_type: HttpResponseType = HttpResponseType.Json,
+                              rate_limiter: AdaptiveRateLimiter = None) -> Dict[str, Any]:
+    if not rate_limiter:
+        return await call_method(url, params, headers, payload, method, response_body_type)
+
+    global_limit = await rate_limiter.acquire()
+    result = {}
+    start = time.monotonic()
+    try:
+        result = await call_method(url, params, headers, payload, method, response_body_type)
+    finally:
+        await rate_limiter.release(result.get("status"), time.monotonic() - start, result.get("response") is not None,
+                                   global_limit)
+    return result
+
+
+def retry_error_class(result: Dict[str, Any]) -> Optional[RetryErrorClass]:
+    status = result.get("status")
+    if status == 429:
+        return RetryErrorClass.Throttled
+    if status is not None and status >= 500:
+        return RetryErrorClass.Server
+    return result.get("error")
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait by a Retry-After header, which holds either seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(retry_policy: RetryPolicy, retries: int, result: Dict[str, Any]) -> float:
+    http_response: Optional[ClientResponse] = result.get("http_response")
+    retry_after = parse_retry_after(http_response.headers.get("Retry-After")) if http_response is not None else None
+    if retry_after is not None:
+        return min(retry_after, retry_policy.retry_after_max)
+    # full jitter, requests which failed together are not retried together
+    return random.uniform(0, min(retry_policy.backoff_max, retry_policy.backoff_base * 2 ** (retries - 1)))
+
+
+async def call_method_with_retries(url: str, params: Dict[str, str] = None,
+                                   headers: Dict[str, str] = None, payload: Dict[str, str] = None, method: HttpMethod = HttpMethod.Get, response_body_type: HttpResponseType = HttpResponseType.Json,
+                                   rate_limiter: AdaptiveRateLimiter = None, retry_policy: RetryPolicy = None) -> Dict[str, Any]:
+    """
+    Retries failed requests while the retry budget of the class of their error lasts. Every attempt goes through the
+    rate limiter, so it slows down on failures, and waits of backoff hold no slot of it.
+    """
+    retry_policy = retry_policy or default_retry_policy
+    retries: Dict[RetryErrorClass, int] = defaultdict(int)
+    while True:
+        result = await call_method_limited(url, params, headers, payload, method, response_body_type, rate_limiter)
+        error_class = retry_error_class(result)
+        if error_class is None:
+            return result
+        if retries[error_class] >= retry_policy.retry_budgets.get(error_class, 0):
+            logging.error(f"Giving up {url} after {sum(retries.values())} retries, "
+                          f"{error_class.value} error, status: {result.get('status')}")
+            return result
+        retries[error_class] += 1
+        delay = retry_delay(retry_policy, sum(retries.values()), result)
+        logging.warning(f"Retrying {url} in {delay:.2f} s after a {error_class.value} error, "
+                        f"status: {result.get('status')}")
+        await asyncio.sleep(delay)
+
+
+# identical requests in flight, later callers wait for the response of the first one instead of requesting it again
+class InFlightRequest():
+    """A request shared by identical callers, it is cancelled once none of them waits for it"""
+
+    def __init__(self, future: "asyncio.Future[Dict[str, Any]]"):
+        self.future = future
+        self.waiters = 0
+
+
+in_flight_requests: Dict[str, InFlightRequest] = {}
+
+
+def request_key(url: str, params: Optional[Dict[str, str]], headers: Optional[Dict[str, str]],
+                payload: Optional[Dict[str, str]], method: HttpMethod, response_body_type: HttpResponseType,
+                rate_limiter: Optional[AdaptiveRateLimiter], retry_policy: RetryPolicy) -> str:
+    # requests are shared only by callers who would send them the same way
+    return json.dumps([method, url, params, headers, payload, response_body_type,
+                       id(rate_limiter) if rate_limiter else None, retry_policy.dict()], sort_keys=True,
+                      ensure_ascii=False, default=json_serial)
+
+
+async def get_http_response_info(url: str, params: Dict[str, str] = None,
+                                 headers: Dict[str, str] = None, payload: Dict[str, str] = None, method: HttpMethod = HttpMethod.Get, response_body_type: HttpResponseType = HttpResponseType.Json,
+                                 rate_limiter: AdaptiveRateLimiter = None, retry_policy: RetryPolicy = None) -> Dict[str, Any]:
+    retry_policy = retry_policy or default_retry_policy
+    key = request_key(url, params, headers, payload, method, response_body_type, rate_limiter, retry_policy)
+    request = in_flight_requests.get(key)
+    if request is None:
+        logging.debug(f"Http requesting {url}...")
+        request = InFlightRequest(asyncio.ensure_future(call_method_with_retries(
+            url, params, headers, payload, method, response_body_type, rate_limiter, retry_policy)))
+        in_flight_requests[key] = request
+
+        def forget_request(_):
+            if in_flight_requests.get(key) is request:
+                del in_flight_requests[key]
+
+        request.future.add_done_callback(forget_request)
+    else:
+        logging.debug(f"Waiting for the same request to {url} in flight...")
+    request.waiters += 1
+    try:
+        # a cancelled caller does not cancel the request for the others
+        return await asyncio.shield(request.future)
+    finally:
+        request.waiters -= 1
+        if not request.waiters and not request.future.done():
+            # the last caller was cancelled, nobody needs the response or its retries
+            request.future.cancel()
+            if in_flight_requests.get(key) is request:
+                del in_flight_requests[key]
 
 async def get_http_response(url: str, params: Dict[str, str] = None,
-                      headers: Dict[str, str] = None, payload: Dict[str, str] = None, method: HttpMethod = HttpMethod.Get, response_body_type: HttpResponseType = HttpResponseType.Json) -> Any:
-    logging.debug(f"Http requesting {url}...")
-    return (await call_method(url, params, headers, payload, method, response_body_type)).get("response")
+                      headers: Dict[str, str] = None, payload: Dict[str, str] = None, method: HttpMethod = HttpMethod.Get, response_body_type: HttpResponseType = HttpResponseType.Json,
+                      rate_limiter: AdaptiveRateLimiter = None, retry_policy: RetryPolicy = None) -> Any:
+    return (await get_http_response_info(url, params, headers, payload, method, response_body_type, rate_limiter,
+                                         retry_policy)).get("response")
 
 def chunks(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
+class CrawlProgress():
+    """Aggregates task completion of every crawl running in the process into one progress report"""
+
+    def __init__(self):
+        self.total_tasks: Dict[str, int] = {}
+        self.completed_tasks: Dict[str, int] = {}
+        self.reported_progress = None
+
+    def add_tasks(self, name: str, count: int):
+        self.total_tasks[name] = self.total_tasks.get(name, 0) + count
+        self.completed_tasks.setdefault(name, 0)
+
+    def complete_task(self, name: str):
+        self.completed_tasks[name] += 1
+        total, completed = sum(self.total_tasks.values()), sum(self.completed_tasks.values())
+        progress = round(completed / total * 100)
+        if progress != self.reported_progress:
+            self.reported_progress = progress
+            running = [f"{crawl}: {round(self.completed_tasks[crawl] / count * 100)}%"
+                       for crawl, count in self.total_tasks.items() if self.completed_tasks[crawl] < count]
+            print(f"Completed {progress}% of tasks ({completed}/{total})" +
+                  (f", in progress: {', '.join(running)}" if running else ""))
+
+
+crawl_progress = CrawlProgress()
+
+
+async def as_completed_with_progress(tasks: List[Awaitable], name: str = "default") -> AsyncIterator[Any]:
+    crawl_progress.add_tasks(name, len(tasks))
+    for task in asyncio.as_completed(tasks):
+        result = await task
+        crawl_progress.complete_task(name)
+        yield result
+
+
+async def as_completed_by_groups(groups: List[List[Awaitable]], max_open_groups: int,
+                                 name: str = "default") -> AsyncIterator[Any]:
+    """
+    Yields results as they complete like as_completed_with_progress, but only the awaitables of up to
+    `max_open_groups` groups are scheduled at a time, the next group is started once every awaitable of an open
+    group completed
+    """
+    crawl_progress.add_tasks(name, sum(len(group) for group in groups))
+    pending: Dict[asyncio.Future, int] = {}
+    left_in_group: Dict[int, int] = {}
+    next_group = 0
+    try:
+        while next_group < len(groups) or pending:
+            while next_group < len(groups) and len(left_in_group) < max(max_open_groups, 1):
+                if groups[next_group]:
+                    left_in_group[next_group] = len(groups[next_group])
+                    for awaitable in groups[next_group]:
+                        pending[asyncio.ensure_future(awaitable)] = next_group
+                next_group += 1
+            if not pending:
+                continue
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                group_index = pending.pop(task)
+                left_in_group[group_index] -= 1
+                if not left_in_group[group_index]:
+                    del left_in_group[group_index]
+                crawl_progress.complete_task(name)
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        for group in groups[next_group:]:
+            for awaitable in group:
+                if asyncio.iscoroutine(awaitable):
+                    awaitable.close()
+
 def async_cmd(func):  # to do, write your function decorator
     @ft.wraps(func)
     def wrapper(*args, **kwargs):
         return asyncio.run(func(*args, **kwargs))
 
     return wrapper
-
-from datetime import date, datetime
-def json_serial(obj):
-    """JSON serializer for objects not serializable by default json code"""
-
-    if isinstance(obj, (datetime, date)):
-        return obj.isoformat()
-    raise TypeError ("Type %s not serializable" % type(obj))
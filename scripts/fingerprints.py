@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+from typing import Optional, Dict, Any, List
+
+from pydantic import BaseModel
+
+from catalog_storage import atomic_write
+from serialization import dump, parse_file
+
+
+class CategoryFingerprint(BaseModel):
+    product_count: Optional[int]
+    content_hash: Optional[str]
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+class FingerprintStage():
+    """
+    Fingerprints of an incremental crawl. Fingerprints of requested categories are staged and replace the saved ones
+    only once their category was scraped without failed pages and written, so a category saved with missing pages,
+    or not saved at all, is scraped again by the next crawl instead of being taken for unchanged.
+    """
+
+    def __init__(self, saved: Dict[str, CategoryFingerprint]):
+        self.saved = saved
+        self.staged: Dict[str, CategoryFingerprint] = {}
+        self.scraped_categories: Dict[str, List[str]] = {}
+
+    def get(self, key: str) -> Optional[CategoryFingerprint]:
+        """Fingerprint of the previous crawl"""
+        return self.saved.get(key)
+
+    def __setitem__(self, key: str, fingerprint: CategoryFingerprint):
+        self.staged[key] = fingerprint
+
+    def category_scraped(self, category_key: str, keys: List[str], complete: bool):
+        """
+        Called by a scraper for every category it yields with the keys of fingerprints of the category, which is
+        complete when none of its pages failed
+        """
+        if complete:
+            self.scraped_categories[category_key] = keys
+        else:
+            for key in keys:
+                self.staged.pop(key, None)
+
+    def commit(self, category_key: str):
+        """Called once the category is written"""
+        for key in self.scraped_categories.pop(category_key, []):
+            if key in self.staged:
+                self.saved[key] = self.staged.pop(key)
+
+
+def load_fingerprints(path: str) -> Dict[str, CategoryFingerprint]:
+    if os.path.isfile(path):
+        return parse_file(Dict[str, CategoryFingerprint], path)
+    return {}
+
+
+def save_fingerprints(path: str, fingerprints: Dict[str, CategoryFingerprint]):
+    with atomic_write(path, 'wb') as f:
+        dump({key: fingerprint.dict() for key, fingerprint in fingerprints.items()}, f)
+
+
+def conditional_headers(fingerprints: Optional[FingerprintStage], key: str) -> Dict[str, str]:
+    fingerprint = fingerprints.get(key) if fingerprints else None
+    headers = {}
+    if fingerprint and fingerprint.etag:
+        headers["If-None-Match"] = fingerprint.etag
+    if fingerprint and fingerprint.last_modified:
+        headers["If-Modified-Since"] = fingerprint.last_modified
+    return headers
+
+
+def is_category_changed(fingerprints: FingerprintStage, key: str, response_info: Dict[str, Any],
+                        items_key: str) -> bool:
+    """
+    Stores the fingerprint of a fetched category page and reports whether the category differs from the previous crawl.
+    Failed responses are reported as changed, so the caller handles them the same way as without fingerprints.
+    """
+    if response_info.get("status") == 304:
+        return False
+    response = response_info.get("response")
+    if not response:
+        return True
+
+    items = response.get(items_key) or []
+    http_response = response_info.get("http_response")
+    fingerprint = CategoryFingerprint(
+        product_count=response.get("count", len(items)),
+        content_hash=hashlib.sha1(json.dumps(items, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest(),
+        etag=http_response.headers.get("ETag") if http_response is not None else None,
+        last_modified=http_response.headers.get("Last-Modified") if http_response is not None else None)
+    previous_fingerprint = fingerprints.get(key)
+    fingerprints[key] = fingerprint
+
+    return not previous_fingerprint or previous_fingerprint.product_count != fingerprint.product_count \
+        or previous_fingerprint.content_hash != fingerprint.content_hash
@@ -1,9 +1,16 @@
+import heapq
 import logging
 import math
-import re
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from base_entities import ProductInfo, SizeInfo, SizeInfoType, CategoryInfo, ProductBuyInfo
+from normalization import normalize_title, parse_weight_info, parse_weight_info_with_validation, \
+    capacity_measures, mass_measures, length_measures
 from service_base import ShopScrapperService
 from zakaz_helper import ZakazoShopScrapperService
 from silpo_helper import silpo_shops, SilpoShopScrapperService
@@ -12,174 +19,17 @@ from zakaz_shops import zakaz_shops
 shop_infos = {**zakaz_shops, **silpo_shops}
 shop_parsers: Dict[str, ShopScrapperService] = {**{shop: ZakazoShopScrapperService() for shop in zakaz_shops.keys()}, **{shop: SilpoShopScrapperService() for shop in silpo_shops.keys()}}
 
-capacity_measures = ["л", "мл", 'l', 'ml']
-mass_measures = ["кг", "г", "гр", 'kg', 'g', 'gr']
-length_measures = ['м', 'см', 'мм', 'км', 'm', 'cm', 'mm', 'km']
-
-def normalize_title(product_title: str, product_brand: str = ""):
-    try:
-        product_key = product_title.lower()
-        if product_brand:
-            regexp_brand = product_brand.lower().replace("+", "\+")
-        else:
-            rb_first_letter = "(?<=\s)([A-ZА-ЯЇІЄҐ\+]"
-            rb_word = rb_first_letter + "[A-ZА-Яa-zа-яЇїІіЄєҐґ\-\—\.\+®']+\s?)+\s*"
-            rb_exc = "[a-zа-яїієґ\-\—\.®']{0,5}\s*"
-            regexp_brand = rb_word + '(' + rb_word + ')*' + '(' + rb_exc + rb_word + '){0,1}' + '(' + rb_word + ')*'
-        regexp_amount = "(?<=\s)\d+(,?\d+|.?\d+)*[a-zа-яЇїІіЄєҐґ]+"
-        regexp_percentage = "(?<=\s)\d+(,\d+|.\d+)*\s*%"
-        regexp_number = "№\d*"
-        regexp_symbols = "[®]+"
-        regexp_quotes = "['\"‘’«»”„]"  # delete only symbols
-        regexp_brackets = "[()\[\]{}]*"  # delete only symbols
-        # regexp_quotes = "['\"‘’«»”„].*['\"‘’«»”„]" # delete all inside
-        # regexp_brackets = "\(.*\)|\[.*\]|\{.*\}" # delete all inside
-
-        amount = re.search(regexp_amount, product_key, flags=re.IGNORECASE)
-        percentages = re.search(regexp_percentage, product_key, flags=re.IGNORECASE)
-        number = re.search(regexp_number, product_key, flags=re.IGNORECASE)
-
-        brand = re.search(regexp_brand, product_key, flags=re.IGNORECASE)
-
-        if amount is not None:
-            amount = amount.group().strip()
-            product_key = product_key.replace(amount, '')
-        if percentages is not None:
-            percentages = percentages.group().strip()
-            product_key = product_key.replace(percentages, '')
-        if number is not None:
-            number = number.group().strip()
-            product_key = product_key.replace(number, '')
-        if brand is not None:
-            brand = brand.group().strip()
-            product_key = product_key.replace(brand, '')
-
-        product_key = re.sub(regexp_symbols, '', product_key, flags=re.IGNORECASE)
-        product_key = re.sub(regexp_quotes, '', product_key, flags=re.IGNORECASE)
-        product_key = re.sub(regexp_brackets, '', product_key, flags=re.IGNORECASE)
-        product_key = re.sub(' {2,}', ' ', product_key, flags=re.IGNORECASE)
-
-        return product_key.strip()
-    except Exception as ex:
-        logging.error(f'Failed to normalized {product_title}, {product_brand}', exc_info=ex)
-        return product_title
-
-
-def parse_weight_info(amount: str) -> SizeInfo:
-    amount = amount.replace(' {1,}', '')
-    regexp_num = '\d+(,?\d+|.?\d+)*'
-    regexp_unit = '[a-zа-яЇїІіЄєҐґ]+'
-    if not amount:
-        value = 1
-        unit = ''
-    else:
-        value = re.search(regexp_num, amount)
-        unit = re.findall(regexp_unit, amount)
-        if value:
-            value = value.group()
-            value = value.replace(',', '.')
-            try:
-                value = float(value)
-            except Exception as ex:
-                try:
-                    value = value.replace('х', "*")
-                    value = eval(value)
-                except SyntaxError as se:
-                    value = 0
-        else:
-            value = 1
-
-        if unit:
-            unit = unit[-1]
-        else:
-            unit = ''
-    type = SizeInfoType.Quantity
-    if unit in capacity_measures:
-        type = SizeInfoType.Capacity
-    elif unit in mass_measures:
-        type = SizeInfoType.Mass
-    elif unit in length_measures:
-        type = SizeInfoType.Length
-
-    return SizeInfo(value=value, unit=unit, type=type)
-
-
-def parse_weight_info_with_validation(product_info: ProductInfo) -> SizeInfo:
-    title, volume, weight, bundle, unit = product_info.title, product_info.volume, product_info.weight, product_info.bundle, product_info.unit
-
-    weight_info = product_info.weight_info
-    if not weight_info:
-        weight_info = parse_weight_info(product_info.weight)
-    weight_info_formatted = weight_info
-    weight_value, weight_unit, type = weight_info.value, weight_info.unit, weight_info.type
-
-    regexp_amount = "(?<=\s)(\d+(\,?\d+|\.?\d+)*\s{0,1}[a-zа-яЇїІіЄє]{1,6})+(\s|$)"
-    weight_in_title = re.search(regexp_amount, title)
-    if weight_in_title:
-
-        weight_in_title = weight_in_title.group()
-        if 'шт х ' in title:
-            title = title.replace('шт', '')
-            title = title.replace(' {2,}', ' ')
-            title = title.replace(' х ', 'х')
-            weight_in_title = re.search(regexp_amount, title)
-            if weight_in_title:
-                weight_in_title = weight_in_title.group()
-
-        if type == SizeInfoType.Quantity:
-            weight_info_formatted = parse_weight_info(weight_in_title)
-
-        elif volume and (str(int(volume)) in weight_in_title
-                         or str(float(volume / 1000)) in weight_in_title
-                         or str(int(volume / 1000)) in weight_in_title
-                         or str(float(volume / 1000)).replace('.', ',') in weight_in_title
-                         or str(int(volume * 1000)) in weight_in_title):
-            weight_info_formatted = parse_weight_info(weight_in_title)
-
-        elif weight_value and (str(int(weight_value)) in weight_in_title
-                               or str(float(weight_value / 1000)) in weight_in_title
-                               or str(float(weight_value / 1000)).replace('.', ',') in weight_in_title
-                               or str(int(weight_value * 1000)) in weight_in_title):
-            weight_info_formatted = parse_weight_info(weight_in_title)
-
-        elif bundle and (str(int(bundle)) in weight_in_title
-                         or str(float(bundle / 1000)) in weight_in_title
-                         or str(float(bundle / 1000)).replace('.', ',') in weight_in_title
-                         or str(int(bundle * 1000)) in weight_in_title):
-            weight_info_formatted = parse_weight_info(weight_in_title)
-
-        elif not weight_value and not volume:
-            weight_info_formatted = parse_weight_info(weight_in_title)
-
-    elif bundle and unit:
-        weight_info_formatted = parse_weight_info(str(bundle) + unit)
-
-    elif weight and (weight_info.type == SizeInfoType.Quantity or not weight_unit):
-        weight_unit = ''
-        if float(weight_value) >= 10:
-            weight_unit = 'г'
-        elif float(weight_value) < 10:
-            weight_unit = 'кг'
-        weight_info_formatted = parse_weight_info(str(weight_value) + weight_unit)
-
-    elif volume and (weight_info.type == SizeInfoType.Capacity or not weight_unit):
-        weight_unit = ''
-        if float(weight_value) >= 10:
-            weight_unit = 'мл'
-        elif float(weight_value) < 10:
-            weight_unit = 'л'
-        weight_info_formatted = parse_weight_info(str(volume) + weight_unit)
-
-    formatted_value, formatted_unit, formatted_type = weight_info_formatted
-
-    if not formatted_value:
-        weight_info_formatted = weight_info
-
-    return weight_info_formatted
-
+def normalize_weight_values(weight_value: float, weight_unit: str, weight_type: str,
+                            filter_type: SizeInfoType = SizeInfoType.Unknown) -> Tuple[float, str, str]:
+    if filter_type == SizeInfoType.Capacity:
+        if weight_unit in ['г', "гр"]:
+            return weight_value, 'мл', SizeInfoType.Capacity
+        return weight_value, weight_unit, weight_type
+    elif filter_type == SizeInfoType.Mass:
+        if weight_unit == 'мл':
+            return weight_value, 'г', SizeInfoType.Mass
+        return weight_value, weight_unit, weight_type
 
-def normalize_weight_info(weight_info: SizeInfo, filter_type: SizeInfoType = SizeInfoType.Unknown) -> SizeInfo:
-    weight_value, weight_unit, weight_type = weight_info.value, weight_info.unit, weight_info.type
     if weight_unit == 'л' or weight_unit == 'l':
         weight_value *= 1000
         weight_unit = 'мл'
@@ -195,11 +45,13 @@ def normalize_weight_info(weight_info: SizeInfo, filter_type: SizeInfoType = Siz
     elif weight_unit == 'км' or weight_unit == 'km':
         weight_value *= 1000
         weight_unit = 'м'
-    if filter_type == SizeInfoType.Capacity:
-        return mass_to_capacity(weight_info)
-    elif filter_type == SizeInfoType.Mass:
-        return capacity_to_mass(weight_info)
-    return SizeInfo(value=weight_value, unit=weight_unit, type=weight_info.type)
+    return weight_value, weight_unit, weight_type
+
+
+def normalize_weight_info(weight_info: SizeInfo, filter_type: SizeInfoType = SizeInfoType.Unknown) -> SizeInfo:
+    weight_value, weight_unit, weight_type = normalize_weight_values(weight_info.value, weight_info.unit,
+                                                                     weight_info.type, filter_type)
+    return SizeInfo(value=weight_value, unit=weight_unit, type=weight_type)
 
 
 def capacity_to_mass(weight_info: SizeInfo) -> SizeInfo:
@@ -256,6 +108,57 @@ def get_products_buy_info(product_element: ProductInfo, min_size: str = "") -> P
     return ProductBuyInfo(end_price=end_price, product=product_element, quantity=quantity)
 
 
+def select_cheapest(product_buy_infos: List[ProductBuyInfo], k: int = 1) -> List[ProductBuyInfo]:
+    """k cheapest products sorted by end price, same as a full stable sort cut to k, in O(n log k)"""
+    return heapq.nsmallest(k, product_buy_infos, key=lambda x: x.end_price)
+
+
+def get_products_buy_infos(products: List[ProductInfo], min_size: str = "",
+                           top_k: Optional[int] = None) -> List[ProductBuyInfo]:
+    """
+    Prices all candidates of a buy preference at once with the same results as get_products_buy_info.
+    Products keep their order, with `top_k` only the cheapest ones are returned sorted by end price.
+    """
+    if np is None or not products:
+        product_buy_infos = [get_products_buy_info(product, min_size) for product in products]
+        if top_k is not None:
+            product_buy_infos = select_cheapest(product_buy_infos, top_k)
+        return product_buy_infos
+
+    normalized_min_size_info: SizeInfo = normalize_weight_info(parse_weight_info(min_size)) if min_size else None
+    filter_type = normalized_min_size_info.type if normalized_min_size_info and normalized_min_size_info.unit \
+        else SizeInfoType.Unknown
+    normalized_sizes = [normalize_weight_values(product.weight_info.value, product.weight_info.unit,
+                                                product.weight_info.type, filter_type) for product in products]
+
+    prices = np.array([product.price for product in products], dtype=float)
+    quantities = np.ones(len(products))
+    if normalized_min_size_info and normalized_min_size_info.type != SizeInfoType.Length:
+        min_size_value = normalized_min_size_info.value
+        values = np.array([size[0] for size in normalized_sizes], dtype=float)
+        bundles = np.array([product.bundle or 0 for product in products], dtype=float)
+        same_unit = np.array([size[1] == normalized_min_size_info.unit and size[2] != SizeInfoType.Length
+                              for size in normalized_sizes])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            quantities = np.select(
+                [same_unit & (bundles != 0) & (values != 0), same_unit & (bundles != 0), same_unit & (values != 0)],
+                [np.ceil(min_size_value / (values * bundles)), np.ceil(min_size_value / bundles),
+                 np.ceil(min_size_value / values)], default=1)
+    end_prices = prices * quantities
+
+    if top_k is None:
+        order = range(len(products))
+    elif top_k < len(products):
+        # partition finds the k-th price in linear time, only products up to it are sorted, ties keep their order
+        kth_price = np.partition(end_prices, top_k - 1)[top_k - 1] if top_k > 0 else -np.inf
+        cheapest = np.flatnonzero(end_prices <= kth_price)
+        order = cheapest[np.argsort(end_prices[cheapest], kind='stable')][:top_k]
+    else:
+        order = np.argsort(end_prices, kind='stable')
+    return [ProductBuyInfo.construct(end_price=float(end_prices[i]), product=products[i], quantity=int(quantities[i]))
+            for i in order]
+
+
 # def find_filters():
 #     regexp_filters = '(\"filters\": \[(\s(.*\s))*\]){1}'
 
@@ -0,0 +1,139 @@
+import math
+import os
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+tiles_per_page = 30
+
+
+class ProductTile(NamedTuple):
+    """Fields of a `.ProductsBox__listItem` product card of a zakaz.ua listing page"""
+    title: Optional[str]
+    href: Optional[str]
+    price: Optional[str]
+    weight: Optional[str]
+    available: bool
+
+
+class ListingPage(NamedTuple):
+    tiles: List[ProductTile]
+    # text of the products counter of a (sub)category, e.g. "74 товари"
+    products_count: Optional[str]
+    # number of the last page in the pagination block, None without pagination
+    last_page: Optional[int]
+
+    def pages_count(self) -> int:
+        """Pages of the (sub)category, at most one more than its products fill, as the crawlers always counted them"""
+        amount = int(self.products_count.split(' ')[0])
+        return min(math.ceil(amount / tiles_per_page + 1), self.last_page or 1)
+
+
+# class of an element inside a tile -> field of ProductTile, the first element of a class in document order wins
+tile_field_classes = {
+    'ProductTile__title': 'title',
+    'Price__value_caption': 'price',
+    'ProductTile__weight': 'weight',
+}
+unavailable_tile_class = 'ProductTile_withOpacity'
+link_class = 'ProductTile'
+tile_class = 'ProductsBox__listItem'
+products_count_classes = ['FilterableLayout__productsCount', 'SecondLevelCategory__goodsNumber']
+pagination_class = 'Pagination__item'
+
+
+def _tile_from_fields(fields: Dict[str, Optional[str]], href: Optional[str], available: bool) -> ProductTile:
+    return ProductTile(title=fields.get('title'), href=href, price=fields.get('price'), weight=fields.get('weight'),
+                       available=available)
+
+
+def _class_xpath(class_name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+def parse_listing_lxml(page_html: str) -> ListingPage:
+    document = lxml_html.fromstring(page_html)
+    tiles = []
+    for tile in document.xpath(f"//*[{_class_xpath(tile_class)}]"):
+        # one walk over the elements of a tile fills all of its fields
+        fields: Dict[str, Optional[str]] = {}
+        href = None
+        available = True
+        for element in tile.iterdescendants():
+            classes = element.get('class')
+            if not classes:
+                continue
+            for class_name in classes.split():
+                field = tile_field_classes.get(class_name)
+                if field and field not in fields:
+                    fields[field] = element.text_content()
+                elif class_name == link_class and href is None:
+                    href = element.get('href')
+                elif class_name == unavailable_tile_class:
+                    available = False
+        tiles.append(_tile_from_fields(fields, href, available))
+
+    products_count = None
+    for class_name in products_count_classes:
+        counters = document.xpath(f"(//*[{_class_xpath(class_name)}])[1]")
+        if counters:
+            products_count = counters[0].text_content()
+            break
+    pagination = document.xpath(f"(//*[{_class_xpath(pagination_class)}])[last()]")
+    return ListingPage(tiles=tiles, products_count=products_count,
+                       last_page=int(pagination[0].text_content()) if pagination else None)
+
+
+def parse_listing_bs4(page_html: str) -> ListingPage:
+    soup = BeautifulSoup(page_html, features='html.parser')
+    tiles = []
+    for tile in soup.select(f'.{tile_class}'):
+        fields: Dict[str, Optional[str]] = {}
+        href = None
+        available = True
+        for element in tile.find_all(class_=True):
+            for class_name in element.get('class'):
+                field = tile_field_classes.get(class_name)
+                if field and field not in fields:
+                    fields[field] = element.text
+                elif class_name == link_class and href is None:
+                    href = element.get('href')
+                elif class_name == unavailable_tile_class:
+                    available = False
+        tiles.append(_tile_from_fields(fields, href, available))
+
+    counter = None
+    for class_name in products_count_classes:
+        counter = soup.select_one(f'.{class_name}')
+        if counter:
+            break
+    pagination = soup.select(f'.{pagination_class}')
+    return ListingPage(tiles=tiles, products_count=counter.text if counter else None,
+                       last_page=int(pagination[-1].text) if pagination else None)
+
+
+listing_parsers: Dict[str, Callable[[str], ListingPage]] = {}
+if lxml_html is not None:
+    listing_parsers['lxml'] = parse_listing_lxml
+if BeautifulSoup is not None:
+    listing_parsers['bs4'] = parse_listing_bs4
+html_parser_backends = list(listing_parsers)
+
+# the fastest installed parser unless PRODUCTS_HTML_PARSER selects one
+html_parser_backend = os.environ.get("PRODUCTS_HTML_PARSER") or next(iter(listing_parsers), "bs4")
+
+
+def parse_listing(page_html: str, backend: str = None) -> ListingPage:
+    """Product tiles and pagination of a listing page of a (sub)category"""
+    backend = backend or html_parser_backend
+    if backend not in listing_parsers:
+        raise RuntimeError(f"HTML parser {backend} is not installed, installed parsers: {html_parser_backends}")
+    return listing_parsers[backend](page_html)
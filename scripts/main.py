@@ -1,120 +1,202 @@
 import asyncio
-import json
 import logging
+import math
 import os
 from collections import defaultdict
-from typing import List, Dict, Set, Any, Tuple
+from typing import List, Dict, Set, Any, Tuple, Optional
 import click
 from constants import STORE_INFO_PATH
 from base_entities import CategoryInfo, ProductInfo, UserBuyRequest, BuyPreference, ProductsRequest, \
-    ShopLocationPreference, SizeInfo, ChequeShop, ChequeMulti, ProductsShopRequest, ProductBuyInfo
-from pydantic import parse_obj_as, parse_raw_as, parse_file_as, BaseModel
-from parser import file_open_settings, json_write_settings, async_cmd, cli
-from helpers import get_products_buy_info
+    ShopLocationPreference, SizeInfo, ChequeShop, ChequeMulti, ChequeMultiOptimized, ProductsShopRequest, ProductBuyInfo
+from pydantic import parse_obj_as, parse_raw_as, BaseModel
+from parser import file_open_settings, async_cmd, cli, json_options
+from helpers import get_products_buy_infos, select_cheapest
+from basket_optimizer import optimize_basket
+from catalog_cache import CatalogCache
+from catalog_db import CatalogDatabase
 from datetime import date, datetime
+from serialization import dump, parse_file
 @click.group()
 def cli():
     pass
 
 @cli.command()
 @async_cmd
+@json_options
 @click.option('--input_file_path', default="./user_data/user_buy_request.json", type=str, help='relative file path '
                                                                                                'to user request.')
+@click.option('--catalog_cache_mb', default=256, type=int, help='MB of parsed shop files kept between buy preferences.')
+@click.option('--catalog_db', default="", type=str, help='path to an SQLite catalog to query instead of shop files.')
+@click.option('--top_k', default=1, type=int, help='cheapest products of each buy preference kept in cheques.')
+@click.option('--cheques_only', default=False, type=bool, help='save only cheques, without full output of each shop.')
+@click.option('--optimize_shops', default=False, type=bool,
+              help='pick shops of a multi shop cheque minimizing basket price with shop fees.')
+@click.option('--shop_fee', default=0.0, type=float, help='delivery cost of each visited shop.')
+@click.option('--max_shops', default=None, type=int, help='max number of shops to visit.')
 # @click.option('--output_file_path', default="./user_data/", type=str, help='relative file path
 # to dir where save outputs')
-async def form_buy_list(input_file_path):
-    user_query: UserBuyRequest = parse_file_as(UserBuyRequest, input_file_path)
+async def form_buy_list(input_file_path, catalog_cache_mb, catalog_db, top_k, cheques_only, optimize_shops, shop_fee,
+                        max_shops):
+    user_query: UserBuyRequest = parse_file(UserBuyRequest, input_file_path)
     if user_query:
         print('Stored user_query')
-    buy_list: List[BuyPreference] = user_query.buy_list
     base_path = os.path.join(os.path.dirname(__file__), STORE_INFO_PATH)  # path to data
-    file_navigator = os.path.join('default', 'products_categories.json')
-    file_product_info = "normalized_products.json"
+    catalog_cache = CatalogCache(base_path, max_bytes=catalog_cache_mb * 1024 * 1024)
+    catalog_database: Optional[CatalogDatabase] = CatalogDatabase(catalog_db) if catalog_db else None
 
+    user_basket = form_user_basket(user_query, catalog_cache, catalog_database, top_k if cheques_only else None)
+
+    if catalog_database:
+        catalog_database.close()
+    else:
+        print(f"Catalog cache {catalog_cache.stats()}")
+    logging.info("Saving results...")
+    if not cheques_only:
+        for shop, product_requests in user_basket.items():
+            with open(f'./user_data/output_{shop}.json', 'w', **file_open_settings) as f:
+                dump([product_request.dict() for product_request in product_requests], f)
+
+    shop_cheques, multi_cheque = form_cheques(user_query, user_basket, top_k, optimize_shops, shop_fee, max_shops)
+    for shop, cheque in shop_cheques.items():
+        with open(f'./user_data/minimum_output_{shop}.json', 'w', **file_open_settings) as f:
+            dump(cheque.dict(), f)
+
+    if isinstance(multi_cheque, ChequeMultiOptimized):
+        print(f"Optimized basket: shops {multi_cheque.shops}, products price {multi_cheque.products_price:.2f}, "
+              f"with shop fees {multi_cheque.end_price:.2f}, missing {len(multi_cheque.missing_requests)} buy preferences")
+    if multi_cheque:
+        with open(f'./user_data/multi_shop_output.json', 'w', **file_open_settings) as f:
+            dump(multi_cheque.dict(), f)
+
+
+def find_shop_products(buy_preference: BuyPreference, shop: str, catalog_cache: CatalogCache,
+                       catalog_database: Optional[CatalogDatabase] = None) -> List[ProductInfo]:
+    products = []
+    # equal products have equal fields, so a product is compared only with added products sharing the key fields
+    added_products: Dict[Tuple, List[ProductInfo]] = defaultdict(list)
+
+    title_filter = buy_preference.title_filter.lower()
+    if catalog_database:
+        candidates = catalog_database.find_products(shop, title_filter)
+    else:
+        candidates = catalog_cache.find_products(shop, title_filter)
+    for product_item in candidates:
+        product_item: ProductInfo
+        same_key_products = added_products[(product_item.normalized_title, product_item.category_id,
+                                            product_item.web_url, product_item.price)]
+        if product_item not in same_key_products:
+            if buy_preference.brand_filter and product_item.producer.trademark:
+                for brand in buy_preference.brand_filter:
+                    if brand.lower() in product_item.producer.trademark.lower():
+                        products.append(product_item)
+                        same_key_products.append(product_item)
+            elif not buy_preference.brand_filter:
+                products.append(product_item)
+                same_key_products.append(product_item)
+    return products
+
+
+def price_shop_products(buy_preference: BuyPreference, shop: str, catalog_cache: CatalogCache,
+                        catalog_database: Optional[CatalogDatabase] = None,
+                        top_k: Optional[int] = None) -> List[ProductBuyInfo]:
+    def price():
+        products = find_shop_products(buy_preference, shop, catalog_cache, catalog_database)
+        return get_products_buy_infos(products, buy_preference.weight_filter, top_k)
+
+    # the database may be updated by a running crawl, shop files are not replaced while they are cached
+    if catalog_database:
+        return price()
+    return catalog_cache.memo(('price_shop_products', shop, buy_preference, top_k), price)
+
+
+def form_user_basket(user_query: UserBuyRequest, catalog_cache: CatalogCache,
+                     catalog_database: Optional[CatalogDatabase] = None, top_k: Optional[int] = None,
+                     verbose: bool = True) -> Dict[str, List[ProductsRequest]]:
+    """Priced products of every buy preference by shop, with `top_k` only the cheapest ones are priced"""
     user_basket: Dict[str, List[ProductsRequest]] = defaultdict(list)
 
-    for buy_preference in buy_list:
+    for buy_preference in user_query.buy_list:
         buy_preference: BuyPreference
-        paths_to_shops = []
-        paths_to_navigators = []
         for shop in buy_preference.shop_filter:
-            products_in_request: List[ProductsRequest] = []
-            print(f"Started scanning shop {shop} for buy_preference: title filter - '{buy_preference.title_filter}', brand filter - '{buy_preference.brand_filter}',"
-                   f"weight filter - '{buy_preference.weight_filter}' ")
-            products = []
-            path_to_shop = os.path.join(base_path, shop)
-            path_to_navigator = os.path.join(path_to_shop, file_navigator)
-
-            paths_to_shops.append(path_to_shop)
-            paths_to_navigators.append(path_to_navigator)
-            examined_categories = set()
-
-            # find category of buy_preference
-            file_navigation = parse_file_as(Dict[str, List[str]], path_to_navigator)
-            for product_key in list(file_navigation.keys()):
-                for path_to_category in file_navigation[product_key]:
-                    if buy_preference.title_filter.lower() + " " in product_key and path_to_category not in examined_categories:
-                        logging.debug(f"Scanning products of category {path_to_category}")
-                        examined_categories.add(path_to_category)
-                        product_location = os.path.join(path_to_shop, 'default', path_to_category, file_product_info)
-
-                        # find buy_preference in category
-                        file_info: Dict[str, ProductInfo] = parse_file_as(Dict[str, ProductInfo], product_location)
-                        for title_key, product_item in list(file_info.items()):
-                            product_item: ProductInfo
-                            if buy_preference.title_filter.lower() + " " in title_key.lower():
-                                if product_item not in products:
-                                    if buy_preference.brand_filter and product_item.producer.trademark:
-                                        for brand in buy_preference.brand_filter:
-                                            if brand.lower() in product_item.producer.trademark.lower():
-                                                products.append(product_item)
-                                    elif not buy_preference.brand_filter:
-                                        products.append(product_item)
-            product_buy_infos: List[ProductBuyInfo] = list(map(lambda product_info: get_products_buy_info(product_info, buy_preference.weight_filter), products))
-            products_in_request.append(ProductsRequest(request=buy_preference, product_buy_infos=product_buy_infos))
-            user_basket[shop].extend(products_in_request)
+            if verbose:
+                print(f"Started scanning shop {shop} for buy_preference: title filter - '{buy_preference.title_filter}', brand filter - '{buy_preference.brand_filter}',"
+                      f"weight filter - '{buy_preference.weight_filter}' ")
+            product_buy_infos: List[ProductBuyInfo] = price_shop_products(buy_preference, shop, catalog_cache,
+                                                                          catalog_database, top_k)
+            user_basket[shop].append(ProductsRequest(request=buy_preference, product_buy_infos=product_buy_infos))
+    return user_basket
 
-    logging.info("Saving results...")
-    for shop, product_requests in user_basket.items():
-        with open(f'./user_data/output_{shop}.json', 'w', **file_open_settings) as f:
-            json.dump([product_request.dict() for product_request in product_requests], f, **json_write_settings)
 
+def form_cheques(user_query: UserBuyRequest, user_basket: Dict[str, List[ProductsRequest]], top_k: int = 1,
+                 optimize_shops: bool = False, shop_fee: float = 0,
+                 max_shops: Optional[int] = None) -> Tuple[Dict[str, ChequeShop], Optional[ChequeMulti]]:
+    """Cheques of every shop and the multi shop cheque, product_buy_infos of the basket are cut to `top_k`"""
+    shop_cheques: Dict[str, ChequeShop] = {}
     for shop, product_requests in user_basket.items():
         sum_price = 0
         for product_request in product_requests:
             product_request: ProductsRequest
-            product_request.product_buy_infos.sort(key=lambda x: x.end_price)
-            product_request.product_buy_infos = product_request.product_buy_infos[:1]
+            product_request.product_buy_infos = select_cheapest(product_request.product_buy_infos, top_k)
             if product_request.product_buy_infos:
                 sum_price += product_request.product_buy_infos[0].end_price
-        with open(f'./user_data/minimum_output_{shop}.json', 'w', **file_open_settings) as f:
-            json.dump(
-                ChequeShop(end_price=sum_price, buy_list=product_requests).dict(),
-                f, **json_write_settings)
+        shop_cheques[shop] = ChequeShop(end_price=sum_price, buy_list=product_requests)
+
+    if user_query.buy_location_preference != ShopLocationPreference.MultiShopCheck:
+        return shop_cheques, None
+    if optimize_shops:
+        return shop_cheques, form_optimized_cheque(user_basket, shop_fee, max_shops)
 
     buy_preferences: Dict[BuyPreference, Tuple[str, ProductBuyInfo]] = {}
-    if user_query.buy_location_preference == ShopLocationPreference.MultiShopCheck:
-        for shop, product_requests in user_basket.items():
-            for product_request in product_requests:
-                product_request: ProductsRequest
-                if product_request.product_buy_infos:
-                    if product_request.request in buy_preferences:
-                        existing_product_info: ProductBuyInfo = buy_preferences.get(product_request.request)[1]
-                        if existing_product_info.end_price > product_request.product_buy_infos[0].end_price:
-                            buy_preferences[product_request.request] = (shop, product_request.product_buy_infos[0])
-                    else:
+    for shop, product_requests in user_basket.items():
+        for product_request in product_requests:
+            product_request: ProductsRequest
+            if product_request.product_buy_infos:
+                if product_request.request in buy_preferences:
+                    existing_product_info: ProductBuyInfo = buy_preferences.get(product_request.request)[1]
+                    if existing_product_info.end_price > product_request.product_buy_infos[0].end_price:
                         buy_preferences[product_request.request] = (shop, product_request.product_buy_infos[0])
+                else:
+                    buy_preferences[product_request.request] = (shop, product_request.product_buy_infos[0])
 
-        shops_buy_results: List[ProductsShopRequest] = []
-        sum_price = 0
-        for buy_preference, info in buy_preferences.items():
-            product_buy_info: ProductBuyInfo = info[1]
-            shops_buy_results.append(ProductsShopRequest(shop=info[0], product_request=ProductsRequest(request=buy_preference, product_buy_infos=[product_buy_info])))
+    shops_buy_results: List[ProductsShopRequest] = []
+    sum_price = 0
+    for buy_preference, info in buy_preferences.items():
+        product_buy_info: ProductBuyInfo = info[1]
+        shops_buy_results.append(ProductsShopRequest(shop=info[0], product_request=ProductsRequest(request=buy_preference, product_buy_infos=[product_buy_info])))
 
-            sum_price += info[1].end_price
+        sum_price += info[1].end_price
+    return shop_cheques, ChequeMulti(end_price=sum_price, buy_list=shops_buy_results)
 
-        with open(f'./user_data/multi_shop_output.json', 'w', **file_open_settings) as f:
-            json.dump(ChequeMulti(end_price=sum_price, buy_list=shops_buy_results).dict(), f, **json_write_settings)
+
+def form_optimized_cheque(user_basket: Dict[str, List[ProductsRequest]], shop_fee: float,
+                          max_shops: Optional[int]) -> ChequeMultiOptimized:
+    shops = list(user_basket.keys())
+    # cheapest offer of every buy preference in every shop, product_buy_infos are already sorted by end price
+    offers: Dict[BuyPreference, Dict[str, ProductBuyInfo]] = defaultdict(dict)
+    for shop, product_requests in user_basket.items():
+        for product_request in product_requests:
+            if product_request.product_buy_infos:
+                shop_offers = offers[product_request.request]
+                if shop not in shop_offers or shop_offers[shop].end_price > product_request.product_buy_infos[0].end_price:
+                    shop_offers[shop] = product_request.product_buy_infos[0]
+
+    requests = list(offers.keys())
+    costs = [[offers[request][shop].end_price if shop in offers[request] else math.inf for shop in shops]
+             for request in requests]
+    plan = optimize_basket(costs, shop_fee, max_shops)
+
+    buy_list: List[ProductsShopRequest] = []
+    missing_requests: List[BuyPreference] = []
+    for request, shop_index in zip(requests, plan.assignment):
+        if shop_index is None:
+            missing_requests.append(request)
+            continue
+        buy_list.append(ProductsShopRequest(shop=shops[shop_index], product_request=ProductsRequest(
+            request=request, product_buy_infos=[offers[request][shops[shop_index]]])))
+    return ChequeMultiOptimized(buy_list=buy_list, end_price=plan.total_price(shop_fee),
+                                shops=[shops[shop_index] for shop_index in plan.shops],
+                                products_price=plan.products_price, shop_fee=shop_fee,
+                                missing_requests=missing_requests)
 
 
 if __name__ == '__main__':
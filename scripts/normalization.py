@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import List, Optional
+
+from base_entities import ProductInfo, SizeInfo, SizeInfoType
+
+capacity_measures = ["л", "мл", 'l', 'ml']
+mass_measures = ["кг", "г", "гр", 'kg', 'g', 'gr']
+length_measures = ['м', 'см', 'мм', 'км', 'm', 'cm', 'mm', 'km']
+
+# every pattern is compiled once at import, normalization runs once per scraped product
+rb_first_letter = "(?<=\s)([A-ZА-ЯЇІЄҐ\+]"
+rb_word = rb_first_letter + "[A-ZА-Яa-zа-яЇїІіЄєҐґ\-\—\.\+®']+\s?)+\s*"
+rb_exc = "[a-zа-яїієґ\-\—\.®']{0,5}\s*"
+regexp_brand = re.compile(rb_word + '(' + rb_word + ')*' + '(' + rb_exc + rb_word + '){0,1}' + '(' + rb_word + ')*',
+                          flags=re.IGNORECASE)
+regexp_amount = re.compile("(?<=\s)\d+(,?\d+|.?\d+)*[a-zа-яЇїІіЄєҐґ]+", flags=re.IGNORECASE)
+regexp_percentage = re.compile("(?<=\s)\d+(,\d+|.\d+)*\s*%", flags=re.IGNORECASE)
+regexp_number = re.compile("№\d*", flags=re.IGNORECASE)
+regexp_symbols = re.compile("[®]+", flags=re.IGNORECASE)
+regexp_quotes = re.compile("['\"‘’«»”„]", flags=re.IGNORECASE)  # delete only symbols
+regexp_brackets = re.compile("[()\[\]{}]*", flags=re.IGNORECASE)  # delete only symbols
+regexp_spaces = re.compile(' {2,}', flags=re.IGNORECASE)
+# regexp_quotes = "['\"‘’«»”„].*['\"‘’«»”„]" # delete all inside
+# regexp_brackets = "\(.*\)|\[.*\]|\{.*\}" # delete all inside
+
+regexp_weight_num = re.compile('\d+(,?\d+|.?\d+)*')
+regexp_weight_unit = re.compile('[a-zа-яЇїІіЄєҐґ]+')
+regexp_title_amount = re.compile("(?<=\s)(\d+(\,?\d+|\.?\d+)*\s{0,1}[a-zа-яЇїІіЄє]{1,6})+(\s|$)")
+
+
+@lru_cache(maxsize=4096)
+def get_brand_regexp(product_brand: str) -> re.Pattern:
+    # trademark is used as a pattern as is, only '+' is escaped
+    return re.compile(product_brand.lower().replace("+", "\+"), flags=re.IGNORECASE)
+
+
+def normalize_title(product_title: str, product_brand: str = ""):
+    try:
+        product_key = product_title.lower()
+        brand_regexp = get_brand_regexp(product_brand) if product_brand else regexp_brand
+
+        amount = regexp_amount.search(product_key)
+        percentages = regexp_percentage.search(product_key)
+        number = regexp_number.search(product_key)
+
+        brand = brand_regexp.search(product_key)
+
+        if amount is not None:
+            amount = amount.group().strip()
+            product_key = product_key.replace(amount, '')
+        if percentages is not None:
+            percentages = percentages.group().strip()
+            product_key = product_key.replace(percentages, '')
+        if number is not None:
+            number = number.group().strip()
+            product_key = product_key.replace(number, '')
+        if brand is not None:
+            brand = brand.group().strip()
+            product_key = product_key.replace(brand, '')
+
+        product_key = regexp_symbols.sub('', product_key)
+        product_key = regexp_quotes.sub('', product_key)
+        product_key = regexp_brackets.sub('', product_key)
+        product_key = regexp_spaces.sub(' ', product_key)
+
+        return product_key.strip()
+    except Exception as ex:
+        logging.error(f'Failed to normalized {product_title}, {product_brand}', exc_info=ex)
+        return product_title
+
+
+def parse_weight_info(amount: str) -> SizeInfo:
+    amount = amount.replace(' {1,}', '')
+    if not amount:
+        value = 1
+        unit = ''
+    else:
+        value = regexp_weight_num.search(amount)
+        unit = regexp_weight_unit.findall(amount)
+        if value:
+            value = value.group()
+            value = value.replace(',', '.')
+            try:
+                value = float(value)
+            except Exception as ex:
+                try:
+                    value = value.replace('х', "*")
+                    value = eval(value)
+                except SyntaxError as se:
+                    value = 0
+        else:
+            value = 1
+
+        if unit:
+            unit = unit[-1]
+        else:
+            unit = ''
+    type = SizeInfoType.Quantity
+    if unit in capacity_measures:
+        type = SizeInfoType.Capacity
+    elif unit in mass_measures:
+        type = SizeInfoType.Mass
+    elif unit in length_measures:
+        type = SizeInfoType.Length
+
+    return SizeInfo(value=value, unit=unit, type=type)
+
+
+def parse_weight_info_with_validation(product_info: ProductInfo) -> SizeInfo:
+    title, volume, weight, bundle, unit = product_info.title, product_info.volume, product_info.weight, product_info.bundle, product_info.unit
+
+    weight_info = product_info.weight_info
+    if not weight_info:
+        weight_info = parse_weight_info(product_info.weight)
+    weight_info_formatted = weight_info
+    weight_value, weight_unit, type = weight_info.value, weight_info.unit, weight_info.type
+
+    weight_in_title = regexp_title_amount.search(title)
+    if weight_in_title:
+
+        weight_in_title = weight_in_title.group()
+        if 'шт х ' in title:
+            title = title.replace('шт', '')
+            title = title.replace(' {2,}', ' ')
+            title = title.replace(' х ', 'х')
+            weight_in_title = regexp_title_amount.search(title)
+            if weight_in_title:
+                weight_in_title = weight_in_title.group()
+
+        if type == SizeInfoType.Quantity:
+            weight_info_formatted = parse_weight_info(weight_in_title)
+
+        elif volume and (str(int(volume)) in weight_in_title
+                         or str(float(volume / 1000)) in weight_in_title
+                         or str(int(volume / 1000)) in weight_in_title
+                         or str(float(volume / 1000)).replace('.', ',') in weight_in_title
+                         or str(int(volume * 1000)) in weight_in_title):
+            weight_info_formatted = parse_weight_info(weight_in_title)
+
+        elif weight_value and (str(int(weight_value)) in weight_in_title
+                               or str(float(weight_value / 1000)) in weight_in_title
+                               or str(float(weight_value / 1000)).replace('.', ',') in weight_in_title
+                               or str(int(weight_value * 1000)) in weight_in_title):
+            weight_info_formatted = parse_weight_info(weight_in_title)
+
+        elif bundle and (str(int(bundle)) in weight_in_title
+                         or str(float(bundle / 1000)) in weight_in_title
+                         or str(float(bundle / 1000)).replace('.', ',') in weight_in_title
+                         or str(int(bundle * 1000)) in weight_in_title):
+            weight_info_formatted = parse_weight_info(weight_in_title)
+
+        elif not weight_value and not volume:
+            weight_info_formatted = parse_weight_info(weight_in_title)
+
+    elif bundle and unit:
+        weight_info_formatted = parse_weight_info(str(bundle) + unit)
+
+    elif weight and (weight_info.type == SizeInfoType.Quantity or not weight_unit):
+        weight_unit = ''
+        if float(weight_value) >= 10:
+            weight_unit = 'г'
+        elif float(weight_value) < 10:
+            weight_unit = 'кг'
+        weight_info_formatted = parse_weight_info(str(weight_value) + weight_unit)
+
+    elif volume and (weight_info.type == SizeInfoType.Capacity or not weight_unit):
+        weight_unit = ''
+        if float(weight_value) >= 10:
+            weight_unit = 'мл'
+        elif float(weight_value) < 10:
+            weight_unit = 'л'
+        weight_info_formatted = parse_weight_info(str(volume) + weight_unit)
+
+    formatted_value, formatted_unit, formatted_type = weight_info_formatted
+
+    if not formatted_value:
+        weight_info_formatted = weight_info
+
+    return weight_info_formatted
+
+
+def normalize_products(products: List[ProductInfo]) -> List[ProductInfo]:
+    for product in products:
+        product: ProductInfo
+        product.normalized_title = normalize_title(product_title=product.title,
+                                                   product_brand=product.producer.trademark)
+        product.weight_info = parse_weight_info_with_validation(product)
+        if product.weight_info.type == SizeInfoType.Length and SizeInfoType.Quantity in product.title:
+            product.bundle *= product.weight_info.value
+            product.unit = product.weight_info.unit
+    return products
+
+
+class NormalizationStage():
+    """
+    Normalizes products in chunks on a process pool, so regex work runs on all cores and off the event loop.
+    With `workers` <= 1, or once the pool is broken, products are normalized serially in the calling process.
+    Workers are started by a forkserver, or spawned where it is not available, because by the time the pool starts
+    them the crawl already runs threads, and a forked worker could inherit a lock held by one of them.
+    """
+
+    def __init__(self, workers: Optional[int] = None, chunk_size: int = 500):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.chunk_size = max(chunk_size, 1)
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def open(self):
+        if self.workers > 1 and not self.executor:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context(start_method))
+        return self
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def normalize(self, products: List[ProductInfo]) -> List[ProductInfo]:
+        """Returns normalized products, pooled chunks come back as copies of the given products"""
+        if not self.executor or not products:
+            return normalize_products(products)
+
+        loop = asyncio.get_running_loop()
+        chunks = [products[i:i + self.chunk_size] for i in range(0, len(products), self.chunk_size)]
+        try:
+            normalized_chunks = await asyncio.gather(
+                *[loop.run_in_executor(self.executor, normalize_products, chunk) for chunk in chunks])
+        except BrokenProcessPool as ex:
+            logging.error("Normalization process pool is broken, normalizing serially", exc_info=ex)
+            self.close()
+            return normalize_products(products)
+        return [product for chunk in normalized_chunks for product in chunk]
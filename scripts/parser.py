@@ -1,21 +1,30 @@
-import json
+import asyncio
+import functools as ft
 import logging
 import os
-from collections import defaultdict
+from collections import defaultdict, deque
 from pathlib import Path
-from typing import List, Dict, Set
+from typing import List, Dict, Set, Awaitable, Optional, Deque, Tuple, Any
 
 import click
-from pydantic import parse_file_as
 
-from base_entities import CategoryInfo, ProductInfo, SizeInfoType
+from base_entities import CategoryInfo, ProductInfo
+from catalog_db import CatalogDatabase
+from catalog_storage import catalog_formats, atomic_write
+from catalog_writer import CatalogWriter, serialize_products, write_times_summary
+from checkpoints import CrawlCheckpoint
 from constants import STORE_INFO_PATH
-from extensions import async_cmd, json_serial
-from helpers import parse_weight_info_with_validation, normalize_title, get_shop_locations, shop_infos, shop_parsers
+from fingerprints import FingerprintStage, load_fingerprints, save_fingerprints
+from extensions import async_cmd, HttpClient, HttpClientSettings
+from helpers import get_shop_locations, shop_infos, shop_parsers
+from normalization import NormalizationStage
+from rate_limiter import set_global_request_limit
 from service_base import ShopScrapperService
+from serialization import serialization_backends, configure, dumps_object_entry, dumps_object_end, dump, \
+    load_file, parse_file
+from title_index import save_title_index
 
 file_open_settings = {"encoding": 'utf-8'}
-json_write_settings = {"ensure_ascii": False, "indent": 2, "default":json_serial}
 
 curr_dir = os.path.dirname(__file__)
 datat_dir = os.path.join(curr_dir, STORE_INFO_PATH)
@@ -33,6 +42,123 @@ def try_create_shop_dir(shop: str, shop_location: str = None):
     return shop_dir
 
 
+def http_client_options(func):
+    @click.option('--keepalive_timeout', default=HttpClientSettings().keepalive_timeout, type=float,
+                  help='seconds to keep idle connections open.')
+    @click.option('--limit_per_host', default=HttpClientSettings().limit_per_host, type=int,
+                  help='max simultaneous connections per host.')
+    @click.option('--dns_cache_ttl', default=HttpClientSettings().dns_cache_ttl, type=int,
+                  help='seconds to cache resolved hosts.')
+    @ft.wraps(func)
+    async def wrapper(*args, keepalive_timeout, limit_per_host, dns_cache_ttl, **kwargs):
+        settings = HttpClientSettings(keepalive_timeout=keepalive_timeout, limit_per_host=limit_per_host,
+                                      dns_cache_ttl=dns_cache_ttl)
+        async with HttpClient(settings):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+def crawl_options(func):
+    @click.option('--concurrent', default=False, type=bool,
+                  help='scrape all selected shops and locations at the same time.')
+    @click.option('--max_in_flight', default=100, type=int,
+                  help='max requests in flight across all shops in concurrent mode.')
+    @ft.wraps(func)
+    async def wrapper(*args, concurrent, max_in_flight, **kwargs):
+        return await func(*args, crawl_runner=CrawlRunner(concurrent, max_in_flight), **kwargs)
+
+    return wrapper
+
+
+def normalization_options(func):
+    @click.option('--normalize_workers', default=None, type=int,
+                  help='processes normalizing products, all cores by default, 1 normalizes in the scraper process.')
+    @click.option('--normalize_chunk_size', default=500, type=int,
+                  help='products normalized by a process at once.')
+    @ft.wraps(func)
+    async def wrapper(*args, normalize_workers, normalize_chunk_size, **kwargs):
+        with NormalizationStage(normalize_workers, normalize_chunk_size) as normalization_stage:
+            return await func(*args, normalization_stage=normalization_stage, **kwargs)
+
+    return wrapper
+
+
+def json_options(func):
+    @click.option('--json_backend', default=None, type=click.Choice(serialization_backends),
+                  help='JSON library of all dumps and loads, orjson when it is installed by default.')
+    @click.option('--compact_json', default=None, type=bool,
+                  help='write JSON files without indentation, smaller and faster to write.')
+    @ft.wraps(func)
+    def wrapper(*args, json_backend, compact_json, **kwargs):
+        configure(json_backend, None if compact_json is None else not compact_json)
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def writer_options(func):
+    @click.option('--write_workers', default=4, type=int, help='threads writing files of categories.')
+    @ft.wraps(func)
+    async def wrapper(*args, write_workers, **kwargs):
+        with CatalogWriter(write_workers) as catalog_writer:
+            return await func(*args, catalog_writer=catalog_writer, **kwargs)
+
+    return wrapper
+
+
+class CrawlRunner():
+    def __init__(self, concurrent: bool = False, max_in_flight: int = None):
+        self.concurrent = concurrent
+        self.max_in_flight = max_in_flight
+
+    async def run(self, crawl_units: List[Awaitable]):
+        if not self.concurrent:
+            for crawl_unit in crawl_units:
+                await crawl_unit
+            return
+        logging.info(f"Running {len(crawl_units)} crawls concurrently, max requests in flight: {self.max_in_flight}")
+        set_global_request_limit(self.max_in_flight)
+        try:
+            await asyncio.gather(*crawl_units)
+        finally:
+            set_global_request_limit(None)
+
+
+def select_shop_locations(shop_key: str, input_locations: List[str]) -> List[str]:
+    return get_shop_locations(shop_key) if not input_locations else list(
+        filter(lambda location: location in input_locations, get_shop_locations(shop_key)))
+
+
+save_queue_size = 10
+
+
+class JsonObjectStreamWriter():
+    """
+    Writes a JSON object entry by entry into a temporary file, formatted the same way as dump of the whole object.
+    The target file is replaced only on close, so readers never see a half-written object.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.temp_path = path + ".tmp"
+        self.file = open(self.temp_path, 'w+', **file_open_settings)
+        self.entries_count = 0
+
+    def write(self, key: str, value):
+        self.file.write("".join(dumps_object_entry(key, value, self.entries_count)))
+        self.entries_count += 1
+
+    def close(self):
+        self.file.write(dumps_object_end(self.entries_count))
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+
 @click.group()
 def cli():
     pass
@@ -40,12 +166,15 @@ def cli():
 
 @cli.command()
 @async_cmd
+@json_options
+@http_client_options
+@crawl_options
 @click.option('--shops', default="all", type=str, help='list of shop categories.')
 @click.option('--locations', default="all", type=str, help='list of locations.')
 @click.option('--promotions_only', default=False, type=bool, help='scrape only promotions or no?')
 @click.option('--popular', default=False, type=bool, help='return popular categories or no.')
 @click.option('--force_reload', default=True, type=bool, help='force data download no matter cache exists.')
-async def parse_categories(shops, locations, promotions_only, popular, force_reload):
+async def parse_categories(shops, locations, promotions_only, popular, force_reload, crawl_runner: CrawlRunner):
     shop_list = list(shop_infos.keys()) if not shops or shops == "all" else [shop.strip() for shop in shops.split(",")]
     input_locations = locations.split(",") if locations and locations != "all" else []
 
@@ -73,7 +202,7 @@ async def parse_categories(shops, locations, promotions_only, popular, force_rel
                 else await scrapper.get_promotion_categories(shop_key, shop_location)
         else:
             logging.info(f"Retrieving {shop_full_name} {promotion_str} categories from path: {raw_category_file_path}")
-            categories = parse_file_as(List[CategoryInfo], raw_category_file_path)
+            categories = parse_file(List[CategoryInfo], raw_category_file_path)
         if categories:
             logging.info(f"Available {promotion_str} categories for {shop_full_name}, count: {len(categories)}")
             if not categories_cached or force_reload:
@@ -81,36 +210,55 @@ async def parse_categories(shops, locations, promotions_only, popular, force_rel
                     f"Saving {promotion_str} categories to {raw_category_file_path} and {categories_hierarchy_file_path}")
 
                 with open(raw_category_file_path, "w+", **file_open_settings) as f:
-                    json.dump([category.dict() for category in categories], f, **json_write_settings)
+                    dump([category.dict() for category in categories], f)
 
                 category_hierarchy = {category.slug: category.dict() for category in categories}
 
                 with open(categories_hierarchy_file_path, "w+", **file_open_settings) as f:
-                    json.dump(category_hierarchy, f, **json_write_settings)
+                    dump(category_hierarchy, f)
 
     ###
+    crawl_units: List[Awaitable] = []
     for shop_key in shop_list:
-        shop_location_list = get_shop_locations(shop_key) if not input_locations else list(
-            filter(lambda shop: shop.location in input_locations, get_shop_locations(shop_key)))
+        shop_location_list = select_shop_locations(shop_key, input_locations)
 
         if shop_location_list:
             for shop_location in shop_location_list:
                 if not promotions_only:
-                    await scrape_categories(shop_key, shop_location, False)
-                await scrape_categories(shop_key, shop_location, True)
+                    crawl_units.append(scrape_categories(shop_key, shop_location, False))
+                crawl_units.append(scrape_categories(shop_key, shop_location, True))
         else:
             logging.debug(f"No shop infos found for shop '{shop_key}', locations: {locations}'")
+    await crawl_runner.run(crawl_units)
 
 
 @cli.command()
 @async_cmd
+@json_options
+@http_client_options
+@crawl_options
+@normalization_options
+@writer_options
 @click.option('--shops', default="silpo", type=str, help='list of shops.')
 @click.option('--locations', default="all", type=str, help='list of locations.')
 @click.option('--promotions_only', default=False, type=bool, help='scrape only promotions or no?')
 @click.option('--page_count', default=1, help='number of pages_count to scrape from shops.')
 @click.option('--per_page_product_count', default=100, help='number of products to scrape from shops.')
 @click.option('--force_reload', default=True, help='force data download no matter cache exists.')
-async def parse_shop_products(shops, locations, promotions_only, page_count, per_page_product_count, force_reload):
+@click.option('--incremental', default=False, type=bool,
+              help='re-scrape only categories changed since the previous crawl and merge them into saved data.')
+@click.option('--catalog_format', default="json", type=click.Choice(catalog_formats),
+              help='format of normalized products of categories, msgpack is compact and loads without validation.')
+@click.option('--catalog_db', default="", type=str,
+              help='path to an SQLite catalog to save normalized products to in addition to files.')
+@click.option('--resume', default=True, type=bool,
+              help='continue an interrupted crawl from its checkpoint, pages scraped before are not requested again.')
+@click.option('--checkpoint_max_age_hours', default=24.0, type=float,
+              help='checkpoints older than this are discarded and the crawl starts from scratch.')
+async def parse_shop_products(shops, locations, promotions_only, page_count, per_page_product_count, force_reload,
+                              incremental, catalog_format, catalog_db, resume, checkpoint_max_age_hours,
+                              crawl_runner: CrawlRunner, normalization_stage: NormalizationStage,
+                              catalog_writer: CatalogWriter):
     shop_list: List[str] = []
     if not shops or shops == "all":
         shop_list = allowed_shops
@@ -118,7 +266,14 @@ async def parse_shop_products(shops, locations, promotions_only, page_count, per
         for shop_key in shops.split(","):
             shop_list.append(shop_key.strip())
 
-    input_locations = locations.splt(",") if locations and locations != "all" else []
+    input_locations = locations.split(",") if locations and locations != "all" else []
+    catalog_database: Optional[CatalogDatabase] = CatalogDatabase(catalog_db) if catalog_db else None
+    crawl_params = {"page_count": page_count, "per_page_product_count": per_page_product_count}
+    # shops and locations crawled completely, a rerun after a crash skips them, pages of the others are recorded
+    # in checkpoints of their directories
+    crawl_checkpoint = CrawlCheckpoint(os.path.join(datat_dir, "parse_shop_products_checkpoint.jsonl"),
+                                       {**crawl_params, "incremental": incremental, "catalog_format": catalog_format},
+                                       resume, checkpoint_max_age_hours).open()
 
     ###
     async def scrape_products(shop_key: str, shop_location: str, promotion: bool = False):
@@ -127,6 +282,10 @@ async def parse_shop_products(shops, locations, promotions_only, page_count, per
         promotion_str = "promotion" if promotion else "common"
 
         shop_full_name = f"{shop_key}_{shop_location}"
+        crawl_unit = (shop_key, shop_location, promotion_str)
+        if crawl_unit in crawl_checkpoint:
+            logging.info(f"Skipping {shop_full_name} {promotion_str} products, crawled before the crawl was interrupted")
+            return
 
         logging.info(f"Started scrapping {shop_full_name} {promotion_str} products")
 
@@ -134,99 +293,136 @@ async def parse_shop_products(shops, locations, promotions_only, page_count, per
 
         raw_product_path = os.path.join(shop_dir, f"{output_file_prefix}raw_products_info.json")
         products_cached = os.path.exists(raw_product_path) and os.stat(raw_product_path).st_size > 5
-        category_products: Dict[str, List[ProductInfo]] = {}
+        fingerprints_path = os.path.join(shop_dir, f"{output_file_prefix}category_fingerprints.json")
+        # fingerprints without saved products would skip categories which were never written
+        fingerprints: Optional[FingerprintStage] = FingerprintStage(
+            load_fingerprints(fingerprints_path) if products_cached else {}) if incremental else None
 
-        if not products_cached or force_reload:
-            category_products = await scrapper.get_products(shop_key, shop_location, page_count, per_page_product_count) if not promotion else await scrapper.get_promotion_products(shop_key, shop_location, page_count, per_page_product_count)
-        else:
+        if products_cached and not force_reload and not incremental:
             logging.info(f"Retrieving '{shop_full_name}' {promotion_str} products from path: {raw_product_path}")
-            category_products = parse_file_as(Dict[str, List[ProductInfo]], raw_product_path)
-        if category_products:
-            for category, products in category_products.items():
-                for product in products:
-                    product: ProductInfo
-                    product.normalized_title = normalize_title(product_title=product.title,
-                                                               product_brand=product.producer.trademark)
-                    product.weight_info = parse_weight_info_with_validation(product)
-                    if product.weight_info.type == SizeInfoType.Length and SizeInfoType.Quantity in product.title:
-                        product.bundle *= product.weight_info.value
-                        product.unit = product.weight_info.unit 
-
+            category_products: Dict[str, List[ProductInfo]] = parse_file(Dict[str, List[ProductInfo]], raw_product_path)
+            await asyncio.gather(*[normalization_stage.normalize(products) for products in category_products.values()])
             print(
                 f"Available {promotion_str} products for '{shop_full_name}', categories count: {len(category_products)}")
-            if not products_cached or force_reload:
-                logging.info(f"Saving raw {promotion_str} products to {raw_product_path}")
-
-                with open(raw_product_path, 'w+', **file_open_settings) as f:
-                    json.dump(
-                        {category_id: [product.dict() for product in product_list] for category_id, product_list
-                         in
-                         category_products.items()}, f, **json_write_settings)
-                product_categories: Dict[str, List[str]] = defaultdict(list)
-                logging.info(f"Saving {promotion_str} products per each category folder....")
-
-                for category_id, products in category_products.items():
-                    products: List[ProductInfo]
-                    path_to_category = os.path.join(shop_dir, category_id)
-                    if not os.path.exists(path_to_category):
-                        os.mkdir(path_to_category)
-
-                    with open(os.path.join(path_to_category, f'{output_file_prefix}normalized_products.json'), 'w+',
-                              **file_open_settings) as f:
-                        json.dump({product.normalized_title: product.dict() for product in products}, f,
-                                  **json_write_settings)
-
-                    with open(os.path.join(path_to_category, f'{output_file_prefix}normalized_products_list.json'),
-                              'w+',
-                              **file_open_settings) as f:
-                        json.dump(sorted([product.normalized_title for product in products]), f,
-                                  **json_write_settings)
-
-                    with open(os.path.join(path_to_category, f'{output_file_prefix}products_list.json'), 'w+',
-                              **file_open_settings) as f:
-                        json.dump(sorted([product.title for product in products]), f, **json_write_settings)
-
-                    with open(os.path.join(path_to_category, f'{output_file_prefix}brand_list.json'), 'w+',
-                              **file_open_settings) as f:
-                        json.dump(list(
-                            set([product.producer.trademark for product in products if
-                                 product.producer.trademark])), f,
-                            **json_write_settings)
-
-                    brand_products: Dict[str, Set[str]] = defaultdict(set)
-                    product_brands: Dict[str, Set[str]] = defaultdict(set)
-                    for product in products:
-                        # normalize
-                        if product.producer.trademark:
-                            brand_products[product.producer.trademark].add(product.normalized_title)
-                            product_brands[product.normalized_title].add(product.producer.trademark)
-                        product_categories[product.normalized_title].append(category_id)
-
-                    with open(os.path.join(path_to_category, f'{output_file_prefix}brand_products.json'), 'w+',
-                              **file_open_settings) as f:
-                        json.dump({k: list(v) for k, v in brand_products.items()}, f, **json_write_settings)
-
-                    with open(os.path.join(path_to_category, f'{output_file_prefix}product_brands.json'), 'w+',
-                              **file_open_settings) as f:
-                        json.dump({k: list(v) for k, v in product_brands.items()}, f, **json_write_settings)
-
-                with open(os.path.join(shop_dir, f'{output_file_prefix}products_categories.json'), 'w+',
-                          **file_open_settings) as f:
-                    json.dump(product_categories, f,
-                              **json_write_settings)
+            return
+
+        # pages are recorded as they are scraped, a rerun after a crash requests only pages which are not recorded
+        checkpoint = CrawlCheckpoint(os.path.join(shop_dir, f"{output_file_prefix}crawl_checkpoint.jsonl"),
+                                     crawl_params, resume, checkpoint_max_age_hours).open()
+
+        product_stream = scrapper.iter_products(shop_key, shop_location, page_count, per_page_product_count, fingerprints=fingerprints, checkpoint=checkpoint) if not promotion else scrapper.iter_promotion_products(shop_key, shop_location, page_count, per_page_product_count, fingerprints=fingerprints, checkpoint=checkpoint)
+
+        product_categories: Dict[str, List[str]] = defaultdict(list)
+        products_categories_path = os.path.join(shop_dir, f'{output_file_prefix}products_categories.json')
+
+        logging.info(f"Saving raw {promotion_str} products to {raw_product_path} and per each category folder....")
+        raw_products_writer = JsonObjectStreamWriter(raw_product_path)
+        saved_categories: Set[str] = set()
+        category_queue: asyncio.Queue = asyncio.Queue(maxsize=save_queue_size)
+        # categories whose files are being written, they are saved in the order they were scraped
+        writes_in_flight: Deque[Tuple[str, List[ProductInfo], List[Dict[str, Any]], asyncio.Future]] = deque()
+        write_times: List[float] = []
+
+        async def finish_category(category_id: str, products: List[ProductInfo], product_dicts: List[Dict[str, Any]],
+                                  files_written: asyncio.Future):
+            try:
+                write_times.append(await files_written)
+                if catalog_database:
+                    await asyncio.to_thread(catalog_database.write_category, shop_key, shop_location, promotion,
+                                            category_id, {product.normalized_title: product for product in products},
+                                            {product.normalized_title: product_dict
+                                             for product, product_dict in zip(products, product_dicts)})
+                for product in products:
+                    product_categories[product.normalized_title].append(category_id)
+                saved_categories.add(category_id)
+                if fingerprints is not None:
+                    fingerprints.commit(category_id)
+            except Exception as ex:
+                logging.error(f"Failed to save {promotion_str} products of category {category_id} of {shop_full_name}",
+                              exc_info=ex)
+
+        async def save_categories():
+            # runs next to the scraper, so normalization and disk writes overlap with requests in flight
+            while (item := await category_queue.get()) is not None:
+                category_id, normalization = item
+                try:
+                    products = await normalization
+                    product_dicts = await asyncio.to_thread(serialize_products, products)
+                    await asyncio.to_thread(raw_products_writer.write, category_id, product_dicts)
+                except Exception as ex:
+                    logging.error(f"Failed to save {promotion_str} products of category {category_id} of {shop_full_name}",
+                                  exc_info=ex)
+                    continue
+                writes_in_flight.append((category_id, products, product_dicts, asyncio.ensure_future(
+                    catalog_writer.write_category(shop_dir, output_file_prefix, category_id, products, product_dicts,
+                                                  catalog_format))))
+                if len(writes_in_flight) > catalog_writer.workers:
+                    await finish_category(*writes_in_flight.popleft())
+            while writes_in_flight:
+                await finish_category(*writes_in_flight.popleft())
+
+        saver = asyncio.create_task(save_categories())
+        try:
+            try:
+                async for category_id, products in product_stream:
+                    # categories waiting in the queue are normalized in parallel, the saver keeps their order
+                    await category_queue.put((category_id, asyncio.ensure_future(normalization_stage.normalize(products))))
+            finally:
+                await category_queue.put(None)
+                await saver
+        except BaseException:
+            # saved files of the previous crawl stay as they are
+            raw_products_writer.discard()
+            raise
+
+        if not saved_categories:
+            # keep data of the previous crawl
+            raw_products_writer.discard()
+        else:
+            print(f"Available {promotion_str} products for '{shop_full_name}', categories count: {len(saved_categories)}")
+            if incremental and products_cached:
+                # unchanged categories are carried over from the previous crawl
+                for category_id, products in load_file(raw_product_path).items():
+                    if category_id not in saved_categories:
+                        raw_products_writer.write(category_id, products)
+                if os.path.isfile(products_categories_path):
+                    for product_key, category_ids in load_file(products_categories_path).items():
+                        product_categories[product_key].extend(
+                            [category_id for category_id in category_ids if category_id not in saved_categories])
+            raw_products_writer.close()
+            logging.info(f"Files of {shop_full_name} {promotion_str} categories: {write_times_summary(write_times)}")
+
+            with atomic_write(products_categories_path, 'w', **file_open_settings) as f:
+                dump(product_categories, f)
+            save_title_index(os.path.join(shop_dir, f'{output_file_prefix}title_index.json'), product_categories.keys())
+            if catalog_database and not incremental:
+                catalog_database.remove_categories_except(shop_key, shop_location, promotion, list(saved_categories))
+        if fingerprints is not None:
+            save_fingerprints(fingerprints_path, fingerprints.saved)
+        if checkpoint.complete():
+            crawl_checkpoint.done(crawl_unit)
+        else:
+            crawl_checkpoint.failed(crawl_unit)
 
     ###
+    crawl_units: List[Awaitable] = []
     for shop_key in shop_list:
-        shop_location_list = get_shop_locations(shop_key) if not input_locations else list(
-            filter(lambda shop: shop.location in input_locations, get_shop_locations(shop_key)))
+        shop_location_list = select_shop_locations(shop_key, input_locations)
 
         if shop_location_list:
             for shop_location in shop_location_list:
                 if not promotions_only:
-                    await scrape_products(shop_key, shop_location, False)
-                await scrape_products(shop_key, shop_location, True)
+                    crawl_units.append(scrape_products(shop_key, shop_location, False))
+                crawl_units.append(scrape_products(shop_key, shop_location, True))
         else:
             logging.debug(f"No shop infos found for shop '{shop_key}', locations: {locations}'")
+    try:
+        await crawl_runner.run(crawl_units)
+        crawl_checkpoint.complete()
+    finally:
+        crawl_checkpoint.close()
+        if catalog_database:
+            catalog_database.close()
 
 
 if __name__ == '__main__':
@@ -1,63 +1,107 @@
-from typing import List, Dict
-from pydantic import parse_file_as
+from typing import List, Optional
 from base_entities import CategoryInfo, ShopInfo, ProductInfo, UserBuyRequest
 import os
 
-from helpers import shop_infos
+from catalog_cache import CatalogCache
+from catalog_db import CatalogDatabase
+from catalog_storage import products_file_path
+from helpers import shop_infos, shop_parsers
+from main import form_user_basket, form_cheques
 from service_base import ProductService
 
+promotion_prefix = "promotion_"
+
+
+def flatten_categories(categories: List[CategoryInfo]) -> List[CategoryInfo]:
+    flat_categories: List[CategoryInfo] = []
+    for category in categories:
+        flat_categories.append(category)
+        flat_categories += flatten_categories(category.children or [])
+    return flat_categories
+
 
 class FileBaseProductService(ProductService):
-    def __init__(self, input_file_path: str):
+    """
+    Read side of the data saved by parse_categories and parse_shop_products. Files are parsed on first use and kept
+    in a size-bounded LRU cache, an entry is parsed again once its files change on disk.
+    """
+
+    def __init__(self, input_file_path: str, catalog_database: Optional[CatalogDatabase] = None,
+                 max_bytes: int = 256 * 1024 * 1024):
         self.input_file_path = input_file_path
+        self.catalog_database = catalog_database
+        self.catalog_cache = CatalogCache(input_file_path, max_bytes=max_bytes, check_mtime=True)
 
     def get_shops(self) -> List[ShopInfo]:
         return list(shop_infos.values())
 
+    @staticmethod
+    def shop_key(shop: ShopInfo) -> str:
+        """Key of the shop in shop_infos, its data is saved by it, ShopInfo.name is not set for every shop"""
+        if shop.name in shop_infos:
+            return shop.name
+        for shop_key, shop_info_list in shop_infos.items():
+            if any(shop_info.id == shop.id for shop_info in shop_info_list):
+                return shop_key
+        return shop.name
+
     def get_categories(self, shop: ShopInfo) -> List[CategoryInfo]:
-        categories_list: List[CategoryInfo] = []
-        path_to_categories_file = os.path.join(self.input_file_path, shop.name, shop.location,
-                                               'raw_categories_info.json')
-        if os.path.isfile(path_to_categories_file):
-            categories_list = parse_file_as(List[CategoryInfo], path_to_categories_file) # найдет ли эта запись только верхние категории?
-        return categories_list
+        return self.catalog_cache.categories(self.shop_key(shop), shop.location)
+
+    def _get_products(self, shop: ShopInfo, category: Optional[CategoryInfo], prefix: str) -> List[ProductInfo]:
+        shop_key = self.shop_key(shop)
+        category_ids = [shop_parsers[shop_key].category_key(category)] if category else \
+            self.catalog_cache.category_ids(shop_key, shop.location, prefix)
+        products_list: List[ProductInfo] = []
+        for category_id in category_ids:
+            if self.catalog_database:
+                products_list += self.catalog_database.get_category_products(shop_key, shop.location, category_id,
+                                                                             promotion=bool(prefix))
+            elif os.path.isfile(products_file_path(os.path.join(self.catalog_cache.shop_dir(shop_key, shop.location),
+                                                                category_id), prefix)):
+                products_list += self.catalog_cache.category_products(shop_key, category_id, shop.location,
+                                                                      prefix).values()
+        return products_list
 
     def get_products(self, shop: ShopInfo, category: CategoryInfo = None) -> List[ProductInfo]:
-        products_list: Dict[str, ProductInfo] = {}
-        path_to_file_products = os.path.join(self.input_file_path, shop.name, category.slug, "normalized_products.json")
-        if os.path.isfile(path_to_file_products):
-            products_list = parse_file_as(Dict[str, ProductInfo], path_to_file_products)
-        return list(products_list.values())
+        """Products of a category, of all categories of the shop when no category is given"""
+        return self._get_products(shop, category, "")
 
     def get_shop_locations(self, shop: ShopInfo) -> List[str]:
         shop_locations: List[str] = []
-        for shop_key, shop_info_list in shop_infos.items():
-            if shop_key == shop.name:
-                for shop_info in shop_info_list:
-                    shop_locations.append(shop_info.location)
+        for shop_info in shop_infos.get(self.shop_key(shop), []):
+            shop_locations.append(shop_info.location)
         return shop_locations
 
-        ##########
-
     def get_promotion_categories(self, shop: ShopInfo) -> List[CategoryInfo]:
-        pass
-        # это категории, в которых есть акционные товары?
-        # или категория акций?
+        """Promotion categories saved by parse_categories, otherwise the categories with saved promotion products"""
+        shop_key = self.shop_key(shop)
+        categories = self.catalog_cache.categories(shop_key, shop.location, promotion_prefix)
+        if categories:
+            return categories
+        promotion_category_ids = set(self.catalog_cache.category_ids(shop_key, shop.location, promotion_prefix))
+        return [category for category in flatten_categories(self.get_categories(shop))
+                if shop_parsers[shop_key].category_key(category) in promotion_category_ids]
 
     def get_promotion_products(self, shop: ShopInfo, category: CategoryInfo = None) -> List[ProductInfo]:
-        pass
-        # может передать promotion_categories в get_products?
+        return self._get_products(shop, category, promotion_prefix)
 
     def form_buy_list(self, buy_request: UserBuyRequest) -> List[ProductInfo]:
-        buy_list: List[ProductInfo] = []
-        # buy_list? що це має бути?
-        return buy_list
-
-
-test = FileBaseProductService(input_file_path=os.path.join(os.path.dirname(__file__), 'data'))
-shops = test.get_shops()
-locations = test.get_shop_locations(ShopInfo(id=48201070, title='novus'))
-categories = test.get_categories(ShopInfo(id=48221130, title='таврія'))
-print(shops)
-print(locations)
-print(categories)
+        """Cheapest product of every buy preference, in the cheapest shop when a multi shop cheque is requested"""
+        user_basket = form_user_basket(buy_request, self.catalog_cache, self.catalog_database, top_k=1,
+                                       verbose=False)
+        shop_cheques, multi_cheque = form_cheques(buy_request, user_basket)
+        if multi_cheque:
+            return [shop_request.product_request.product_buy_infos[0].product for shop_request in multi_cheque.buy_list]
+        return [product_request.product_buy_infos[0].product for cheque in shop_cheques.values()
+                for product_request in cheque.buy_list if product_request.product_buy_infos]
+
+
+if __name__ == '__main__':
+    test = FileBaseProductService(input_file_path=os.path.join(os.path.dirname(__file__), 'data'))
+    shops = test.get_shops()
+    locations = test.get_shop_locations(ShopInfo(id=48201070, name='novus', title='novus'))
+    categories = test.get_categories(ShopInfo(id=48221130, name='таврія', title='таврія'))
+    print(shops)
+    print(locations)
+    print(categories)
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from pydantic import BaseModel
+
+scraping_config_path = os.path.join(os.path.dirname(__file__), 'scraping_config.json')
+
+
+class ShopScrapingConfig(BaseModel):
+    max_request_batch: int = 10
+    timeout: float = 2.5
+    max_rate_multiplier: float = 2
+    latency_factor: float = 2
+    latency_window: int = 50
+
+
+def load_scraping_config(path: str = scraping_config_path) -> Dict[str, ShopScrapingConfig]:
+    if not os.path.isfile(path):
+        logging.warning(f"Scraping config not found: {path}, using defaults")
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return {shop: ShopScrapingConfig.parse_obj(config) for shop, config in json.load(f).items()}
+
+
+class AdaptiveRateLimiter():
+    """
+    Keeps up to `concurrency` requests in flight and starts at most `rate` requests per second.
+    Both shrink by half on 429/5xx/failed responses and grow back additively while responses stay healthy.
+    Latency is compared with the fastest of the recent 2xx responses with a body, so the baseline follows the server
+    when it gets slower for a while and a single fast 304/404 does not hold concurrency down.
+    """
+
+    def __init__(self, name: str, config: ShopScrapingConfig):
+        self.name = name
+        self.max_concurrency = max(config.max_request_batch, 1)
+        self.base_rate = self.max_concurrency / config.timeout if config.timeout else float(self.max_concurrency)
+        self.max_rate = self.base_rate * config.max_rate_multiplier
+        self.min_rate = self.base_rate / 10
+        self.latency_factor = config.latency_factor
+
+        self.concurrency: float = self.max_concurrency
+        self.rate: float = self.base_rate
+        self.in_flight = 0
+        self.tokens: float = self.max_concurrency
+        self.last_refill = time.monotonic()
+        self.latency: Optional[float] = None
+        self.recent_latencies: Deque[float] = deque(maxlen=max(config.latency_window, 1))
+        self._slot_released: Optional[asyncio.Condition] = None
+
+    @property
+    def slot_released(self) -> asyncio.Condition:
+        if self._slot_released is None:
+            self._slot_released = asyncio.Condition()
+        return self._slot_released
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.max_concurrency, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self) -> Optional[asyncio.Semaphore]:
+        """Returns the global request limit the request holds a permit of, it is given back to release"""
+        async with self.slot_released:
+            await self.slot_released.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+        global_limit = global_request_limit
+        global_acquired = False
+        try:
+            if global_limit:
+                await global_limit.acquire()
+                global_acquired = True
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+            return global_limit
+        except asyncio.CancelledError:
+            # the caller never gets to release a slot it was cancelled waiting for
+            if global_acquired:
+                global_limit.release()
+            await self._free_slot()
+            raise
+
+    async def release(self, status: Optional[int], latency: float, has_body: bool = True,
+                      global_limit: Optional[asyncio.Semaphore] = None):
+        if status is None or status == 429 or status >= 500:
+            self.concurrency = max(1.0, self.concurrency / 2)
+            self.rate = max(self.min_rate, self.rate / 2)
+            logging.warning(f"Backing off {self.name} after status {status}: "
+                            f"concurrency {int(self.concurrency)}, rate {self.rate:.2f}/s")
+        elif 200 <= status < 300 and has_body:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.recent_latencies.append(latency)
+            if self.latency > min(self.recent_latencies) * self.latency_factor:
+                self.concurrency = max(1.0, self.concurrency - 1)
+                self.rate = max(self.min_rate, self.rate - self.base_rate / self.max_concurrency)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self.rate = min(self.max_rate, self.rate + self.base_rate / self.max_concurrency)
+
+        # the limit may be replaced while the request is in flight, the permit goes back to the one it was taken from
+        if global_limit:
+            global_limit.release()
+        await self._free_slot()
+
+    async def _free_slot(self):
+        async with self.slot_released:
+            self.in_flight -= 1
+            self.slot_released.notify_all()
+
+
+rate_limiters: Dict[str, AdaptiveRateLimiter] = {}
+global_request_limit: Optional[asyncio.Semaphore] = None
+
+
+def set_global_request_limit(max_in_flight: Optional[int]):
+    """Caps requests in flight across all shops, must be set before any request is started"""
+    global global_request_limit
+    global_request_limit = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+
+
+def get_rate_limiter(shop: str) -> AdaptiveRateLimiter:
+    if shop not in rate_limiters:
+        config = load_scraping_config().get(shop) or ShopScrapingConfig()
+        rate_limiters[shop] = AdaptiveRateLimiter(shop, config)
+    return rate_limiters[shop]
@@ -0,0 +1,118 @@
+import io
+import json
+import os
+from datetime import date, datetime
+from typing import Any, Type, TypeVar, Tuple, Union, IO
+
+from pydantic import BaseModel, parse_obj_as
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+T = TypeVar("T")
+
+serialization_backends = ["orjson", "json"]
+
+
+def json_serial(obj):
+    """JSON serializer for objects not serializable by default json code"""
+
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError ("Type %s not serializable" % type(obj))
+
+
+class SerializationSettings(BaseModel):
+    backend: str = "orjson" if orjson is not None else "json"
+    # indented output is readable, compact output is smaller and faster to write
+    indent: bool = True
+
+
+serialization_settings = SerializationSettings(
+    backend=os.environ.get("PRODUCTS_JSON_BACKEND") or ("orjson" if orjson is not None else "json"),
+    indent=os.environ.get("PRODUCTS_JSON_COMPACT", "") not in ["1", "true"])
+
+
+def configure(backend: str = None, indent: bool = None):
+    """Selects the serialization backend and output mode of all dumps of a process"""
+    if backend == "orjson" and orjson is None:
+        raise RuntimeError("orjson is not installed, install it or use the json backend")
+    if backend is not None:
+        serialization_settings.backend = backend
+    if indent is not None:
+        serialization_settings.indent = indent
+
+
+def use_orjson() -> bool:
+    return serialization_settings.backend == "orjson" and orjson is not None
+
+
+def dumps_bytes(value: Any, indent: bool = None) -> bytes:
+    indent = serialization_settings.indent if indent is None else indent
+    if use_orjson():
+        # datetimes go through json_serial, so both backends write them the same way
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(value, default=json_serial, option=option)
+    return dumps(value, indent).encode('utf-8')
+
+
+def dumps(value: Any, indent: bool = None) -> str:
+    indent = serialization_settings.indent if indent is None else indent
+    if use_orjson():
+        return dumps_bytes(value, indent).decode('utf-8')
+    if indent:
+        return json.dumps(value, ensure_ascii=False, indent=2, default=json_serial)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=json_serial)
+
+
+def dump(value: Any, f: IO, indent: bool = None):
+    """Writes `value` to a text or binary file"""
+    if isinstance(f, io.TextIOBase):
+        f.write(dumps(value, indent))
+    else:
+        f.write(dumps_bytes(value, indent))
+
+
+def dumps_object_entry(key: str, value: Any, index: int, indent: bool = None) -> Tuple[str, str]:
+    """
+    Text preceding the value of the `index`-th entry of an object and the value, formatted as dumps formats them
+    inside the whole object, so large objects can be written entry by entry.
+    """
+    indent = serialization_settings.indent if indent is None else indent
+    value_text = dumps(value, indent)
+    if indent:
+        return ("," if index else "{") + "\n  " + dumps(key, False) + ": ", value_text.replace("\n", "\n  ")
+    return ("," if index else "{") + dumps(key, False) + ":", value_text
+
+
+def dumps_object_end(entries_count: int, indent: bool = None) -> str:
+    indent = serialization_settings.indent if indent is None else indent
+    if not entries_count:
+        return "{}"
+    return "\n}" if indent else "}"
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if use_orjson():
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def load(f: IO) -> Any:
+    return loads(f.read())
+
+
+def load_file(path: str) -> Any:
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def parse_file(type_: Type[T], path: str) -> T:
+    """Validates a JSON file as `type_`, a drop-in replacement of pydantic's parse_file_as"""
+    return parse_obj_as(type_, load_file(path))
+
+
+def parse_raw(type_: Type[T], data: Union[str, bytes]) -> T:
+    return parse_obj_as(type_, loads(data))
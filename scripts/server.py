@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+import click
+from aiohttp import web
+from pydantic import ValidationError
+
+from base_entities import UserBuyRequest, BuyListResult, BuyPreference, ShopInfo
+from catalog_cache import CatalogCache
+from catalog_db import CatalogDatabase
+from constants import STORE_INFO_PATH
+from helpers import shop_infos, get_products_buy_infos
+from main import form_user_basket, form_cheques, find_shop_products
+from product_service import FileBaseProductService
+from serialization import dumps, parse_raw
+
+
+class CatalogSnapshot():
+    """
+    Catalogs of all saved shops preloaded into memory. A snapshot is never modified after it is loaded, a refreshed
+    data directory is loaded into a new snapshot which replaces the current one, requests in flight keep the old one.
+    """
+
+    def __init__(self, base_path: str, catalog_cache_mb: int, shops: Optional[List[str]] = None):
+        self.catalog_cache = CatalogCache(base_path, max_bytes=catalog_cache_mb * 1024 * 1024)
+        self.shops = shops or self.catalog_cache.saved_shops()
+        self.version = catalog_version(self.catalog_cache, self.shops)
+        self.loaded_at = time.time()
+
+    def preload(self):
+        for shop in self.shops:
+            self.catalog_cache.preload(shop)
+
+
+def catalog_version(catalog_cache: CatalogCache, shops: List[str]) -> Tuple[Tuple[str, float], ...]:
+    """Navigators are saved last by parse_shop_products, so their mtimes change once a crawl of a shop is complete"""
+    return tuple((shop, os.path.getmtime(catalog_cache.navigator_path(shop)))
+                 for shop in shops if os.path.isfile(catalog_cache.navigator_path(shop)))
+
+
+def json_response(value, status: int = 200) -> web.Response:
+    return web.Response(text=dumps(value, indent=False), status=status,
+                        content_type='application/json')
+
+
+def query_bool(request: web.Request, name: str, default: bool = False) -> bool:
+    value = request.query.get(name)
+    return default if value is None else value.lower() in ["1", "true", "yes"]
+
+
+def get_shop_info(shop: str) -> ShopInfo:
+    if shop not in shop_infos:
+        raise web.HTTPNotFound(text=f"Unknown shop {shop}")
+    return shop_infos[shop][0]
+
+
+async def load_snapshot(app: web.Application) -> bool:
+    """Loads a new snapshot when navigators changed since the current one was loaded, returns whether it did"""
+    async with app['reload_lock']:
+        current: Optional[CatalogSnapshot] = app.get('snapshot')
+        snapshot = CatalogSnapshot(app['base_path'], app['catalog_cache_mb'], app['shops'])
+        if current and snapshot.version == current.version:
+            return False
+        start = time.perf_counter()
+        await asyncio.to_thread(snapshot.preload)
+        app['snapshot'] = snapshot
+        logging.info(f"Loaded catalogs of {len(snapshot.shops)} shops in {time.perf_counter() - start:.1f} s, "
+                     f"catalog cache {snapshot.catalog_cache.stats()}")
+        return True
+
+
+async def watch_data_dir(app: web.Application):
+    while True:
+        await asyncio.sleep(app['reload_interval'])
+        try:
+            await load_snapshot(app)
+        except Exception as ex:
+            logging.error("Failed to reload catalogs, serving the previous ones", exc_info=ex)
+
+
+async def start_background_tasks(app: web.Application):
+    if app['reload_interval'] > 0:
+        app['watcher'] = asyncio.create_task(watch_data_dir(app))
+
+
+async def stop_background_tasks(app: web.Application):
+    if 'watcher' in app:
+        app['watcher'].cancel()
+    if app['catalog_database']:
+        app['catalog_database'].close()
+
+
+async def health(request: web.Request) -> web.Response:
+    snapshot: CatalogSnapshot = request.app['snapshot']
+    return json_response({"shops": snapshot.shops, "loaded_at": snapshot.loaded_at,
+                          "catalog_cache": snapshot.catalog_cache.stats()})
+
+
+async def reload(request: web.Request) -> web.Response:
+    return json_response({"reloaded": await load_snapshot(request.app)})
+
+
+async def buy_list(request: web.Request) -> web.Response:
+    """Cheques of a UserBuyRequest, the same as form_buy_list saves with --cheques_only"""
+    try:
+        user_query = parse_raw(UserBuyRequest, await request.text())
+        top_k = int(request.query.get('top_k', 1))
+        shop_fee = float(request.query.get('shop_fee', 0))
+        max_shops = int(request.query['max_shops']) if request.query.get('max_shops') else None
+    except (ValidationError, ValueError) as ex:
+        raise web.HTTPBadRequest(text=str(ex))
+
+    snapshot: CatalogSnapshot = request.app['snapshot']
+    # lookups and cheque optimization are CPU-bound, other requests are served meanwhile
+    user_basket = await asyncio.to_thread(form_user_basket, user_query, snapshot.catalog_cache,
+                                          request.app['catalog_database'], top_k, verbose=False)
+    shop_cheques, multi_cheque = await asyncio.to_thread(form_cheques, user_query, user_basket, top_k,
+                                                         query_bool(request, 'optimize_shops'), shop_fee, max_shops)
+    return json_response(BuyListResult(request_index=0, shop_cheques=shop_cheques, multi_cheque=multi_cheque).dict())
+
+
+async def shop_products(request: web.Request) -> web.Response:
+    """Priced products of a shop matching a buy preference given by query parameters"""
+    shop = request.match_info['shop']
+    get_shop_info(shop)
+    try:
+        buy_preference = BuyPreference(title_filter=request.query.get('title_filter', ''),
+                                       brand_filter=request.query.getall('brand_filter', None),
+                                       weight_filter=request.query.get('weight_filter'), shop_filter=[shop])
+        top_k = int(request.query['top_k']) if request.query.get('top_k') else None
+    except (ValidationError, ValueError) as ex:
+        raise web.HTTPBadRequest(text=str(ex))
+
+    snapshot: CatalogSnapshot = request.app['snapshot']
+    products = await asyncio.to_thread(find_shop_products, buy_preference, shop, snapshot.catalog_cache,
+                                       request.app['catalog_database'])
+    product_buy_infos = await asyncio.to_thread(get_products_buy_infos, products, buy_preference.weight_filter, top_k)
+    return json_response([product_buy_info.dict() for product_buy_info in product_buy_infos])
+
+
+async def shops(request: web.Request) -> web.Response:
+    return json_response([shop_info_list[0].dict() for shop_info_list in shop_infos.values()])
+
+
+async def shop_locations(request: web.Request) -> web.Response:
+    product_service: FileBaseProductService = request.app['product_service']
+    return json_response(product_service.get_shop_locations(get_shop_info(request.match_info['shop'])))
+
+
+async def shop_categories(request: web.Request) -> web.Response:
+    product_service: FileBaseProductService = request.app['product_service']
+    categories = product_service.get_categories(get_shop_info(request.match_info['shop']))
+    return json_response([category.dict() for category in categories])
+
+
+async def category_products(request: web.Request) -> web.Response:
+    shop, category_id = request.match_info['shop'], request.match_info['category_id']
+    get_shop_info(shop)
+    # category ids name directories of the shop, they must not lead out of it
+    if any(separator in category_id for separator in ["/", "\\", ".."]):
+        raise web.HTTPBadRequest(text=f"Invalid category {category_id}")
+    if request.app['catalog_database']:
+        products = request.app['catalog_database'].get_category_products(shop, "default", category_id)
+    else:
+        snapshot: CatalogSnapshot = request.app['snapshot']
+        if not os.path.isdir(os.path.join(snapshot.catalog_cache.shop_dir(shop), category_id)):
+            raise web.HTTPNotFound(text=f"Unknown category {category_id} of shop {shop}")
+        products = list(snapshot.catalog_cache.category_products(shop, category_id).values())
+    return json_response([product.dict() for product in products])
+
+
+def create_app(base_path: str, catalog_cache_mb: int = 1024, shops_list: Optional[List[str]] = None,
+               catalog_db: str = "", reload_interval: float = 30) -> web.Application:
+    app = web.Application()
+    app['base_path'] = base_path
+    app['catalog_cache_mb'] = catalog_cache_mb
+    app['shops'] = shops_list
+    app['reload_interval'] = reload_interval
+    app['reload_lock'] = asyncio.Lock()
+    app['catalog_database'] = CatalogDatabase(catalog_db) if catalog_db else None
+    app['product_service'] = FileBaseProductService(base_path, app['catalog_database'])
+    app.on_startup.append(load_snapshot)
+    app.on_startup.append(start_background_tasks)
+    app.on_cleanup.append(stop_background_tasks)
+    app.add_routes([web.get('/health', health),
+                    web.post('/reload', reload),
+                    web.post('/buy_list', buy_list),
+                    web.get('/shops', shops),
+                    web.get('/shops/{shop}/locations', shop_locations),
+                    web.get('/shops/{shop}/categories', shop_categories),
+                    web.get('/shops/{shop}/categories/{category_id}/products', category_products),
+                    web.get('/shops/{shop}/products', shop_products)])
+    return app
+
+
+@click.command()
+@click.option('--host', default="127.0.0.1", type=str, help='host to listen on.')
+@click.option('--port', default=8080, type=int, help='port to listen on.')
+@click.option('--shops', default="", type=str, help='shops to keep in memory, all saved by default.')
+@click.option('--catalog_cache_mb', default=1024, type=int, help='MB of parsed shop files kept in memory.')
+@click.option('--catalog_db', default="", type=str, help='path to an SQLite catalog to query instead of shop files.')
+@click.option('--reload_interval', default=30.0, type=float,
+              help='seconds between checks of the data directory for a finished crawl, 0 disables hot reload.')
+def serve(host, port, shops, catalog_cache_mb, catalog_db, reload_interval):
+    logging.basicConfig(level=logging.INFO)
+    shops_list = [shop.strip() for shop in shops.split(",")] if shops else None
+    web.run_app(create_app(os.path.join(os.path.dirname(__file__), STORE_INFO_PATH), catalog_cache_mb, shops_list,
+                           catalog_db, reload_interval), host=host, port=port, access_log=None)
+
+
+if __name__ == '__main__':
+    serve()
@@ -1,22 +1,101 @@
-from typing import List, Dict
+from collections import defaultdict
+from typing import List, Dict, Optional, AsyncIterator, Tuple, Set
+
+from pydantic import parse_obj_as
 
 from base_entities import ProductInfo, CategoryInfo, ShopInfo, UserBuyRequest
+from checkpoints import CrawlCheckpoint, Unit
+from fingerprints import FingerprintStage
+
+
+class CategoryStreamBuffer():
+    """Buffers pages of categories in flight and releases each category once all of its pages arrived"""
+
+    def __init__(self):
+        self.pages_left: Dict[str, int] = {}
+        self.products: Dict[str, List[ProductInfo]] = {}
+        # categories with failed pages, they are released with the products of the other pages
+        self.failed_categories: Set[str] = set()
+
+    def expect(self, category_key: str, page_count: int = 1):
+        self.pages_left[category_key] = self.pages_left.get(category_key, 0) + page_count
+
+    def add(self, category_key: str, products: Optional[List[ProductInfo]]) -> Optional[List[ProductInfo]]:
+        """products are None for failed pages, returns all products of the category when it is complete"""
+        if products is not None:
+            self.products.setdefault(category_key, []).extend(products)
+        else:
+            self.failed_categories.add(category_key)
+        self.pages_left[category_key] -= 1
+        if self.pages_left[category_key] > 0:
+            return None
+        del self.pages_left[category_key]
+        return self.products.pop(category_key, None)
+
+
+def restore_page_products(checkpoint: Optional[CrawlCheckpoint], unit: Unit) -> Optional[List[ProductInfo]]:
+    """Products of a page scraped by an interrupted run of the crawl, None when the page has to be requested"""
+    if checkpoint is None or unit not in checkpoint:
+        return None
+    return parse_obj_as(List[ProductInfo], checkpoint.get(unit))
+
+
+def record_page_products(checkpoint: Optional[CrawlCheckpoint], unit: Unit, products: Optional[List[ProductInfo]]):
+    """products are None for failed pages, they are requested again when the crawl is rerun"""
+    if checkpoint is None:
+        return
+    if products is None:
+        checkpoint.failed(unit)
+    else:
+        checkpoint.done(unit, [product.dict() for product in products])
 
 
 class ShopScrapperService():
     async def get_categories(self, shop: str, location: str, popular: bool = False) -> List[CategoryInfo]:
         pass
 
-    async def get_products(self, shop: str, location: str, page_count: int, per_page_product_count: int) -> Dict[
-        str, List[ProductInfo]]:
+    def category_key(self, category: CategoryInfo) -> str:
+        """Key products of the category are saved by, the name of its directory"""
+        return category.id
+
+    async def iter_products(self, shop: str, location: str, page_count: int, per_page_product_count: int,
+                            fingerprints: FingerprintStage = None,
+                            checkpoint: CrawlCheckpoint = None) -> AsyncIterator[
+        Tuple[str, List[ProductInfo]]]:
+        """
+        Yields (category, products) as soon as all pages of a category are scraped. When fingerprints are passed,
+        only categories which changed since the fingerprints were taken are yielded and their fresh fingerprints are
+        staged, every yielded category is reported to the stage with whether all of its pages were scraped. When a
+        checkpoint is passed, scraped pages are recorded in it and pages recorded by an interrupted run are taken from
+        it instead of being requested again.
+        """
         pass
+
+    async def get_products(self, shop: str, location: str, page_count: int, per_page_product_count: int,
+                           fingerprints: FingerprintStage = None) -> Dict[str, List[ProductInfo]]:
+        results: Dict[str, List[ProductInfo]] = defaultdict(list)
+        async for category, products in self.iter_products(shop, location, page_count, per_page_product_count,
+                                                           fingerprints):
+            results[category].extend(products)
+        return results
+
     async def get_promotion_categories(self, shop: str, location: str) -> List[CategoryInfo]:
         pass
 
-    async def get_promotion_products(self, shop: str, location: str, page_count: int, per_page_product_count: int) -> Dict[
-        str, List[ProductInfo]]:
+    async def iter_promotion_products(self, shop: str, location: str, page_count: int, per_page_product_count: int,
+                                      fingerprints: FingerprintStage = None,
+                                      checkpoint: CrawlCheckpoint = None) -> AsyncIterator[
+        Tuple[str, List[ProductInfo]]]:
         pass
 
+    async def get_promotion_products(self, shop: str, location: str, page_count: int, per_page_product_count: int,
+                                     fingerprints: FingerprintStage = None) -> Dict[str, List[ProductInfo]]:
+        results: Dict[str, List[ProductInfo]] = defaultdict(list)
+        async for category, products in self.iter_promotion_products(shop, location, page_count,
+                                                                     per_page_product_count, fingerprints):
+            results[category].extend(products)
+        return results
+
 class ProductService():
 
     def get_shops(self) -> List[ShopInfo]:
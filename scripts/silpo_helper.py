@@ -2,14 +2,17 @@ import asyncio
 import logging
 import re
 from collections import namedtuple, defaultdict
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, AsyncIterator, Tuple, Callable, Awaitable
 import datefinder
 from pydantic import parse_obj_as, BaseModel
 
 from base_entities import CategoryInfo, ProductInfo, ShopInfo, ProducerInfo, PromoInfo
+from checkpoints import CrawlCheckpoint
 from constants import BASE_silpo_UA_URL
-from extensions import get_http_response, chunks, HttpMethod
-from service_base import ShopScrapperService
+from extensions import get_http_response, get_http_response_info, as_completed_with_progress, HttpMethod
+from fingerprints import FingerprintStage, conditional_headers, is_category_changed
+from rate_limiter import get_rate_limiter
+from service_base import ShopScrapperService, CategoryStreamBuffer, restore_page_products, record_page_products
 from datetime import datetime, date
 
 silpo_shops = {
@@ -28,6 +31,48 @@ class SilpotCategoryListReponse(BaseModel):
 ProductListWithCategory = namedtuple('ProductListWithCategory', ['category', 'product_list'])
 
 
+async def iter_slug_products(categories: List[CategoryInfo],
+                             request_products: Callable[[CategoryInfo, bool], Awaitable[ProductListWithCategory]],
+                             fingerprints: Optional[FingerprintStage], name: str) -> AsyncIterator[
+    Tuple[str, List[ProductInfo]]]:
+    """
+    Categories sharing a slug are saved together, so a slug is yielded once all of its categories arrived. When some
+    of them changed since the previous crawl, the unchanged ones are requested again without conditional headers,
+    otherwise the saved slug would keep only the products of the changed ones.
+    """
+    results = CategoryStreamBuffer()
+    slug_category_ids: Dict[str, List[str]] = defaultdict(list)
+    for category in categories:
+        results.expect(category.slug)
+        slug_category_ids[category.slug].append(category.id)
+    unchanged_categories: Dict[str, List[CategoryInfo]] = defaultdict(list)
+
+    print(f"Total amount of scrape tasks: {len(categories)}")
+    async for item in as_completed_with_progress([request_products(category, True) for category in categories],
+                                                 name=name):
+        item: ProductListWithCategory
+        slug = item.category.slug
+        if item.product_list is None:
+            unchanged_categories[slug].append(item.category)
+        category_products = results.add(slug, item.product_list)
+        if slug in results.pages_left:
+            continue
+        stale_categories = unchanged_categories.pop(slug, [])
+        if category_products is not None:
+            if fingerprints is not None and stale_categories:
+                stale_items = await asyncio.gather(*[request_products(category, False)
+                                                     for category in stale_categories])
+                if any(stale_item.product_list is None for stale_item in stale_items):
+                    logging.warning(f"Keeping saved products of category {slug}, some of its categories failed")
+                    continue
+                for stale_item in stale_items:
+                    category_products.extend(stale_item.product_list)
+            if fingerprints is not None:
+                # products of every category of the slug are in, failures are either requested again or not yielded
+                fingerprints.category_scraped(slug, slug_category_ids[slug], True)
+            yield slug, category_products
+
+
 class PromotionCategory(BaseModel):
     name: str
     id: int
@@ -66,6 +111,10 @@ class ProductInfoSilpoResponse(BaseModel):
 
 
 class SilpoShopScrapperService(ShopScrapperService):
+    def category_key(self, category: CategoryInfo) -> str:
+        # categories sharing a slug are saved together
+        return category.slug
+
 
     async def get_categories(self, shop: str, location: str, popular: bool = False) -> List[CategoryInfo]:
         shop_infos: List[ShopInfo] = list(filter(lambda x: x.location == location, silpo_shops.get(shop)))
@@ -115,17 +164,25 @@ class SilpoShopScrapperService(ShopScrapperService):
         else:
             logging.warning(f"Failed to find shop {shop}, location: {location}")
 
-    async def get_products(self, shop: str, location: str, page_count: int, per_page_product_count: int) -> Dict[
-        str, List[ProductInfo]]:
+    async def iter_products(self, shop: str, location: str, page_count: int, per_page_product_count: int,
+                            fingerprints: FingerprintStage = None,
+                            checkpoint: CrawlCheckpoint = None) -> AsyncIterator[
+        Tuple[str, List[ProductInfo]]]:
         shop_infos: List[ShopInfo] = list(filter(lambda x: x.location == location, silpo_shops.get(shop)))
         if not shop_infos:
-            return {}
+            return
 
         shop_info = shop_infos[0]
         categories: List[CategoryInfo] = await self.get_categories(shop=shop, location=location)
         product_web_url = "https://shop.silpo.ua/product/"
 
-        async def request_products(category: CategoryInfo):
+        async def request_products(category: CategoryInfo, conditional: bool = True):
+            # all products of a category are requested at once, as its first page
+            unit = (shop, location, category.id, 1)
+            saved_products = restore_page_products(checkpoint, unit)
+            if saved_products is not None:
+                return ProductListWithCategory(category=category, product_list=saved_products)
+
             payload = {
                 "method": "GetSimpleCatalogItems",
                 "data": {
@@ -148,12 +205,21 @@ class SilpoShopScrapperService(ShopScrapperService):
             }
 
             product_url = BASE_silpo_UA_URL
-            response = await get_http_response(product_url, headers={"Accept-Language": "uk"}, payload=payload,
-                                               method=HttpMethod.Post)
+            headers = {"Accept-Language": "uk"}
+            if conditional:
+                headers.update(conditional_headers(fingerprints, category.id))
+            response_info = await get_http_response_info(
+                product_url, headers=headers, payload=payload, method=HttpMethod.Post,
+                rate_limiter=get_rate_limiter(shop))
+            # the fingerprint is stored for unconditional requests as well, their products are kept anyway
+            if fingerprints is not None and not is_category_changed(fingerprints, category.id, response_info,
+                                                                    'items') and conditional:
+                return ProductListWithCategory(category=category, product_list=None)
+            response = response_info.get("response")
             if response:
                 shop_products: List[ProductInfoSilpoResponse] = parse_obj_as(List[ProductInfoSilpoResponse],
                                                                              response['items'])
-                return ProductListWithCategory(category=category, product_list=[
+                products = [
                     ProductInfo(title=product.name, category_id=category.id, price=product.price, weight=product.unit,
                                 slug=product.slug, web_url=product_web_url + product.slug,
                                 producer=ProducerInfo(
@@ -161,12 +227,13 @@ class SilpoShopScrapperService(ShopScrapperService):
                                         0].value if product.parameters and list(
                                         filter(lambda x: x.key == "trademark", product.parameters)) else None))
                     for product in shop_products
-                ])
+                ]
+                record_page_products(checkpoint, unit, products)
+                return ProductListWithCategory(category=category, product_list=products)
             else:
                 logging.warning(f"Failed to parse products of category {category} of shop {shop}, location: {location}")
-                return None
-
-        results: Dict[str, List[ProductInfo]] = defaultdict(list)
+                record_page_products(checkpoint, unit, None)
+                return ProductListWithCategory(category=category, product_list=None)
 
         def get_categories(category: CategoryInfo):
             categories = []
@@ -187,19 +254,9 @@ class SilpoShopScrapperService(ShopScrapperService):
                     categories_ids.add(cat.id)
                     scrape_args.append(cat)
 
-        total_tasks = len(scrape_args)
-        print(f"Total amount of scrape tasks: {total_tasks}")
-        completed_tasks = 0
-        for args in chunks(scrape_args, 30):
-            for item in await asyncio.gather(
-                    *[asyncio.create_task(request_products(arg)) for arg in args]):
-                item: ProductListWithCategory
-                results[item.category.slug].extend(item.product_list)
-                completed_tasks += 1
-            print(f"Completed {round(completed_tasks / total_tasks * 100)}% of tasks")
-            await asyncio.sleep(2.5)
-
-        return results
+        async for slug, category_products in iter_slug_products(scrape_args, request_products, fingerprints,
+                                                                f"{shop}_{location}"):
+            yield slug, category_products
 
     async def get_promotion_categories(self, shop: str, location: str) -> List[CategoryInfo]:
         shop_infos: List[ShopInfo] = list(filter(lambda x: x.location == location, silpo_shops.get(shop)))
@@ -242,18 +299,25 @@ class SilpoShopScrapperService(ShopScrapperService):
         else:
             logging.warning(f"Failed to find shop {shop}, location: {location}")
 
-    async def get_promotion_products(self, shop: str, location: str, page_count: int, per_page_product_count: int) -> \
-            Dict[
-                str, List[ProductInfo]]:
+    async def iter_promotion_products(self, shop: str, location: str, page_count: int, per_page_product_count: int,
+                                      fingerprints: FingerprintStage = None,
+                                      checkpoint: CrawlCheckpoint = None) -> AsyncIterator[
+        Tuple[str, List[ProductInfo]]]:
         shop_infos: List[ShopInfo] = list(filter(lambda x: x.location == location, silpo_shops.get(shop)))
         if not shop_infos:
-            return {}
+            return
 
         shop_info = shop_infos[0]
         categories: List[CategoryInfo] = await self.get_promotion_categories(shop=shop, location=location)
         product_web_url = "https://shop.silpo.ua/product/"
 
-        async def request_products(category: CategoryInfo):
+        async def request_products(category: CategoryInfo, conditional: bool = True):
+            # all products of a category are requested at once, as its first page
+            unit = (shop, location, category.id, 1)
+            saved_products = restore_page_products(checkpoint, unit)
+            if saved_products is not None:
+                return ProductListWithCategory(category=category, product_list=saved_products)
+
             payload = {
                 "method": "GetSimpleCatalogItems",
                 "data": {
@@ -278,12 +342,21 @@ class SilpoShopScrapperService(ShopScrapperService):
             }
 
             product_url = BASE_silpo_UA_URL
-            response = await get_http_response(product_url, headers={"Accept-Language": "uk"}, payload=payload,
-                                               method=HttpMethod.Post)
+            headers = {"Accept-Language": "uk"}
+            if conditional:
+                headers.update(conditional_headers(fingerprints, category.id))
+            response_info = await get_http_response_info(
+                product_url, headers=headers, payload=payload, method=HttpMethod.Post,
+                rate_limiter=get_rate_limiter(shop))
+            # the fingerprint is stored for unconditional requests as well, their products are kept anyway
+            if fingerprints is not None and not is_category_changed(fingerprints, category.id, response_info,
+                                                                    'items') and conditional:
+                return ProductListWithCategory(category=category, product_list=None)
+            response = response_info.get("response")
             if response:
                 shop_products: List[ProductInfoSilpoResponse] = parse_obj_as(List[ProductInfoSilpoResponse],
                                                                              response['items'])
-                return ProductListWithCategory(category=category, product_list=[
+                products = [
                     ProductInfo(title=product.name, category_id=category.id, price=product.price, weight=product.unit,
                                 slug=re.sub("-\d+$", "", category.slug), web_url=product_web_url + product.slug,
                                 promotion=PromoInfo(title=product.promoTitle,
@@ -300,12 +373,13 @@ class SilpoShopScrapperService(ShopScrapperService):
                                         0].value if product.parameters and list(
                                         filter(lambda x: x.key == "trademark", product.parameters)) else None))
                     for product in shop_products
-                ])
+                ]
+                record_page_products(checkpoint, unit, products)
+                return ProductListWithCategory(category=category, product_list=products)
             else:
                 logging.warning(f"Failed to parse products of category {category} of shop {shop}, location: {location}")
-                return None
-
-        results: Dict[str, List[ProductInfo]] = defaultdict(list)
+                record_page_products(checkpoint, unit, None)
+                return ProductListWithCategory(category=category, product_list=None)
 
         def get_categories(category: CategoryInfo):
             categories = []
@@ -326,16 +400,6 @@ class SilpoShopScrapperService(ShopScrapperService):
                     categories_ids.add(cat.id)
                     scrape_args.append(cat)
 
-        total_tasks = len(scrape_args)
-        print(f"Total amount of scrape tasks: {total_tasks}")
-        completed_tasks = 0
-        for args in chunks(scrape_args, 30):
-            for item in await asyncio.gather(
-                    *[asyncio.create_task(request_products(arg)) for arg in args]):
-                item: ProductListWithCategory
-                results[item.category.slug].extend(item.product_list)
-                completed_tasks += 1
-            print(f"Completed {round(completed_tasks / total_tasks * 100)}% of tasks")
-            await asyncio.sleep(2.5)
-
-        return results
+        async for slug, category_products in iter_slug_products(scrape_args, request_products, fingerprints,
+                                                                f"{shop}_{location}_promotion"):
+            yield slug, category_products
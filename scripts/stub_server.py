@@ -0,0 +1,15 @@
+from typing import Tuple
+
+from aiohttp import web
+
+
+async def start_stub_server(handler) -> Tuple[web.AppRunner, str]:
+    """Serves every path of a free local port by handler, returns the runner to clean up and the base url"""
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
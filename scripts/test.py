@@ -1,5 +1,47 @@
-from base_entities import SizeInfo, ProductInfo, SizeInfoType
-from helpers import parse_weight_info_with_validation, normalize_title, normalize_weight_info, get_products_buy_info
+import asyncio
+import itertools
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import List
+
+import aiohttp
+from aiohttp import web
+from yarl import URL
+
+from base_entities import SizeInfo, ProductInfo, SizeInfoType, CategoryInfo, ProducerInfo, BuyPreference, \
+    ProductsRequest, ProductBuyInfo
+import basket_optimizer
+from basket_optimizer import exact_search, local_search, evaluate_shops, plan_key
+from catalog_db import CatalogDatabase
+from catalog_storage import save_products_file, load_products_file
+from fingerprints import FingerprintStage
+from extensions import HttpClient, HttpMethod, RetryPolicy, get_http_response, get_http_response_info, \
+    parse_retry_after, in_flight_requests, as_completed_by_groups
+import helpers
+from main import form_optimized_cheque
+from helpers import parse_weight_info_with_validation, normalize_title, normalize_weight_info, get_products_buy_info, \
+    get_products_buy_infos
+from normalization import parse_weight_info
+from product_service import FileBaseProductService
+import rate_limiter as rate_limiter_module
+from rate_limiter import AdaptiveRateLimiter, ShopScrapingConfig, set_global_request_limit
+from serialization import dump, load_file
+from server import create_app
+from silpo_helper import ProductListWithCategory, iter_slug_products, silpo_shops
+from stub_server import start_stub_server
+import zakaz_helper
+from title_index import TitleIndex
+from html_tiles import html_parser_backends, parse_listing, ListingPage
+from checkpoints import CrawlCheckpoint
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'gets'))
+import jsonl_writer  # noqa: E402
+from jsonl_writer import JsonlWriter, JsonlStore, concat_lists  # noqa: E402
+from html_crawler import map_pages  # noqa: E402
 
 
 def test():
@@ -564,6 +606,573 @@ def test():
     output_buy_info = get_products_buy_info(ProductInfo.parse_obj(data33))
     print(output_buy_info.dict())
 
+
+async def check_http_retries():
+    requests = defaultdict(int)
+
+    async def faulty_handler(request: web.Request):
+        # every path fails in its own way, the first requests of a path fail and later ones succeed
+        requests[request.path_qs] += 1
+        count = requests[request.path_qs]
+        if request.path == "/flaky" and count <= 2:
+            return web.json_response({"error": "unavailable"}, status=503)
+        if request.path == "/throttled" and count == 1:
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        if request.path == "/broken":
+            return web.Response(status=500, text="<html>error</html>")
+        if request.path == "/missing":
+            return web.Response(status=404)
+        if request.path == "/truncated" and count == 1:
+            return web.Response(text='{"results": [', content_type="application/json")
+        if request.path == "/dropped" and count == 1:
+            request.transport.close()
+            return web.Response()
+        if request.path == "/slow":
+            await asyncio.sleep(0.2)
+        if request.path == "/down":
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return web.json_response({"path": request.path, "page": request.query.get("page")})
+
+    runner, base_url = await start_stub_server(faulty_handler)
+    retry_policy = RetryPolicy(backoff_base=0.01)
+    try:
+        async with HttpClient():
+            assert await get_http_response(base_url + "/flaky", retry_policy=retry_policy) == {"path": "/flaky", "page": None}
+            assert requests["/flaky"] == 3
+
+            start = time.monotonic()
+            assert await get_http_response(base_url + "/throttled", retry_policy=retry_policy) == {"path": "/throttled", "page": None}
+            assert requests["/throttled"] == 2 and time.monotonic() - start >= 1
+
+            response_info = await get_http_response_info(base_url + "/broken", retry_policy=retry_policy)
+            assert response_info["response"] is None and response_info["status"] == 500
+            assert requests["/broken"] == 1 + retry_policy.retry_budgets["server"]
+
+            response_info = await get_http_response_info(base_url + "/missing", retry_policy=retry_policy)
+            assert response_info["response"] is None and response_info["status"] == 404
+            assert requests["/missing"] == 1
+
+            assert await get_http_response(base_url + "/truncated", retry_policy=retry_policy) == {"path": "/truncated", "page": None}
+            assert requests["/truncated"] == 2
+
+            # aiohttp itself repeats idempotent requests on dropped connections, a POST is left to the retry policy
+            assert await get_http_response(base_url + "/dropped", payload={"page": 1}, method=HttpMethod.Post,
+                                           retry_policy=retry_policy) == {"path": "/dropped", "page": None}
+            assert requests["/dropped"] == 2
+
+            # identical requests in flight are sent once, other params are a separate request
+            responses = await asyncio.gather(*[get_http_response(base_url + "/slow", params={"page": "1"})
+                                               for _ in range(10)],
+                                             get_http_response(base_url + "/slow", params={"page": "2"}))
+            assert responses == [{"path": "/slow", "page": "1"}] * 10 + [{"path": "/slow", "page": "2"}]
+            assert requests["/slow?page=1"] == 1 and requests["/slow?page=2"] == 1
+            await get_http_response(base_url + "/slow", params={"page": "1"})
+            assert requests["/slow?page=1"] == 2
+
+            # callers with another retry policy do not share the request
+            await asyncio.gather(get_http_response(base_url + "/slow", params={"page": "3"}),
+                                 get_http_response(base_url + "/slow", params={"page": "3"}, retry_policy=retry_policy))
+            assert requests["/slow?page=3"] == 2
+
+            # the request stops retrying once all of its callers are cancelled
+            waiters = [asyncio.ensure_future(get_http_response(base_url + "/down", retry_policy=retry_policy))
+                       for _ in range(2)]
+            await asyncio.sleep(0.1)
+            for waiter in waiters:
+                waiter.cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+            assert not in_flight_requests
+            await asyncio.sleep(1.5)
+            assert requests["/down"] == 1
+    finally:
+        await runner.cleanup()
+
+
+def test_normalization():
+    # outputs of the helpers before the patterns were precompiled, quirks included
+    titles = {
+        ("Цукор Dr.Oetker ванільний 8г", "Dr.Oetker"): "цукор ванільний",
+        ("Яйця курячі С1 «Квочка»", "Квочка"): "яйця курячі с1",
+        ("Молоко «Сто пудов» сухе 1,5%", "Сто пудів"): "молоко сто пудов сухе",
+        ("Молоко Яготинське для дітей від 9 місяців 3,2% 950г", "Яготинське для дітей"): "молоко від 9 місяців",
+        ("Олія соняшникова Олейна Пресова рафінована 1,8л", "Олейна"): "олія соняшникова пресова рафінована",
+        ("Напій Coca-Cola Zero+ 0,33л", "Zero+"): "напій coca-cola",
+        ("Сир (твердий) Комо [Пармезан] 45% 200г", ""): "сир твердий пармезан",
+        ("Вода Моршинська №1 негазована 6 шт х 1,5л", ""): "вода негазована 6 шт х",
+    }
+    for (title, brand), normalized_title in titles.items():
+        assert normalize_title(title, brand) == normalized_title, title
+
+    amounts = {
+        "0,5л": SizeInfo(value=0.5, unit="л", type=SizeInfoType.Capacity),
+        "250 мл": SizeInfo(value=250, unit="мл", type=SizeInfoType.Capacity),
+        "1.5кг": SizeInfo(value=1.5, unit="кг", type=SizeInfoType.Mass),
+        "10шт": SizeInfo(value=10, unit="шт", type=SizeInfoType.Quantity),
+        "2х100г": SizeInfo(value=200, unit="г", type=SizeInfoType.Mass),
+        "": SizeInfo(value=1, unit="", type=SizeInfoType.Quantity),
+        "12": SizeInfo(value=12, unit="", type=SizeInfoType.Quantity),
+    }
+    for amount, weight_info in amounts.items():
+        assert parse_weight_info(amount) == weight_info, amount
+
+    products = [
+        ({"title": "Вода Моршинська №1 негазована 6 шт х 1,5л", "weight": "1,5л"},
+         SizeInfo(value=6, unit="л", type=SizeInfoType.Capacity)),
+        ({"title": "Оцет Colavita винний бiлий 5,4% 0,5л", "weight": "500.0", "volume": 500.0, "bundle": 1,
+          "weight_info": {"value": 500.0, "unit": "мл", "type": "capacity"}},
+         SizeInfo(value=0.5, unit="л", type=SizeInfoType.Capacity)),
+        ({"title": "Банани", "weight": "", "bundle": 1, "unit": "kg"},
+         SizeInfo(value=1, unit="kg", type=SizeInfoType.Mass)),
+        ({"title": "Цибуля зелена", "weight": "250.0", "weight_info": {"value": 250.0, "unit": "", "type": "quantity"}},
+         SizeInfo(value=250, unit="г", type=SizeInfoType.Mass)),
+        ({"title": "Олія лляна", "weight": "", "volume": 0.5, "weight_info": {"value": 0.5, "unit": "", "type": "capacity"}},
+         SizeInfo(value=0.5, unit="л", type=SizeInfoType.Capacity)),
+    ]
+    for product, weight_info in products:
+        assert parse_weight_info_with_validation(ProductInfo.parse_obj({**product, "producer": {}})) == weight_info, \
+            product["title"]
+    print("normalization ok")
+
+
+def test_title_index():
+    product_keys = ["молоко пастеризоване ", "кокосове молоко ", "молоко ", "молоко згущене з цукром ",
+                    "хліб житній край нарізаний ", "хліб ", "житній хліб ", "сир твердий пармезан ", "пармезан "]
+    title_index = TitleIndex.construct(**TitleIndex.build(product_keys).dict())
+    # prefixes, suffixes, whole words and several words are matched as a substring followed by a space
+    title_filters = ["молоко", "моло", "локо", "ко", "ко молоко", "молоко згущене", "згущене з цукром", "хліб",
+                     "житній хліб", "ній хліб", "ній край", "хліб житній край", "пармезан", "сир пармезан", "ян",
+                     "молоко молоко", ""]
+    for title_filter in title_filters:
+        expected = [product_key for product_key in product_keys if title_filter + " " in product_key]
+        assert title_index.match(title_filter) == expected, title_filter
+        assert {product_keys.index(product_key) for product_key in expected} <= \
+               title_index.find_candidates(title_filter), title_filter
+    print("title index ok")
+
+
+def test_products_buy_infos():
+    sizes = [(500, "г", SizeInfoType.Mass, 1), (1, "кг", SizeInfoType.Mass, 1), (250, "г", SizeInfoType.Mass, 2),
+             (1, "л", SizeInfoType.Capacity, 1), (330, "мл", SizeInfoType.Capacity, 6), (10, "шт", SizeInfoType.Quantity, 1),
+             (2, "м", SizeInfoType.Length, 1), (0, "", SizeInfoType.Quantity, 1), (200, "г", SizeInfoType.Mass, None),
+             (0, "г", SizeInfoType.Mass, 3)]
+    # equal prices give ties in end price, which keep the order of the products
+    products = [ProductInfo(title=f"product {index}", price=[20, 35.5, 20, 80, 10][index % 5], bundle=bundle,
+                            weight_info=SizeInfo(value=value, unit=unit, type=size_type), producer=ProducerInfo())
+                for index, (value, unit, size_type, bundle) in enumerate(sizes * 2)]
+
+    def priced(product_buy_infos):
+        return [(buy_info.product.title, buy_info.end_price, buy_info.quantity) for buy_info in product_buy_infos]
+
+    for min_size in ["", "1кг", "750г", "2л", "500мл", "3шт", "5м"]:
+        scalar = [get_products_buy_info(product, min_size) for product in products]
+        for top_k in [None, 1, 3]:
+            expected = scalar if top_k is None else sorted(scalar, key=lambda buy_info: buy_info.end_price)[:top_k]
+            assert priced(get_products_buy_infos(products, min_size, top_k)) == priced(expected), (min_size, top_k)
+            numpy = helpers.np
+            helpers.np = None
+            try:
+                assert priced(get_products_buy_infos(products, min_size, top_k)) == priced(expected), (min_size, top_k)
+            finally:
+                helpers.np = numpy
+    print("products buy infos ok")
+
+
+def test_basket_optimizer():
+    inf = math.inf
+    costs = [[10, 12, 9.5, inf], [20, inf, 25, 18], [5, 4.5, inf, 6], [inf, 30, 31, inf], [7, 7, 7, 6.5]]
+    for shop_fee, max_shops in [(0, 4), (0, 1), (3, 2), (10, 4), (2.5, 3)]:
+        brute_force = min((evaluate_shops(costs, list(shops)) for size in range(1, max_shops + 1)
+                           for shops in itertools.combinations(range(4), size)),
+                          key=lambda plan: plan_key(plan, shop_fee))
+        exact = exact_search(costs, shop_fee, max_shops)
+        assert plan_key(exact, shop_fee) == plan_key(brute_force, shop_fee), (shop_fee, max_shops)
+        # local search may stop in a local optimum, never below the exhaustive one
+        assert plan_key(exact, shop_fee) <= plan_key(local_search(costs, shop_fee, max_shops), shop_fee)
+
+        # subsets searched in chunks of two shops pick the same plan as a single chunk
+        chunk_cells = basket_optimizer.exact_search_chunk_cells
+        basket_optimizer.exact_search_chunk_cells = 4 * len(costs)
+        try:
+            assert exact_search(costs, shop_fee, max_shops) == exact, (shop_fee, max_shops)
+        finally:
+            basket_optimizer.exact_search_chunk_cells = chunk_cells
+
+    buy_preference = BuyPreference(title_filter="молоко")
+    user_basket = {shop: [ProductsRequest(request=buy_preference, product_buy_infos=[ProductBuyInfo(
+        product=ProductInfo(title="Молоко", price=price, producer=ProducerInfo()), quantity=1, end_price=price)])]
+                   for shop, price in [("silpo", 30.75), ("novus", 31.2)]}
+    cheque = form_optimized_cheque(user_basket, 0.5, None)
+    assert cheque.shops == ["silpo"] and cheque.end_price == 31.25
+    print("basket optimizer ok")
+
+
+def test_listing_fixtures():
+    pages_dir = os.path.join(os.path.dirname(__file__), '..', 'gets', 'fixtures', 'listing_pages')
+    # tiles, unavailable tiles, tiles without a price and pages of the (sub)category of every saved listing page
+    expected = {"novus_926eb9c8068d11f9.html": (30, 3, 3, 3), "novus_08208773d6c1711a.html": (14, 2, 1, 3),
+                "metro_595ae10dc6891af7.html": (18, 2, 2, 1), "auchan_6ad05f54f87b9770.html": (10, 1, 1, 2)}
+    for page_name, (tiles_count, unavailable_count, without_price_count, pages_count) in expected.items():
+        with open(os.path.join(pages_dir, page_name), encoding='utf-8') as f:
+            page_html = f.read()
+        listings = [parse_listing(page_html, backend) for backend in html_parser_backends]
+        assert all(listing == listings[0] for listing in listings), page_name
+        tiles = listings[0].tiles
+        assert (len(tiles), len([tile for tile in tiles if not tile.available]),
+                len([tile for tile in tiles if tile.price is None]), listings[0].pages_count()) == \
+               (tiles_count, unavailable_count, without_price_count, pages_count), page_name
+        assert all(tile.title and tile.href and tile.weight for tile in tiles), page_name
+    print("listing fixtures ok")
+
+
+def test_http_retries():
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
+    asyncio.run(check_http_retries())
+    print("http retries ok")
+
+
+async def check_rate_limiter():
+    rate_limiter = AdaptiveRateLimiter("stub", ShopScrapingConfig(max_request_batch=4, timeout=0.1, latency_window=3))
+
+    # a fast 304 is no latency sample, a slower server becomes the baseline once the fast samples leave the window
+    await rate_limiter.acquire()
+    await rate_limiter.release(304, 0.001, False)
+    for _ in range(10):
+        await rate_limiter.acquire()
+        await rate_limiter.release(200, 0.5)
+    assert rate_limiter.concurrency == rate_limiter.max_concurrency
+
+    # growing latency lowers both concurrency and rate
+    rate = rate_limiter.rate
+    for latency in [5, 5]:
+        await rate_limiter.acquire()
+        await rate_limiter.release(200, latency)
+    assert rate_limiter.concurrency < rate_limiter.max_concurrency and rate_limiter.rate < rate
+
+    # a request cancelled while waiting for a token gives its slot back
+    rate_limiter.tokens = 0
+    waiter = asyncio.ensure_future(rate_limiter.acquire())
+    await asyncio.sleep(0.01)
+    assert rate_limiter.in_flight == 1
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    assert rate_limiter.in_flight == 0
+
+    # a permit goes back to the global limit it was taken from, even when the limit was replaced meanwhile
+    rate_limiter.tokens = rate_limiter.max_concurrency
+    set_global_request_limit(1)
+    first_limit = rate_limiter_module.global_request_limit
+    global_limit = await rate_limiter.acquire()
+    set_global_request_limit(1)
+    await rate_limiter.release(200, 0.5, global_limit=global_limit)
+    assert not first_limit.locked() and not rate_limiter_module.global_request_limit.locked()
+    set_global_request_limit(None)
+
+
+def test_rate_limiter():
+    asyncio.run(check_rate_limiter())
+    print("rate limiter ok")
+
+
+async def check_completed_by_groups():
+    pages_in_flight = defaultdict(int)
+    max_open_groups = 0
+
+    async def page(group: int, delay: float):
+        nonlocal max_open_groups
+        pages_in_flight[group] += 1
+        max_open_groups = max(max_open_groups, len(pages_in_flight))
+        await asyncio.sleep(delay)
+        pages_in_flight[group] -= 1
+        if not pages_in_flight[group]:
+            del pages_in_flight[group]
+        return group
+
+    groups = [[page(group, 0.01 * (index + 1)) for index in range(3)] for group in range(5)] + [[]]
+    results = [group async for group in as_completed_by_groups(groups, 2)]
+    assert sorted(results) == sorted(group for group in range(5) for _ in range(3))
+    # a group starts only when an open group completed, so at most two groups have pages in flight
+    assert max_open_groups <= 2
+    for group in range(5):
+        assert results.count(group) == 3
+
+    # an abandoned stream cancels its pending pages and closes the pages which were never scheduled
+    groups = [[page(group, 0.01)] for group in range(3)]
+    stream = as_completed_by_groups(groups, 1)
+    assert await stream.__anext__() == 0
+    await stream.aclose()
+    assert all(coroutine.cr_frame is None for coroutine in groups[2])
+
+
+def test_completed_by_groups():
+    asyncio.run(check_completed_by_groups())
+    print("completed by groups ok")
+
+
+async def check_silpo_slug_products():
+    categories = [CategoryInfo(id="1", title="milk", slug="milk"), CategoryInfo(id="2", title="milk", slug="milk"),
+                  CategoryInfo(id="3", title="bread", slug="bread")]
+    unchanged_ids = {"2", "3"}
+    requests = []
+
+    async def request_products(category: CategoryInfo, conditional: bool):
+        requests.append((category.id, conditional))
+        if conditional and category.id in unchanged_ids:
+            return ProductListWithCategory(category=category, product_list=None)
+        return ProductListWithCategory(category=category, product_list=[
+            ProductInfo(title=f"product {category.id}", category_id=category.id, producer=ProducerInfo())])
+
+    # an unchanged category is requested again when another category of its slug changed
+    fingerprints = FingerprintStage({})
+    saved = {slug: products async for slug, products in iter_slug_products(categories, request_products, fingerprints,
+                                                                           "test")}
+    assert {slug: sorted(product.category_id for product in products) for slug, products in saved.items()} == \
+           {"milk": ["1", "2"]}
+    assert sorted(requests) == [("1", True), ("2", False), ("2", True), ("3", True)]
+
+
+def test_silpo_slug_products():
+    asyncio.run(check_silpo_slug_products())
+    print("silpo slug products ok")
+
+
+async def check_zakaz_incremental_products():
+    category_products = {category_id: [{"title": f"{category_id} {index}", "price": 100, "producer": {}}
+                                       for index in range(5)] for category_id in ["milk", "bread"]}
+
+    failed_pages = set()
+
+    async def zakaz_handler(request: web.Request):
+        parts = request.path.strip('/').split('/')
+        if parts[-1] == "categories":
+            return web.json_response([{"id": category_id, "title": category_id} for category_id in category_products])
+        products = category_products[parts[-2]]
+        page, per_page = int(request.query["page"]), int(request.query["per_page"])
+        if (parts[-2], page) in failed_pages:
+            return web.Response(status=404)
+        return web.json_response({"count": len(products), "results": products[(page - 1) * per_page:page * per_page]})
+
+    runner, base_url = await start_stub_server(zakaz_handler)
+    base_zakaz_url = zakaz_helper.BASE_ZAKAZ_UA_URL
+    zakaz_helper.BASE_ZAKAZ_UA_URL = base_url
+    service = zakaz_helper.ZakazoShopScrapperService()
+    saved_fingerprints = {}
+
+    async def crawl():
+        fingerprints = FingerprintStage(saved_fingerprints)
+        # pages of a category arrive in any order
+        scraped = {category_id: sorted(product.title for product in products) async for category_id, products in
+                   service.iter_products("novus", "default", 3, 2, fingerprints=fingerprints)}
+        for category_id in scraped:
+            fingerprints.commit(category_id)
+        return scraped
+
+    try:
+        async with HttpClient():
+            assert await crawl() == {category_id: [product["title"] for product in products]
+                                     for category_id, products in category_products.items()}
+            assert await crawl() == {}
+            # a changed category is scraped again with all of its pages
+            category_products["milk"][0]["title"] = "milk new"
+            assert await crawl() == {"milk": ["milk 1", "milk 2", "milk 3", "milk 4", "milk new"]}
+            # a category saved with a failed page keeps its previous fingerprint, so the next crawl scrapes it again
+            category_products["milk"][0]["title"] = "milk newer"
+            failed_pages.add(("milk", 2))
+            assert await crawl() == {"milk": ["milk 1", "milk 4", "milk newer"]}
+            failed_pages.clear()
+            assert await crawl() == {"milk": ["milk 1", "milk 2", "milk 3", "milk 4", "milk newer"]}
+            assert await crawl() == {}
+    finally:
+        zakaz_helper.BASE_ZAKAZ_UA_URL = base_zakaz_url
+        await runner.cleanup()
+
+
+def test_zakaz_incremental_products():
+    asyncio.run(check_zakaz_incremental_products())
+    print("zakaz incremental products ok")
+
+
+def test_catalog_db_cheapest():
+    def product(normalized_title: str, price: float) -> ProductInfo:
+        return ProductInfo(title=normalized_title, normalized_title=normalized_title, price=price, bundle=1,
+                           weight_info=SizeInfo(value=1, unit="л", type=SizeInfoType.Capacity), producer=ProducerInfo())
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        with CatalogDatabase(os.path.join(data_dir, "catalog.db")) as catalog_database:
+            # the index matches titles regardless of case, the cheaper upper-case titles do not count for the limit
+            catalog_database.write_category("novus", "default", False, "dairy", {
+                title: product(title, price) for title, price in
+                [("МОЛОКО 1 ", 10), ("МОЛОКО 2 ", 10), ("молоко b ", 20), ("молоко a ", 20)]})
+            catalog_database.write_category("metro", "default", False, "dairy", {"молоко c ": product("молоко c ", 20)})
+            cheapest = catalog_database.find_cheapest("молоко", limit=3)
+            assert [(shop, product.normalized_title) for shop, product in cheapest] == \
+                   [("metro", "молоко c "), ("novus", "молоко b "), ("novus", "молоко a ")]
+    print("catalog db cheapest ok")
+
+
+def test_lazy_products():
+    with tempfile.TemporaryDirectory() as category_dir:
+        products = {f"молоко {index} ": ProductInfo(title=f"Молоко {index}", normalized_title=f"молоко {index} ",
+                                                    price=index, producer=ProducerInfo()) for index in range(3)}
+        save_products_file(category_dir, "", products)
+        lazy_products = load_products_file(category_dir)
+        assert list(lazy_products) == list(products) and lazy_products["молоко 1 "] == products["молоко 1 "]
+        # products loaded before the file is replaced by a new crawl are still decoded from the old file
+        save_products_file(category_dir, "", {"хліб ": ProductInfo(title="Хліб", producer=ProducerInfo())})
+        assert lazy_products["молоко 2 "] == products["молоко 2 "]
+        assert list(load_products_file(category_dir)) == ["хліб "]
+    print("lazy products ok")
+
+
+def test_file_product_service():
+    with tempfile.TemporaryDirectory() as data_dir:
+        # silpo shops have no name, categories sharing a slug are saved to the directory of the slug
+        shop_dir = os.path.join(data_dir, "silpo", "default")
+        os.makedirs(os.path.join(shop_dir, "milk"))
+        with open(os.path.join(shop_dir, "raw_categories_info.json"), 'wb') as f:
+            dump([{"id": "1", "title": "milk", "slug": "milk"}, {"id": "2", "title": "milk", "slug": "milk"}], f)
+        with open(os.path.join(shop_dir, "promotion_products_categories.json"), 'wb') as f:
+            dump({"молоко ": ["milk"]}, f)
+        save_products_file(os.path.join(shop_dir, "milk"), "", {"молоко ": ProductInfo(
+            title="Молоко", normalized_title="молоко ", category_id="2", producer=ProducerInfo())})
+
+        product_service = FileBaseProductService(data_dir)
+        silpo = silpo_shops["silpo"][0]
+        categories = product_service.get_categories(silpo)
+        assert [category.id for category in categories] == ["1", "2"]
+        assert [product.title for product in product_service.get_products(silpo, categories[0])] == ["Молоко"]
+        assert product_service.get_shop_locations(silpo) == ["default"]
+        assert [category.id for category in product_service.get_promotion_categories(silpo)] == ["1", "2"]
+    print("file product service ok")
+
+
+async def check_server_products():
+    with tempfile.TemporaryDirectory() as data_dir:
+        shop_dir = os.path.join(data_dir, "silpo", "default")
+        os.makedirs(os.path.join(shop_dir, "milk"))
+        save_products_file(os.path.join(shop_dir, "milk"), "", {"молоко ": ProductInfo(
+            title="Молоко", normalized_title="молоко ", category_id="1", price=30, producer=ProducerInfo(),
+            weight_info=SizeInfo(value=1, unit="л", type=SizeInfoType.Capacity))})
+        with open(os.path.join(shop_dir, "products_categories.json"), 'wb') as f:
+            dump({"молоко ": ["milk"]}, f)
+
+        runner = web.AppRunner(create_app(data_dir, reload_interval=0), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        base_url = f"http://{host}:{port}/shops/silpo"
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"{base_url}/products", params={"title_filter": "молоко", "top_k": "1"}) as r:
+                    assert r.status == 200 and [buy_info["product"]["title"] for buy_info in await r.json()] == \
+                           ["Молоко"]
+                async with session.get(f"{base_url}/products", params={"title_filter": "молоко", "top_k": "one"}) as r:
+                    assert r.status == 400
+                async with session.get(f"{base_url}/categories/milk/products") as r:
+                    assert r.status == 200 and len(await r.json()) == 1
+                for category_id in ["..", "..%2F..%2Fsilpo", "milk%5C..", "%2E%2E"]:
+                    async with session.get(URL(f"{base_url}/categories/{category_id}/products", encoded=True)) as r:
+                        assert r.status == 400, category_id
+        finally:
+            await runner.cleanup()
+
+
+def test_server_products():
+    asyncio.run(check_server_products())
+    print("server products ok")
+
+
+def test_jsonl_writer():
+    with tempfile.TemporaryDirectory() as data_dir:
+        path = os.path.join(data_dir, "titles.json")
+        with open(path, 'wb') as f:
+            dump(["Хліб"], f)
+
+        # records are appended to the journal, which refers to the file of the previous crawl instead of copying it
+        writer = JsonlWriter(path, concat_lists, list).open()
+        writer.append(["Молоко"], "page 1")
+        writer.append(["Молоко"], "page 1")
+        writer.append(["Сир"], "page 2")
+        with open(path + jsonl_writer.journal_suffix, 'rb') as f:
+            header, *records = f.read().splitlines()
+        assert "Хліб".encode() not in header and len(records) == 2
+        assert load_file(path) == ["Хліб"]
+
+        # a crash keeps the journal, reopening it folds its records into the file again and drops a torn line
+        writer.journal.close()
+        with open(path + jsonl_writer.journal_suffix, 'ab') as f:
+            f.write(b'{"key": "page 3", "rec')
+        writer = JsonlWriter(path, concat_lists, list).open()
+        assert writer.value == ["Хліб", "Молоко", "Сир"] and writer.keys == {"page 1", "page 2"}
+
+        # a journal outgrowing the file is compacted into it and started again with the keys of the records
+        min_bytes = jsonl_writer.compact_min_bytes
+        jsonl_writer.compact_min_bytes = 0
+        try:
+            writer.append(["Кефір " * 10], "page 3")
+        finally:
+            jsonl_writer.compact_min_bytes = min_bytes
+        assert load_file(path) == ["Хліб", "Молоко", "Сир", "Кефір " * 10] and writer.journal_bytes == 0
+        writer.append(["Масло"], "page 4")
+        writer.journal.close()
+        writer = JsonlWriter(path, concat_lists, list).open()
+        writer.append(["Сир"], "page 2")
+        assert writer.value == ["Хліб", "Молоко", "Сир", "Кефір " * 10, "Масло"]
+
+        # records of a journal are not folded twice after a crash between a compaction and the new journal
+        writer.compact()
+        writer.journal.close()
+        writer = JsonlWriter(path, concat_lists, list).open()
+        assert writer.value == ["Хліб", "Молоко", "Сир", "Кефір " * 10, "Масло"] and "page 4" in writer.keys
+        writer.close()
+        assert load_file(path) == writer.value and not os.path.isfile(path + jsonl_writer.journal_suffix)
+    print("jsonl writer ok")
+
+
+def test_jsonl_resume():
+    with tempfile.TemporaryDirectory() as data_dir:
+        path = os.path.join(data_dir, "titles.json")
+        urls = [f"https://novus.zakaz.ua/uk/categories/milk-novus/?page={page}" for page in range(1, 5)]
+        pages = {url: ListingPage(tiles=[], products_count=None, last_page=None) for url in urls}
+
+        def crawl(store: JsonlStore, checkpoint: CrawlCheckpoint, page_urls: List[str]) -> List[str]:
+            def parse(page: ListingPage, url: str) -> str:
+                store.append(path, [url], url)
+                return url
+            return asyncio.run(map_pages(page_urls, parse, checkpoint, pages))
+
+        checkpoint_path = os.path.join(data_dir, "checkpoint.jsonl")
+        store = JsonlStore(concat_lists, list)
+        with CrawlCheckpoint(checkpoint_path) as checkpoint:
+            assert crawl(store, checkpoint, urls[:2]) == urls[:2]
+        # the third page is written to the journal but the crawl is killed before the checkpoint records it
+        store.append(path, [urls[2]], urls[2])
+        store.writers[path].journal.close()
+
+        store = JsonlStore(concat_lists, list)
+        with CrawlCheckpoint(checkpoint_path) as checkpoint:
+            assert crawl(store, checkpoint, urls) == urls[2:]
+        assert store.close(path) == urls and load_file(path) == urls
+    print("jsonl resume ok")
+
+
 if __name__ =="__main__":
     test()
-
+    test_normalization()
+    test_title_index()
+    test_products_buy_infos()
+    test_basket_optimizer()
+    test_listing_fixtures()
+    test_http_retries()
+    test_rate_limiter()
+    test_completed_by_groups()
+    test_silpo_slug_products()
+    test_zakaz_incremental_products()
+    test_catalog_db_cheapest()
+    test_lazy_products()
+    test_jsonl_writer()
+    test_jsonl_resume()
+    test_file_product_service()
+    test_server_products()
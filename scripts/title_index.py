@@ -0,0 +1,74 @@
+import logging
+import os
+from bisect import bisect_left
+from collections import defaultdict
+from typing import List, Dict, Set, Iterable, Iterator, Optional
+
+from pydantic import BaseModel, PrivateAttr
+
+from catalog_storage import atomic_write
+from serialization import dump, load_file
+
+
+class TitleIndex(BaseModel):
+    """
+    Token -> product ids index of normalized product titles, ids are positions of titles in products_categories.json.
+    """
+    product_keys: List[str]
+    tokens: Dict[str, List[int]]
+    # tokens spelled backwards and sorted, tokens ending with a suffix are a range starting with the reversed suffix.
+    # It is sorted on the first lookup, which costs O(V log V) for V distinct tokens once per loaded index
+    _reversed_tokens: Optional[List[str]] = PrivateAttr(None)
+
+    @classmethod
+    def build(cls, product_keys: Iterable[str]) -> "TitleIndex":
+        product_keys = list(product_keys)
+        tokens: Dict[str, List[int]] = defaultdict(list)
+        for product_id, product_key in enumerate(product_keys):
+            for token in set(product_key.split(" ")):
+                if token:
+                    tokens[token].append(product_id)
+        return cls.construct(product_keys=product_keys, tokens=dict(tokens))
+
+    def tokens_ending_with(self, suffix: str) -> Iterator[str]:
+        if self._reversed_tokens is None:
+            self._reversed_tokens = sorted(token[::-1] for token in self.tokens)
+        reversed_suffix = suffix[::-1]
+        position = bisect_left(self._reversed_tokens, reversed_suffix)
+        while position < len(self._reversed_tokens) and self._reversed_tokens[position].startswith(reversed_suffix):
+            yield self._reversed_tokens[position][::-1]
+            position += 1
+
+    def find_candidates(self, title_filter: str) -> Set[int]:
+        filter_tokens = title_filter.split(" ")
+        if "" in filter_tokens:
+            return set(range(len(self.product_keys)))
+
+        # the first filter word may start in the middle of a title word, the following ones match whole words
+        candidates: Set[int] = set()
+        for token in self.tokens_ending_with(filter_tokens[0]):
+            candidates.update(self.tokens[token])
+        for filter_token in filter_tokens[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(self.tokens.get(filter_token, []))
+        return candidates
+
+    def match(self, title_filter: str) -> List[str]:
+        """Product keys in products_categories.json order which contain `title_filter` followed by a space"""
+        pattern = title_filter + " "
+        return [self.product_keys[product_id] for product_id in sorted(self.find_candidates(title_filter))
+                if pattern in self.product_keys[product_id]]
+
+
+def save_title_index(path: str, product_keys: Iterable[str]):
+    with atomic_write(path, 'wb') as f:
+        dump(TitleIndex.build(product_keys).dict(), f, indent=False)
+
+
+def load_title_index(path: str, navigator_path: str) -> TitleIndex:
+    """Loads the index saved next to products_categories.json, a missing or outdated one is rebuilt in memory"""
+    if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(navigator_path):
+        return TitleIndex.construct(**load_file(path))
+    logging.info(f"Title index {path} is missing or outdated, building it from {navigator_path}")
+    return TitleIndex.build(load_file(navigator_path).keys())
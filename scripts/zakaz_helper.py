@@ -1,15 +1,18 @@
-import asyncio
 import logging
-from collections import namedtuple, defaultdict
-from typing import List, Dict, Optional
+import math
+from collections import namedtuple
+from typing import List, Dict, Optional, AsyncIterator, Tuple
 
 import datefinder
 from pydantic import parse_obj_as, BaseModel
 
 from base_entities import CategoryInfo, ProductInfo, PromoInfo
+from checkpoints import CrawlCheckpoint
 from constants import BASE_ZAKAZ_UA_URL
-from extensions import get_http_response, chunks
-from helpers import ShopScrapperService
+from extensions import get_http_response, get_http_response_info, as_completed_with_progress, as_completed_by_groups
+from fingerprints import FingerprintStage, conditional_headers, is_category_changed
+from service_base import ShopScrapperService, CategoryStreamBuffer, restore_page_products, record_page_products
+from rate_limiter import get_rate_limiter
 from zakaz_shops import zakaz_shops, ShopInfo
 
 ProductListWithCategory = namedtuple('ProductListWithCategory', ['category', 'product_list'])
@@ -50,30 +53,46 @@ class ZakazoShopScrapperService(ShopScrapperService):
         else:
             logging.warning(f"Failed to find shop {shop}, location: {location}")
 
-    async def get_products(self, shop: str, location: str, page_count: int, per_page_product_count: int) -> Dict[
-        str, List[ProductInfo]]:
+    async def iter_products(self, shop: str, location: str, page_count: int, per_page_product_count: int,
+                            fingerprints: FingerprintStage = None,
+                            checkpoint: CrawlCheckpoint = None) -> AsyncIterator[
+        Tuple[str, List[ProductInfo]]]:
         shop_infos: List[ShopInfo] = list(filter(lambda x: x.location == location, zakaz_shops.get(shop)))
         if not shop_infos:
-            return {}
+            return
 
         shop_info = shop_infos[0]
         categories: List[CategoryInfo] = await self.get_categories(shop=shop, location=location, popular=False)
 
-        async def get_page_products(page: int, category: CategoryInfo):
+        async def get_page_products(page: int, category: CategoryInfo, check_fingerprint: bool = False):
+            unit = (shop, location, category.id, page)
+            saved_products = restore_page_products(checkpoint, unit)
+            if saved_products is not None:
+                return ProductListWithCategory(category=category, product_list=saved_products)
+
             params = {'page': page, 'per_page': str(per_page_product_count)}
+            headers = {"Accept-Language": "uk"}
+            if check_fingerprint:
+                headers.update(conditional_headers(fingerprints, category.id))
 
             product_url = f"{BASE_ZAKAZ_UA_URL}/{shop_info.id}/categories/{category.id}/products/"
-            response = await get_http_response(product_url, headers={"Accept-Language": "uk"}, params=params)
+            response_info = await get_http_response_info(product_url, headers=headers, params=params,
+                                                          rate_limiter=get_rate_limiter(shop))
+            if check_fingerprint and not is_category_changed(fingerprints, category.id, response_info, 'results'):
+                return ProductListWithCategory(category=category, product_list=None)
+            response = response_info.get("response")
             if response:
                 shop_products: List[ProductInfo] = parse_obj_as(List[ProductInfo], response['results'])
                 for product in shop_products:
                     product.price /= 100
+                record_page_products(checkpoint, unit, shop_products)
                 return ProductListWithCategory(category=category, product_list=shop_products)
             else:
                 logging.warning(f"Failed to parse products of category {category} of shop {shop}, location: {location}")
-                return None
+                record_page_products(checkpoint, unit, None)
+                return ProductListWithCategory(category=category, product_list=None)
 
-        results: Dict[str, List[ProductInfo]] = defaultdict(list)
+        results = CategoryStreamBuffer()
 
         def get_categories(category: CategoryInfo):
             categories = []
@@ -95,23 +114,48 @@ class ZakazoShopScrapperService(ShopScrapperService):
                     categories_ids.add(cat.id)
                     categories_flat.append(cat)
 
-        for page in range(1, page_count + 1):
-            for cat in list(categories_flat):
-                scrape_args.append({"page": page, "category": cat})
-
-        total_tasks = len(scrape_args)
-        print(f"Total amount of scrape tasks: {total_tasks},  categories: {len(categories_flat)}")
-        completed_tasks = 0
-        for args in chunks(scrape_args, 10):
-            for item in await asyncio.gather(
-                    *[asyncio.create_task(get_page_products(arg.get("page"), arg.get("category"))) for arg in args]):
+        first_page = 1
+        if fingerprints is not None:
+            # first pages tell which categories changed since the previous crawl, only those are scraped further
+            print(f"Checking fingerprints of {len(categories_flat)} categories")
+            changed_categories = []
+            async for item in as_completed_with_progress(
+                    [get_page_products(1, cat, check_fingerprint=True) for cat in categories_flat],
+                    name=f"{shop}_{location}_fingerprints"):
                 item: ProductListWithCategory
-                results[item.category.id].extend(item.product_list)
-                completed_tasks += 1
-            print(f"Completed {round(completed_tasks / total_tasks * 100)}% of tasks")
-            await asyncio.sleep(2.5)
+                if item and item.product_list is not None:
+                    changed_categories.append(item.category)
+                    # all pages of a changed category are expected with its first one, the rest are requested below
+                    results.expect(item.category.id, page_count)
+                    category_products = results.add(item.category.id, item.product_list)
+                    if category_products is not None:
+                        fingerprints.category_scraped(item.category.id, [item.category.id], True)
+                        yield item.category.id, category_products
+            print(f"Changed categories: {len(changed_categories)} of {len(categories_flat)}")
+            categories_flat = changed_categories
+            first_page = 2
 
-        return results
+        for cat in list(categories_flat):
+            if fingerprints is None:
+                results.expect(cat.id, page_count)
+            scrape_args.append([{"page": page, "category": cat} for page in range(first_page, page_count + 1)])
+
+        # only a window of categories is requested at a time, it keeps the rate limiter busy while the buffered
+        # pages stay bounded by the window instead of the whole catalog
+        category_pages = max(page_count - first_page + 1, 1)
+        max_open_categories = math.ceil(2 * get_rate_limiter(shop).max_concurrency / category_pages)
+        total_tasks = sum(len(category_args) for category_args in scrape_args)
+        print(f"Total amount of scrape tasks: {total_tasks},  categories: {len(categories_flat)}")
+        async for item in as_completed_by_groups(
+                [[get_page_products(arg.get("page"), arg.get("category")) for arg in category_args]
+                 for category_args in scrape_args], max_open_categories, name=f"{shop}_{location}"):
+            item: ProductListWithCategory
+            category_products = results.add(item.category.id, item.product_list)
+            if category_products is not None:
+                if fingerprints is not None:
+                    fingerprints.category_scraped(item.category.id, [item.category.id],
+                                                  item.category.id not in results.failed_categories)
+                yield item.category.id, category_products
 
     async def get_promotion_categories(self, shop: str, location: str) -> List[CategoryInfo]:
         shop_infos: List[ShopInfo] = list(filter(lambda x: x.location == location, zakaz_shops.get(shop)))
@@ -138,20 +182,33 @@ class ZakazoShopScrapperService(ShopScrapperService):
         else:
             logging.warning(f"Failed to find shop {shop}, location: {location}")
 
-    async def get_promotion_products(self, shop: str, location: str, page_count: int, per_page_product_count: int) -> Dict[
-        str, List[ProductInfo]]:
+    async def iter_promotion_products(self, shop: str, location: str, page_count: int, per_page_product_count: int,
+                                      fingerprints: FingerprintStage = None,
+                                      checkpoint: CrawlCheckpoint = None) -> AsyncIterator[
+        Tuple[str, List[ProductInfo]]]:
         shop_infos: List[ShopInfo] = list(filter(lambda x: x.location == location, zakaz_shops.get(shop)))
         if not shop_infos:
-            return {}
+            return
 
         shop_info = shop_infos[0]
         categories: List[CategoryInfo] = await self.get_promotion_categories(shop=shop, location=location)
 
         async def get_page_products(category: CategoryInfo):
+            unit = (shop, location, category.id, 1)
+            saved_products = restore_page_products(checkpoint, unit)
+            if saved_products is not None:
+                return ProductListWithCategory(category=category, product_list=saved_products)
+
             params = {'category-id': category.id}
 
             product_url = f"{BASE_ZAKAZ_UA_URL}/{shop_info.id}/products/promotion/"
-            response = await get_http_response(product_url, headers={"Accept-Language": "uk"}, params=params)
+            response_info = await get_http_response_info(
+                product_url, headers={"Accept-Language": "uk", **conditional_headers(fingerprints, category.id)},
+                params=params, rate_limiter=get_rate_limiter(shop))
+            if fingerprints is not None and not is_category_changed(fingerprints, category.id, response_info,
+                                                                    'results'):
+                return None
+            response = response_info.get("response")
             if response:
                 shop_products: List[PromoProductInfo] = parse_obj_as(List[PromoProductInfo], response['results'])
                 mapped_products = []
@@ -164,13 +221,13 @@ class ZakazoShopScrapperService(ShopScrapperService):
                     mapped_product.promotion = PromoInfo(stop_date=due_date, old_price=old_price)
                     mapped_products.append(mapped_product)
 
+                record_page_products(checkpoint, unit, mapped_products)
                 return ProductListWithCategory(category=category, product_list=mapped_products)
             else:
                 logging.warning(f"Failed to parse products of category {category} of shop {shop}, location: {location}")
+                record_page_products(checkpoint, unit, None)
                 return None
 
-        results: Dict[str, List[ProductInfo]] = defaultdict(list)
-
         def get_categories(category: CategoryInfo):
             categories = []
             if category.children:
@@ -196,15 +253,11 @@ class ZakazoShopScrapperService(ShopScrapperService):
 
         total_tasks = len(scrape_args)
         print(f"Total amount of scrape tasks: {total_tasks},  categories: {len(categories_flat)}")
-        completed_tasks = 0
-        for args in chunks(scrape_args, 15):
-            for item in await asyncio.gather(
-                    *[asyncio.create_task(get_page_products(arg.get("category"))) for arg in args]):
-                item: ProductListWithCategory
-                results[item.category.id].extend(item.product_list)
-                completed_tasks += 1
-            print(f"Completed {round(completed_tasks / total_tasks * 100)}% of tasks")
-            await asyncio.sleep(2.5)
-
-        return results
+        async for item in as_completed_with_progress([get_page_products(arg.get("category")) for arg in scrape_args],
+                                                     name=f"{shop}_{location}_promotion"):
+            item: ProductListWithCategory
+            if item:
+                if fingerprints is not None:
+                    fingerprints.category_scraped(item.category.id, [item.category.id], True)
+                yield item.category.id, item.product_list
 